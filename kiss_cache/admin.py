@@ -21,8 +21,8 @@ class ResourceAdmin(admin.ModelAdmin):
 
 
 class StatisticAdmin(admin.ModelAdmin):
-    list_display = ("stat_display", "value", "humanized")
-    ordering = ["stat"]
+    list_display = ("stat_display", "shard", "value", "humanized")
+    ordering = ["stat", "shard"]
 
     def stat_display(self, obj):
         return obj.get_stat_display()
@@ -30,7 +30,11 @@ class StatisticAdmin(admin.ModelAdmin):
     stat_display.short_description = "Statistic"
 
     def humanized(self, obj):
-        if obj.stat in [Statistic.STAT_DOWNLOAD, Statistic.STAT_UPLOAD]:
+        if obj.stat in [
+            Statistic.STAT_DOWNLOAD,
+            Statistic.STAT_UPLOAD,
+            Statistic.STAT_SIZE,
+        ]:
             return filesizeformat(obj.value)
 
 
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import atexit
+import logging
+import operator
+import os
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+LOG = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    """
+    Accumulate values in memory and flush them in batches.
+
+    Values added for the same key are merged together. The flush function is
+    called with a dictionary of the merged values, every N seconds, by a
+    background thread. N is read from the given setting and, when N is 0, the
+    values are flushed immediately.
+    """
+
+    def __init__(self, flush, interval_setting, merge=operator.add):
+        self.flush_func = flush
+        self.interval_setting = interval_setting
+        self.merge = merge
+        self.lock = threading.Lock()
+        self.data = {}
+        self.pid = None
+        atexit.register(self.flush)
+
+    def add(self, key, value):
+        interval = getattr(settings, self.interval_setting)
+        if interval <= 0:
+            self.flush_func({key: value})
+            return
+
+        with self.lock:
+            # The thread does not survive a fork: start a new one in each
+            # process and drop the values inherited from the parent.
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.data = {}
+                thread = threading.Thread(
+                    target=self._run, args=(interval,), daemon=True
+                )
+                thread.start()
+            self._merge({key: value})
+
+    def _merge(self, data):
+        for key, value in data.items():
+            if key in self.data:
+                self.data[key] = self.merge(self.data[key], value)
+            else:
+                self.data[key] = value
+
+    def _run(self, interval):
+        event = threading.Event()
+        while not event.wait(interval):
+            close_old_connections()
+            self.flush()
+
+    def flush(self):
+        """Flush the pending values"""
+        with self.lock:
+            data, self.data = self.data, {}
+        if not data:
+            return
+        try:
+            self.flush_func(data)
+        except Exception as exc:
+            LOG.error("Unable to flush %d values, retrying later", len(data))
+            LOG.exception(exc)
+            with self.lock:
+                self._merge(data)
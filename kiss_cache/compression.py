@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import gzip
+import hashlib
+import os
+import struct
+import zlib
+
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    # Only required by the "br" variants and downloads
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    # Only required when RESOURCE_COMPRESSION is "zstd" or by the "zstd"
+    # variants and downloads
+    zstandard = None
+
+# The compressed files use the zstd seekable format: independent frames
+# followed by a skippable frame listing the size of each frame. See
+# https://github.com/facebook/zstd/blob/dev/contrib/seekable_format/zstd_seekable_compression_format.md
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SKIPPABLE_HEADER = struct.Struct("<II")
+ENTRY = struct.Struct("<II")
+# Number of frames, descriptor and magic number
+FOOTER = struct.Struct("<IBI")
+CHECKSUM_FLAG = 0x80
+
+# Suffix of the compressed files and of the variants
+SUFFIXES = {"br": ".br", "gzip": ".gz", "zstd": ".zst"}
+
+
+def check():
+    """Raise if the compression or the variants are not usable"""
+    if settings.RESOURCE_COMPRESSION not in ["", "zstd"]:
+        raise NotImplementedError("Unknown compression")
+    if settings.RESOURCE_COMPRESSION and zstandard is None:
+        raise NotImplementedError("The zstd compression requires zstandard")
+    for coding in settings.RESOURCE_VARIANTS:
+        if coding not in SUFFIXES:
+            raise NotImplementedError("Unknown variant encoding")
+        if coding == "br" and brotli is None:
+            raise NotImplementedError("The br variants require brotli")
+        if coding == "zstd" and zstandard is None:
+            raise NotImplementedError("The zstd variants require zstandard")
+    for coding in settings.DOWNLOAD_ENCODINGS:
+        if coding not in SUFFIXES:
+            raise NotImplementedError("Unknown download encoding")
+        if coding == "br" and brotli is None:
+            raise NotImplementedError("The br downloads require brotli")
+        if coding == "zstd" and zstandard is None:
+            raise NotImplementedError("The zstd downloads require zstandard")
+
+
+def is_compressible(content_type):
+    content_type = content_type.split(";")[0].strip().lower()
+    return any(
+        content_type.startswith(prefix)
+        for prefix in settings.RESOURCE_COMPRESSION_TYPES
+    )
+
+
+def compress(src, dst):
+    """
+    Compress src into dst, by frames of RESOURCE_COMPRESSION_FRAME_SIZE bytes.
+
+    Return the sha256 of dst or None when the first frame is not compressed
+    enough (dst is then incomplete).
+    """
+    cctx = zstandard.ZstdCompressor(level=settings.RESOURCE_COMPRESSION_LEVEL)
+    checksum = hashlib.sha256()
+    entries = []
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        while True:
+            data = f_in.read(settings.RESOURCE_COMPRESSION_FRAME_SIZE)
+            if not data:
+                break
+            frame = cctx.compress(data)
+            if (
+                not entries
+                and len(frame) > len(data) * settings.RESOURCE_COMPRESSION_MAX_RATIO
+            ):
+                return None
+            entries.append((len(frame), len(data)))
+            f_out.write(frame)
+            checksum.update(frame)
+
+        table = b"".join(ENTRY.pack(*entry) for entry in entries)
+        table += FOOTER.pack(len(entries), 0, SEEKABLE_MAGIC)
+        table = SKIPPABLE_HEADER.pack(SKIPPABLE_MAGIC, len(table)) + table
+        f_out.write(table)
+        checksum.update(table)
+    return checksum
+
+
+def seek_table(fd):
+    """Return the (offset, size, plain offset, plain size) of each frame"""
+    length = os.fstat(fd).st_size
+    count, descriptor, magic = FOOTER.unpack(
+        os.pread(fd, FOOTER.size, length - FOOTER.size)
+    )
+    if magic != SEEKABLE_MAGIC:
+        raise ValueError("Invalid seek table")
+    entry_size = ENTRY.size + (4 if descriptor & CHECKSUM_FLAG else 0)
+    data = os.pread(fd, count * entry_size, length - FOOTER.size - count * entry_size)
+    frames = []
+    offset = plain = 0
+    for index in range(count):
+        size, plain_size = ENTRY.unpack_from(data, index * entry_size)
+        frames.append((offset, size, plain, plain_size))
+        offset += size
+        plain += plain_size
+    return frames
+
+
+def decompress(fd, start=0, end=None):
+    """Generate the decompressed content, from start to end (excluded)"""
+    dctx = zstandard.ZstdDecompressor()
+    for offset, size, plain, plain_size in seek_table(fd):
+        if plain + plain_size <= start:
+            continue
+        if end is not None and plain >= end:
+            break
+        data = dctx.decompress(os.pread(fd, size, offset))
+        first = max(start - plain, 0)
+        last = plain_size if end is None else min(end - plain, plain_size)
+        yield data if first == 0 and last == plain_size else data[first:last]
+
+
+def encode(coding, chunks, dst):
+    """Write the chunks encoded with the given coding to dst, return the size"""
+    with open(dst, "wb") as f_out:
+        if coding == "gzip":
+            with gzip.GzipFile(
+                fileobj=f_out,
+                mode="wb",
+                compresslevel=settings.RESOURCE_VARIANTS_GZIP_LEVEL,
+                mtime=0,
+            ) as f_gz:
+                for data in chunks:
+                    f_gz.write(data)
+        elif coding == "br":
+            compressor = brotli.Compressor(
+                quality=settings.RESOURCE_VARIANTS_BROTLI_QUALITY
+            )
+            for data in chunks:
+                f_out.write(compressor.process(data))
+            f_out.write(compressor.finish())
+        elif coding == "zstd":
+            compressor = zstandard.ZstdCompressor(
+                level=settings.RESOURCE_COMPRESSION_LEVEL
+            ).compressobj()
+            for data in chunks:
+                f_out.write(compressor.compress(data))
+            f_out.write(compressor.flush())
+        else:
+            raise NotImplementedError("Unknown variant encoding")
+        return f_out.tell()
+
+
+class Decoder:
+    """Decode, chunk by chunk, a content received with the given coding"""
+
+    def __init__(self, coding):
+        self.coding = coding
+        self.decoder = self._new()
+
+    def _new(self):
+        if self.coding == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.coding == "br":
+            return brotli.Decompressor()
+        if self.coding == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj()
+        raise NotImplementedError("Unknown download encoding")
+
+    def decode(self, data):
+        if self.coding == "br":
+            return self.decoder.process(data)
+        chunks = [self.decoder.decompress(data)]
+        # gzip members and zstd frames might be concatenated
+        while getattr(self.decoder, "eof", False) and self.decoder.unused_data:
+            data = self.decoder.unused_data
+            self.decoder = self._new()
+            chunks.append(self.decoder.decompress(data))
+        return b"".join(chunks)
+
+    def finished(self):
+        """Return False if the content is truncated"""
+        if self.coding == "br":
+            return self.decoder.is_finished()
+        # Only known for the recent versions of zstandard
+        return getattr(self.decoder, "eof", True)
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import atexit
+import logging
+import os
+import pathlib
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from celery.signals import worker_process_shutdown
+from django.conf import settings
+from django.utils import timezone
+
+from kiss_cache.__about__ import __version__
+from kiss_cache.models import Resource
+from kiss_cache.notify import notify
+from kiss_cache.tasks import (
+    _accept_encoding,
+    _checksum,
+    _claim,
+    _decoder_for,
+    _encoded_length,
+    _failed,
+    _fetched,
+    _heartbeat,
+    _log_progress,
+    _log_speed,
+    _store_headers,
+)
+from kiss_cache.utils import RETRY_STATUS_CODES
+
+try:
+    import aiohttp
+
+    CLIENT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+except ImportError:  # pragma: no cover
+    # Only required by the asyncio engine
+    aiohttp = None
+    CLIENT_ERRORS = (asyncio.TimeoutError,)
+
+LOG = logging.getLogger(__name__)
+
+
+async def _get(session, url, headers):
+    """Send the request, retrying like requests_retry()"""
+    retries = settings.DOWNLOAD_RETRY
+    for attempt in range(retries + 1):
+        if attempt > 1:
+            await asyncio.sleep(settings.DOWNLOAD_BACKOFF_FACTOR * 2 ** (attempt - 1))
+        try:
+            resp = await session.get(url, headers=headers)
+        except CLIENT_ERRORS:
+            if attempt == retries:
+                raise
+            continue
+        if resp.status not in RETRY_STATUS_CODES or attempt == retries:
+            return resp
+        resp.release()
+
+
+def _set_status(res):
+    Resource.objects.filter(pk=res.pk).update(status_code=200)
+    res.refresh_from_db()
+
+
+def _set_downloading(res):
+    # Informe the caller about the current state
+    Resource.objects.filter(pk=res.pk).update(
+        state=Resource.STATE_DOWNLOADING, claimed_at=timezone.now()
+    )
+    notify(res.pk)
+    res.refresh_from_db()
+
+
+async def fetch_async(url, session):
+    """
+    Same as the fetch task, using an aiohttp session.
+
+    The database is only accessed through sync_to_async, the event loop is
+    only blocked by the writes to the file.
+    """
+    LOG.info("Fetching '%s'", url)
+    res = await sync_to_async(_claim)(url)
+    if res is None:
+        return
+    url = res.url
+    started = time.monotonic()
+
+    # Create the directory
+    try:
+        base = pathlib.Path(settings.DOWNLOAD_PATH)
+        (base / res.path).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    except OSError as exc:
+        LOG.error("Unable to create the directory '%s'", str((base / res.path)))
+        LOG.exception(exc)
+        await sync_to_async(_failed)(res, 500)
+        return
+
+    # Keep track of the total amount of data, and of the data received when
+    # the content is encoded
+    size = 0
+    received = 0
+    decoder = None
+    encoded_length = None
+    checksum = None
+    retries = 0
+    max_retries = settings.RESOURCE_PARTIAL_DOWLOAD_RETRIES
+    try:
+        while retries < max_retries:
+            # Use a range header if this is a retry
+            headers = {
+                "Accept-Encoding": _accept_encoding(),
+                "User-Agent": f"KissCache/{__version__}",
+            }
+            if received:
+                headers["Range"] = f"bytes={received}-"
+
+            try:
+                resp = await _get(session, res.url, headers)
+            except CLIENT_ERRORS as exc:
+                LOG.error("Unable to connect to '%s'", url)
+                LOG.exception(exc)
+                await sync_to_async(_failed)(res, 502)
+                return
+
+            # When retrying range requests should work, hence status is 206
+            status = resp.status
+            if retries > 0 and received:
+                if status != 206:
+                    LOG.error("Unable to issue range requests when retrying")
+                    status = 502
+                elif (
+                    decoder is not None
+                    and decoder.coding
+                    != resp.headers.get("Content-Encoding", "").strip().lower()
+                ):
+                    LOG.error("The content encoding changed when retrying")
+                    status = 502
+                else:
+                    status = 200
+
+            # Update the status code
+            if status != 200:
+                resp.release()
+                await sync_to_async(_failed)(res, status)
+                LOG.error("'%s' returned %d", url, status)
+                return
+            await sync_to_async(_set_status)(res)
+
+            if not received:
+                decoder = _decoder_for(resp.headers)
+            if retries == 0:
+                await sync_to_async(_store_headers)(
+                    res, resp.headers, decoder is not None
+                )
+                checksum = _checksum(res)
+                if decoder is not None:
+                    encoded_length = _encoded_length(resp.headers)
+
+            # When retrying, append to the file
+            mode = "wb" if retries == 0 else "ab"
+            force_retry = False
+            with res.open(mode=mode) as f_out:
+                await sync_to_async(_set_downloading)(res)
+
+                # variables to log progress
+                last_logged_value = 0
+                start = time.time()
+                last_notified = last_heartbeat = time.monotonic()
+
+                try:
+                    async for data in resp.content.iter_any():
+                        received += len(data)
+                        if decoder is not None:
+                            data = decoder.decode(data)
+                        size += f_out.write(data)
+                        if checksum is not None:
+                            checksum.update(data)
+
+                        now = time.monotonic()
+                        if now - last_notified < settings.NOTIFY_PROGRESS_INTERVAL:
+                            continue
+                        last_notified = now
+
+                        # Wake up the streaming clients
+                        f_out.flush()
+                        await sync_to_async(notify)(res.pk, progress=True)
+                        if now - last_heartbeat >= settings.FETCH_CLAIM_HEARTBEAT:
+                            last_heartbeat = now
+                            await sync_to_async(_heartbeat)(res)
+                        last_logged_value = _log_progress(
+                            size, res.content_length, last_logged_value
+                        )
+                except CLIENT_ERRORS as exc:
+                    LOG.error("Unable to fetch '%s'", url)
+                    LOG.exception(exc)
+                    force_retry = True
+                finally:
+                    resp.release()
+
+                _log_speed(size, start)
+
+            # Retry if kisscache was unable to download the full file
+            if not force_retry:
+                if decoder is not None:
+                    if decoder.finished() and encoded_length in [None, received]:
+                        break
+                elif not res.content_length:
+                    break
+                elif res.content_length == size:
+                    break
+
+            if decoder is not None:
+                LOG.warning(
+                    "The encoded size (%d) is not equal to the Content-Length (%s)",
+                    received,
+                    encoded_length,
+                )
+            else:
+                LOG.warning(
+                    "The total size (%d) is not equal to the Content-Length (%d)",
+                    size,
+                    res.content_length,
+                )
+            LOG.warning("Retrying (%d/%d) after 5 seconds", retries, max_retries)
+            await asyncio.sleep(5)
+            retries += 1
+
+    except Exception as exc:
+        LOG.error("Unable to fetch '%s'", url)
+        LOG.exception(exc)
+        await sync_to_async(_failed)(res, 504)
+        return
+
+    await sync_to_async(_fetched)(res, size, time.monotonic() - started, checksum)
+
+
+class Engine:
+    """
+    Event loop running, in a thread, the downloads of the current process.
+
+    The fetch tasks only hand the urls over to the event loop, so a single
+    worker process runs up to FETCH_ASYNC_CONCURRENCY downloads. The tasks
+    are acknowledged before the downloads are done: the downloads lost with
+    a worker are not redelivered but scheduled again by the expire task (see
+    Resource.lost).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.session = None
+        self.concurrency = 0
+        self.slots = None
+
+    def _reset(self):
+        """Drop the event loop inherited from the parent process"""
+        self.lock = threading.Lock()
+        self.loop = None
+        self.session = None
+        self.slots = None
+
+    def _start(self):
+        with self.lock:
+            if self.loop is not None:
+                return
+            if aiohttp is None:
+                raise NotImplementedError("The asyncio fetch engine requires aiohttp")
+            self.concurrency = settings.FETCH_ASYNC_CONCURRENCY
+            self.slots = threading.BoundedSemaphore(self.concurrency)
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=self.loop.run_forever, name="kiss-cache-engine", daemon=True
+            ).start()
+
+    async def _session(self):
+        # Only called from the event loop
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=settings.FETCH_ASYNC_CONCURRENCY,
+                ttl_dns_cache=settings.DOWNLOAD_DNS_CACHE_TIMEOUT,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                auto_decompress=False,
+                # The session is shared by unrelated downloads
+                cookie_jar=aiohttp.DummyCookieJar(),
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=settings.DOWNLOAD_TIMEOUT,
+                    sock_read=settings.DOWNLOAD_TIMEOUT,
+                ),
+            )
+        return self.session
+
+    async def _fetch(self, url):
+        try:
+            await fetch_async(url, await self._session())
+        except Exception as exc:
+            LOG.exception(exc)
+        finally:
+            self.slots.release()
+
+    def submit(self, url):
+        """
+        Schedule the download of the url.
+
+        Block while FETCH_ASYNC_CONCURRENCY downloads are running, hence the
+        worker process stops accepting new tasks.
+        """
+        self._start()
+        self.slots.acquire()
+        return asyncio.run_coroutine_threadsafe(self._fetch(url), self.loop)
+
+    def stop(self):
+        """Wait for the running downloads and stop the event loop"""
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is None:
+            return
+        for _ in range(self.concurrency):
+            self.slots.acquire()
+        if self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), loop).result()
+            self.session = None
+        loop.call_soon_threadsafe(loop.stop)
+
+
+ENGINE = Engine()
+os.register_at_fork(after_in_child=ENGINE._reset)
+atexit.register(ENGINE.stop)
+
+
+@worker_process_shutdown.connect
+def _stop_engine(**kwargs):
+    """
+    Wait for the downloads before the worker process exits: the prefork
+    children exit with os._exit(), skipping the atexit handlers.
+    """
+    ENGINE.stop()
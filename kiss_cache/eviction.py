@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+from django.conf import settings
+from django.db.models import F, FloatField, Min, Sum, Value
+from django.db.models.functions import Cast, Coalesce, Greatest
+
+from kiss_cache.models import Ghost, Resource, Statistic
+
+# Columns of the candidates, used to compute the size freed by the eviction
+COLUMNS = (
+    "pk",
+    "url",
+    "content_length",
+    "content_digest",
+    "stored_length",
+    "variants_length",
+)
+
+
+class Policy:
+    """
+    Select the resources to evict when the quota is almost reached.
+
+    candidates() should yield tuples of the COLUMNS, in eviction order, from
+    the query of the evictable resources.
+    """
+
+    description = None
+
+    def candidates(self, query):
+        raise NotImplementedError
+
+    def evicted(self, resources):
+        """Called with the list of evicted resources"""
+
+    def fetched(self, pk):
+        """Called when a resource was fully downloaded"""
+
+    def missed(self, url):
+        """Called when a resource is not in the cache"""
+
+    def usage_updates(self, usages):
+        """
+        Return the fields to update when the usages are flushed.
+
+        "usages" is the expression of the usage increment.
+        """
+        return {}
+
+
+class LRU(Policy):
+    """Least Recently Used"""
+
+    description = "last usage"
+
+    def candidates(self, query):
+        query = query.order_by("last_usage")
+        return query.values_list(*COLUMNS).iterator()
+
+
+class LFU(Policy):
+    """Least Frequently Used, the least recently used first in case of tie"""
+
+    description = "usage count"
+
+    def candidates(self, query):
+        query = query.order_by("usage", "last_usage")
+        return query.values_list(*COLUMNS).iterator()
+
+
+class GDSF(Policy):
+    """
+    Greedy-Dual-Size-Frequency
+
+    The priority of each resource is L + usage / size, computed on each hit. L
+    is the inflation value: the lowest priority of the cached resources. Small
+    and often used resources are kept while large resources used once are
+    evicted first. Resources that are not used anymore age as L increases.
+    """
+
+    description = "size and frequency"
+
+    def _inflation(self):
+        query = Resource.objects.filter(state=Resource.STATE_FINISHED)
+        return query.aggregate(value=Min("priority"))["value"] or 0
+
+    def _priority(self, usages):
+        usage = Cast(F("usage") + usages, FloatField())
+        size = Greatest(Coalesce("content_length", 1), 1)
+        return Value(self._inflation()) + usage / Cast(size, FloatField())
+
+    def candidates(self, query):
+        query = query.order_by("priority", "last_usage")
+        return query.values_list(*COLUMNS).iterator()
+
+    def fetched(self, pk):
+        # The size is now known
+        Resource.objects.filter(pk=pk).update(priority=self._priority(Value(0)))
+
+    def usage_updates(self, usages):
+        return {"priority": self._priority(usages)}
+
+
+class ARC(Policy):
+    """
+    Adaptive Replacement Cache
+
+    Resources used once (T1) and resources used more than once (T2) are kept
+    in two LRU lists. The target size of T1 (p) is adapted when a recently
+    evicted resource (a ghost) is requested again: p is increased for ghosts
+    from T1 and decreased for ghosts from T2.
+    """
+
+    description = "adaptive replacement"
+
+    def _target(self):
+        return min(max(Statistic.arc_target(), 0), settings.RESOURCE_QUOTA)
+
+    def candidates(self, query):
+        query = query.order_by("last_usage")
+        columns = COLUMNS + ("usage",)
+        recent = query.filter(usage__lte=1)
+        recent_size = recent.aggregate(size=Sum("content_length"))["size"] or 0
+        recent = recent.values_list(*columns).iterator()
+        frequent = query.filter(usage__gt=1).values_list(*columns).iterator()
+
+        # Evict from T1 while it's larger than the target, then from T2
+        target = self._target()
+        while True:
+            candidate = None
+            if recent_size > target:
+                candidate = next(recent, None)
+            if candidate is None:
+                candidate = next(frequent, None) or next(recent, None)
+            if candidate is None:
+                return
+            if candidate[-1] <= 1:
+                recent_size -= candidate[2] or 0
+            yield candidate[:-1]
+
+    def evicted(self, resources):
+        Ghost.objects.bulk_create(
+            [
+                Ghost(
+                    key=Ghost.key_for(res.url),
+                    frequent=res.usage > 1,
+                    size=res.content_length or 0,
+                )
+                for res in resources
+            ],
+            ignore_conflicts=True,
+        )
+        # Only keep the most recent ghosts
+        limit = settings.RESOURCE_EVICTION_GHOSTS
+        query = Ghost.objects.order_by("-pk").values_list("pk", flat=True)
+        last = list(query[limit : limit + 1])
+        if last:
+            Ghost.objects.filter(pk__lte=last[0]).delete()
+
+    def missed(self, url):
+        ghost = Ghost.objects.filter(key=Ghost.key_for(url)).first()
+        if ghost is None:
+            return
+        sizes = dict(Ghost.objects.values_list("frequent").annotate(size=Sum("size")))
+        recent, frequent = sizes.get(False) or 1, sizes.get(True) or 1
+        current = self._target()
+        if ghost.frequent:
+            target = current - max(recent / frequent, 1) * ghost.size
+        else:
+            target = current + max(frequent / recent, 1) * ghost.size
+        target = min(max(int(target), 0), settings.RESOURCE_QUOTA)
+        Statistic.arc_target(target - current)
+        ghost.delete()
+
+
+POLICIES = {"lru": LRU, "lfu": LFU, "gdsf": GDSF, "arc": ARC}
+
+
+def get_policy():
+    try:
+        return POLICIES[settings.RESOURCE_EVICTION_POLICY]()
+    except KeyError:
+        raise NotImplementedError("Unknown eviction policy")
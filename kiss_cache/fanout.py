@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import collections
+import contextlib
+import copy
+import os
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from kiss_cache.inotify import Watcher
+from kiss_cache.notify import _set_result, subscribe
+
+
+class Tail:
+    """
+    Follow a file being downloaded on behalf of every client streaming it in
+    the current process.
+
+    The last chunks read are kept in a bounded buffer shared by the readers.
+    A single reader at a time (the leader) reads the new data and waits for
+    the fetch task, the other readers wait for the buffer to be updated.
+    Readers lagging behind the buffer read the file directly.
+    """
+
+    def __init__(self, res):
+        # Only the leader refreshes this copy
+        self.res = copy.copy(res)
+        self.pk = res.pk
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.futures = set()
+        self.readers = 0
+        self.leading = False
+        # Chunks of (offset, data), from "start" to "end"
+        self.chunks = collections.deque()
+        self.start = 0
+        self.end = 0
+        self.size = 0
+        self.finished = False
+        self.deleted = False
+
+        # The file won't be removed by the OS until the file descriptor is
+        # closed, even if the resource is removed.
+        self.fd = os.open(res.fullpath, os.O_RDONLY | os.O_CLOEXEC)
+        self.subscription = subscribe(self.pk).__enter__()
+        self.watcher = Watcher(res.fullpath)
+
+    def close(self):
+        self.watcher.close()
+        self.subscription.__exit__(None, None, None)
+        os.close(self.fd)
+
+    def _wake(self):
+        self.condition.notify_all()
+        for loop, future in self.futures:
+            loop.call_soon_threadsafe(_set_result, future)
+
+    def _append(self, data):
+        with self.lock:
+            self.chunks.append((self.end, data))
+            self.end += len(data)
+            self.size += len(data)
+            while (
+                self.size > settings.STREAM_FANOUT_BUFFER_SIZE and len(self.chunks) > 1
+            ):
+                _, chunk = self.chunks.popleft()
+                self.size -= len(chunk)
+                self.start = self.chunks[0][0]
+            self._wake()
+
+    def _finish(self):
+        with self.lock:
+            self.finished = True
+            self._wake()
+
+    def _get(self, offset):
+        """
+        Return the buffered chunks after offset or None if the reader is
+        lagging. Should be called with the lock held.
+        """
+        if offset < self.start:
+            return None
+        data = []
+        for chunk_offset, chunk in self.chunks:
+            if chunk_offset + len(chunk) <= offset:
+                continue
+            if chunk_offset < offset:
+                chunk = chunk[offset - chunk_offset :]
+            data.append(chunk)
+        return data
+
+    def _pread(self, offset):
+        return os.pread(self.fd, settings.STREAM_CHUNK_SIZE, offset)
+
+    def _next(self, offset):
+        """
+        Return the next action for the reader at offset:
+        ("data", chunks), ("lagging", None), ("lead", None), ("wait", None) or
+        ("done", None). Should be called with the lock held.
+        """
+        data = self._get(offset)
+        if data is None:
+            return ("lagging", None)
+        if data:
+            return ("data", data)
+        if self.finished:
+            return ("done", None)
+        if not self.leading:
+            self.leading = True
+            return ("lead", None)
+        return ("wait", None)
+
+    def _read_new_data(self):
+        """Read the new data, return False when the end of file is reached"""
+        # When downloading by segments, the file is preallocated: only read
+        # up to the watermark.
+        watermark = self.res.watermark
+        if watermark is not None:
+            length = min(settings.STREAM_CHUNK_SIZE, watermark - self.end)
+            if length <= 0:
+                return False
+            data = os.pread(self.fd, length, self.end)
+        else:
+            data = self._pread(self.end)
+        if data:
+            self._append(data)
+        return bool(data)
+
+    def _available(self):
+        """Return the length of the data already on disk"""
+        size = os.fstat(self.fd).st_size
+        watermark = self.res.watermark
+        return size if watermark is None else min(size, watermark)
+
+    def _lead(self):
+        """Read the new data or wait for the fetch task (leader only)"""
+        if self._read_new_data():
+            return
+        if self.res.state == self.res.STATE_FINISHED:
+            self._finish()
+            return
+        self._wait()
+
+    def _wait(self):
+        """Wait for the fetch task (leader only)"""
+        # Wait for the fetch task to write more data. Once the file was
+        # closed, only wait for the notifications until the state changes.
+        # The watermark is only updated in the database, along with the
+        # progress notifications.
+        segmented = self.res.watermark is not None
+        if not segmented and self.watcher.wait(settings.NOTIFY_TIMEOUT):
+            return
+        # Wait for an update and refresh from database if needed
+        try:
+            if self.subscription.wait() or segmented:
+                self.res.refresh_from_db()
+        except self.res.DoesNotExist:
+            # The object was removed from the db: continue to stream the data
+            self.res.state = self.res.STATE_FINISHED
+            self.deleted = True
+
+    async def _lead_async(self):
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, self._read_new_data):
+            return
+        if self.res.state == self.res.STATE_FINISHED:
+            self._finish()
+            return
+        await self._wait_async()
+
+    async def _wait_async(self):
+        segmented = self.res.watermark is not None
+        if not segmented and await self.watcher.wait_async(settings.NOTIFY_TIMEOUT):
+            return
+        try:
+            if await self.subscription.wait_async() or segmented:
+                await sync_to_async(self.res.refresh_from_db)()
+        except self.res.DoesNotExist:
+            self.res.state = self.res.STATE_FINISHED
+            self.deleted = True
+
+    def _release_lead(self):
+        with self.lock:
+            self.leading = False
+            self._wake()
+
+    def _acquire_lead(self):
+        """Return True if the caller is now the leader"""
+        with self.lock:
+            if self.leading:
+                return False
+            self.leading = True
+            return True
+
+    def _check_range(self, offset, end):
+        if offset < end:
+            raise Exception(f"Range streamed is truncated: {offset} vs {end}")
+
+    def read(self):
+        """Generate the content of the file until the download is finished"""
+        offset = 0
+        while True:
+            with self.lock:
+                action, data = self._next(offset)
+                if action == "wait":
+                    self.condition.wait(settings.NOTIFY_TIMEOUT)
+                    continue
+            if action == "done":
+                break
+            if action == "data":
+                for chunk in data:
+                    offset += len(chunk)
+                    yield chunk
+            elif action == "lagging":
+                chunk = self._pread(offset)
+                offset += len(chunk)
+                yield chunk
+            else:
+                try:
+                    self._lead()
+                finally:
+                    self._release_lead()
+        self.res._check_streamed_length(offset, self.deleted)
+
+    def read_range(self, start, end):
+        """
+        Generate the content from start to end (excluded).
+
+        The data already on disk is read directly, without the buffer. Only
+        the remaining data is waited for.
+        """
+        offset = start
+        while offset < end:
+            available = self._available()
+            if offset < available:
+                length = min(settings.STREAM_CHUNK_SIZE, min(end, available) - offset)
+                chunk = os.pread(self.fd, length, offset)
+                offset += len(chunk)
+                yield chunk
+                continue
+            if self.res.state == self.res.STATE_FINISHED:
+                break
+            if not self._acquire_lead():
+                with self.lock:
+                    self.condition.wait(settings.NOTIFY_TIMEOUT)
+                continue
+            try:
+                self._wait()
+            finally:
+                self._release_lead()
+        self._check_range(offset, end)
+
+    async def read_range_async(self, start, end):
+        """Same as read_range(), as an async generator"""
+        loop = asyncio.get_running_loop()
+        offset = start
+        while offset < end:
+            available = await loop.run_in_executor(None, self._available)
+            if offset < available:
+                length = min(settings.STREAM_CHUNK_SIZE, min(end, available) - offset)
+                chunk = await loop.run_in_executor(
+                    None, os.pread, self.fd, length, offset
+                )
+                offset += len(chunk)
+                yield chunk
+                continue
+            if self.res.state == self.res.STATE_FINISHED:
+                break
+            if not self._acquire_lead():
+                with self.lock:
+                    waiter = (loop, loop.create_future())
+                    self.futures.add(waiter)
+                try:
+                    await asyncio.wait_for(waiter[1], settings.NOTIFY_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with self.lock:
+                        self.futures.discard(waiter)
+                continue
+            try:
+                await self._wait_async()
+            finally:
+                self._release_lead()
+        self._check_range(offset, end)
+
+    async def read_async(self):
+        """Same as read(), as an async generator"""
+        loop = asyncio.get_running_loop()
+        offset = 0
+        while True:
+            with self.lock:
+                action, data = self._next(offset)
+                if action == "wait":
+                    waiter = (loop, loop.create_future())
+                    self.futures.add(waiter)
+            if action == "wait":
+                try:
+                    await asyncio.wait_for(waiter[1], settings.NOTIFY_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with self.lock:
+                        self.futures.discard(waiter)
+                continue
+            if action == "done":
+                break
+            if action == "data":
+                for chunk in data:
+                    offset += len(chunk)
+                    yield chunk
+            elif action == "lagging":
+                chunk = await loop.run_in_executor(None, self._pread, offset)
+                offset += len(chunk)
+                yield chunk
+            else:
+                try:
+                    await self._lead_async()
+                finally:
+                    self._release_lead()
+        self.res._check_streamed_length(offset, self.deleted)
+
+
+class FanOut:
+    """Registry of the files followed in the current process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tails = {}
+
+    @contextlib.contextmanager
+    def acquire(self, res):
+        pk = res.pk
+        with self.lock:
+            tail = self.tails.get(pk)
+            if tail is None:
+                tail = self.tails[pk] = Tail(res)
+            tail.readers += 1
+        try:
+            yield tail
+        finally:
+            with self.lock:
+                tail.readers -= 1
+                if not tail.readers:
+                    del self.tails[pk]
+                    tail.close()
+
+
+FANOUT = FanOut()
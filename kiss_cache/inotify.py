@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import contextlib
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+
+EVENT = struct.Struct("iIII")
+
+_LIBC = []
+
+
+def _libc():
+    """Return the libc if it implements inotify, None otherwise"""
+    if not _LIBC:
+        libc = None
+        with contextlib.suppress(OSError, AttributeError):
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.inotify_init1.restype = ctypes.c_int
+            libc.inotify_add_watch.argtypes = [
+                ctypes.c_int,
+                ctypes.c_char_p,
+                ctypes.c_uint32,
+            ]
+            libc.inotify_add_watch.restype = ctypes.c_int
+        _LIBC.append(libc)
+    return _LIBC[0]
+
+
+class Watcher:
+    """
+    Watch a file for modifications.
+
+    When inotify is not available, wait() will always return False and the
+    caller should fallback to polling.
+    """
+
+    def __init__(self, path):
+        self.fd = None
+        # Set when the writer closed the file: nothing more will be written
+        self.closed = False
+        libc = _libc()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return
+        if (
+            libc.inotify_add_watch(fd, os.fsencode(path), IN_MODIFY | IN_CLOSE_WRITE)
+            < 0
+        ):
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _read_events(self):
+        mask = 0
+        with contextlib.suppress(BlockingIOError):
+            while True:
+                data = os.read(self.fd, 4096)
+                if not data:
+                    break
+                offset = 0
+                while offset < len(data):
+                    _, event_mask, _, length = EVENT.unpack_from(data, offset)
+                    mask |= event_mask
+                    offset += EVENT.size + length
+        return mask
+
+    def wait(self, timeout):
+        """
+        Wait for the file to be modified.
+
+        Return True if new data was written to the file and the writer is still
+        active. Return False if the writer closed the file, on timeout or if
+        inotify is not available.
+        Once the writer closed the file, return False without waiting.
+        """
+        if self.fd is None or self.closed:
+            return False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        return self._modified()
+
+    async def wait_async(self, timeout):
+        """Same as wait() without blocking the event loop"""
+        if self.fd is None or self.closed:
+            return False
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(self.fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(self.fd)
+        return self._modified()
+
+    def _modified(self):
+        mask = self._read_events()
+        if mask & IN_CLOSE_WRITE:
+            self.closed = True
+        return bool(mask & IN_MODIFY) and not mask & IN_CLOSE_WRITE
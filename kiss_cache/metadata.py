@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import collections
+from datetime import timedelta
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+
+class MetadataCache:
+    """
+    Bounded LRU cache of the finished resources, keyed by url.
+
+    The metadata of a finished resource does not change until the resource is
+    deleted, so cache hits can be answered without any database query.
+    Entries are dropped when the resource is deleted (see notify_deleted) and
+    after METADATA_CACHE_TIMEOUT seconds in case a notification was lost.
+
+    The deletions are only notified by the "postgresql" and "redis" backends:
+    the cache is disabled with the "polling" backend.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.urls = {}
+
+    def get(self, url, ttl):
+        """
+        Return the cached resource or None.
+
+        None is also returned when the given ttl would shorten the life of the
+        resource: the caller should then update the database.
+        """
+        if not self._enabled():
+            return None
+        now = timezone.now()
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            res, cached_at = entry
+            # Expired resources are deleted by the expire task
+            if res.expires_at <= now or now - cached_at > timedelta(
+                seconds=settings.METADATA_CACHE_TIMEOUT
+            ):
+                self._remove(url)
+                return None
+            if res.expires_at > now + timedelta(seconds=ttl):
+                return None
+            self.entries.move_to_end(url)
+            return res
+
+    def add(self, res):
+        """Cache the resource if it's finished and was successfully fetched"""
+        if not self._enabled() or res.status_code != 200:
+            return
+        if res.state != res.STATE_FINISHED or res.expires_at is None:
+            return
+        # Listen for the deletions
+        from kiss_cache.notify import (  # pylint: disable=import-outside-toplevel
+            start_listener,
+        )
+
+        start_listener()
+
+        size = settings.METADATA_CACHE_SIZE
+        with self.lock:
+            # Keep the original date of the cache hits: hot entries should
+            # also be dropped after METADATA_CACHE_TIMEOUT.
+            cached_at = timezone.now()
+            entry = self.entries.get(res.url)
+            if entry is not None and entry[0].pk == res.pk:
+                cached_at = entry[1]
+            self._remove(res.url)
+            self.entries[res.url] = (res, cached_at)
+            self.urls[res.pk] = res.url
+            while len(self.entries) > size:
+                self._remove(next(iter(self.entries)))
+
+    def _enabled(self):
+        return settings.METADATA_CACHE_SIZE > 0 and settings.NOTIFY_BACKEND in [
+            "postgresql",
+            "redis",
+        ]
+
+    def invalidate(self, pks):
+        with self.lock:
+            for pk in pks:
+                url = self.urls.get(pk)
+                if url is not None:
+                    self._remove(url)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.urls.clear()
+
+    def _remove(self, url):
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            del self.urls[entry[0].pk]
+
+
+METADATA = MetadataCache()
@@ -0,0 +1,62 @@
+# Generated by Django 2.2.24 on 2022-03-14 10:12
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def copy_statistics(apps, schema_editor):
+    OldStatistic = apps.get_model("kiss_cache", "OldStatistic")
+    Statistic = apps.get_model("kiss_cache", "Statistic")
+    Statistic.objects.bulk_create(
+        [
+            Statistic(stat=stat.stat, shard=0, value=stat.value)
+            for stat in OldStatistic.objects.all()
+        ]
+    )
+
+
+def merge_statistics(apps, schema_editor):
+    OldStatistic = apps.get_model("kiss_cache", "OldStatistic")
+    Statistic = apps.get_model("kiss_cache", "Statistic")
+    for stat in Statistic.objects.values("stat").annotate(value=Sum("value")):
+        OldStatistic.objects.create(stat=stat["stat"], value=stat["value"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("kiss_cache", "0014_auto_resource_url_512")]
+
+    operations = [
+        migrations.RenameModel("Statistic", "OldStatistic"),
+        migrations.CreateModel(
+            name="Statistic",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "stat",
+                    models.IntegerField(
+                        choices=[
+                            (0, "Download"),
+                            (1, "Upload"),
+                            (2, "Successes"),
+                            (3, "Failures"),
+                            (4, "Requests"),
+                        ]
+                    ),
+                ),
+                ("shard", models.IntegerField(default=0)),
+                ("value", models.BigIntegerField(default=0)),
+            ],
+            options={"unique_together": {("stat", "shard")}},
+        ),
+        migrations.RunPython(copy_statistics, merge_statistics),
+        migrations.DeleteModel("OldStatistic"),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.24 on 2022-03-14 14:37
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def set_expires_at(apps, schema_editor):
+    Resource = apps.get_model("kiss_cache", "Resource")
+    resources = []
+    for res in Resource.objects.only("created_at", "ttl").iterator():
+        res.expires_at = res.created_at + timedelta(seconds=res.ttl)
+        resources.append(res)
+        if len(resources) >= 1000:
+            Resource.objects.bulk_update(resources, ["expires_at"])
+            resources = []
+    Resource.objects.bulk_update(resources, ["expires_at"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("kiss_cache", "0015_statistic_shards")]
+
+    operations = [
+        migrations.AddField(
+            model_name="resource",
+            name="expires_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_expires_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="resource",
+            index=models.Index(
+                fields=["state", "expires_at"], name="resource_expires_at_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.24 on 2022-03-15 09:21
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def create_size(apps, schema_editor):
+    Resource = apps.get_model("kiss_cache", "Resource")
+    Statistic = apps.get_model("kiss_cache", "Statistic")
+    STAT_SIZE = 5
+    size = Resource.objects.aggregate(size=Sum("content_length"))["size"]
+    Statistic.objects.create(stat=STAT_SIZE, shard=0, value=size or 0)
+
+
+def delete_size(apps, schema_editor):
+    Statistic = apps.get_model("kiss_cache", "Statistic")
+    STAT_SIZE = 5
+    Statistic.objects.filter(stat=STAT_SIZE).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("kiss_cache", "0016_resource_expires_at")]
+
+    operations = [
+        migrations.AlterField(
+            model_name="statistic",
+            name="stat",
+            field=models.IntegerField(
+                choices=[
+                    (0, "Download"),
+                    (1, "Upload"),
+                    (2, "Successes"),
+                    (3, "Failures"),
+                    (4, "Requests"),
+                    (5, "Size"),
+                ]
+            ),
+        ),
+        migrations.RunPython(create_size, delete_size),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 2.2.24 on 2022-03-16 08:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("kiss_cache", "0017_statistic_size")]
+
+    operations = [
+        migrations.CreateModel(
+            name="Ghost",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=64, unique=True)),
+                ("frequent", models.BooleanField(default=False)),
+                ("size", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="resource",
+            name="priority",
+            field=models.FloatField(default=0),
+        ),
+        migrations.AlterField(
+            model_name="statistic",
+            name="stat",
+            field=models.IntegerField(
+                choices=[
+                    (0, "Download"),
+                    (1, "Upload"),
+                    (2, "Successes"),
+                    (3, "Failures"),
+                    (4, "Requests"),
+                    (5, "Size"),
+                    (6, "ARC target"),
+                ]
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="resource",
+            index=models.Index(
+                fields=["state", "priority"], name="resource_priority_idx"
+            ),
+        ),
+    ]
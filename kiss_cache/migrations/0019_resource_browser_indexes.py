@@ -0,0 +1,40 @@
+# Generated by Django 2.2.24 on 2022-03-17 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kiss_cache", "0018_eviction_policies"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="resource",
+            index=models.Index(
+                fields=["state", "url", "id"], name="resource_state_url_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="resource",
+            index=models.Index(
+                fields=["state", "status_code", "last_usage", "id"],
+                name="resource_last_usage_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="resource",
+            index=models.Index(
+                fields=["state", "status_code", "usage", "id"],
+                name="resource_usage_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="resource",
+            index=models.Index(
+                fields=["state", "status_code", "content_length", "id"],
+                name="resource_size_idx",
+            ),
+        ),
+    ]
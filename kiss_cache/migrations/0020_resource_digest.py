@@ -0,0 +1,40 @@
+# Generated by Django 2.2.24 on 2022-03-18 09:21
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def set_digest(apps, schema_editor):
+    Resource = apps.get_model("kiss_cache", "Resource")
+    resources = []
+    for res in Resource.objects.only("url").iterator():
+        res.digest = hashlib.sha256(res.url.encode("utf-8")).digest()
+        resources.append(res)
+        if len(resources) >= 1000:
+            Resource.objects.bulk_update(resources, ["digest"])
+            resources = []
+    Resource.objects.bulk_update(resources, ["digest"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("kiss_cache", "0019_resource_browser_indexes")]
+
+    operations = [
+        migrations.AddField(
+            model_name="resource",
+            name="digest",
+            field=models.BinaryField(editable=False, max_length=32, null=True),
+        ),
+        migrations.RunPython(set_digest, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="resource",
+            name="digest",
+            field=models.BinaryField(editable=False, max_length=32, unique=True),
+        ),
+        migrations.RemoveIndex(model_name="resource", name="resource_state_url_idx"),
+        migrations.AlterField(
+            model_name="resource", name="url", field=models.TextField()
+        ),
+    ]
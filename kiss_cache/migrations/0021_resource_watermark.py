@@ -0,0 +1,18 @@
+# Generated by Django 2.2.24 on 2022-03-18 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kiss_cache", "0020_resource_digest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="resource",
+            name="watermark",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
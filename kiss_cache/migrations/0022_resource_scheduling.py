@@ -0,0 +1,28 @@
+# Generated by Django 2.2.24 on 2022-03-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kiss_cache", "0021_resource_watermark"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="resource",
+            name="claimed",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="resource",
+            name="queue",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name="resource",
+            name="waiting",
+            field=models.IntegerField(default=0),
+        ),
+    ]
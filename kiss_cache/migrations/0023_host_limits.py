@@ -0,0 +1,54 @@
+# Generated by Django 2.2.24 on 2022-03-18 16:27
+
+from urllib.parse import urlsplit
+
+from django.db import migrations, models
+
+
+def set_host(apps, schema_editor):
+    # Only the resources being fetched are counted by the limits
+    Resource = apps.get_model("kiss_cache", "Resource")
+    for res in Resource.objects.exclude(state=2).only("url"):
+        try:
+            netloc = urlsplit(res.url).netloc
+        except ValueError:
+            continue
+        res.host = netloc.rpartition("@")[2].lower()[:255]
+        res.save(update_fields=["host"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kiss_cache", "0022_resource_scheduling"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Host",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=255, unique=True)),
+                ("limit", models.FloatField()),
+                ("throughput", models.FloatField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="resource",
+            name="host",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name="resource",
+            index=models.Index(fields=["host", "state"], name="resource_host_idx"),
+        ),
+        migrations.RunPython(set_host, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.24 on 2022-03-18 16:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kiss_cache", "0023_host_limits"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Blob",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("digest", models.BinaryField(max_length=32, unique=True)),
+                ("size", models.BigIntegerField()),
+                ("refs", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="resource",
+            name="content_digest",
+            field=models.BinaryField(blank=True, max_length=32, null=True),
+        ),
+    ]
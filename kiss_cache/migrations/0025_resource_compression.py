@@ -0,0 +1,23 @@
+# Generated by Django 2.2.24 on 2022-03-18 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kiss_cache", "0024_blob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="resource",
+            name="compression",
+            field=models.CharField(blank=True, max_length=16),
+        ),
+        migrations.AddField(
+            model_name="resource",
+            name="stored_length",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
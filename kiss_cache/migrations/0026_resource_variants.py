@@ -0,0 +1,23 @@
+# Generated by Django 2.2.24 on 2022-03-18 17:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kiss_cache", "0025_resource_compression"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="resource",
+            name="variants",
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name="resource",
+            name="variants_length",
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.24 on 2022-03-18 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kiss_cache", "0026_resource_variants"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="resource",
+            name="claimed_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="resource",
+            name="claimed_by",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
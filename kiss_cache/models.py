@@ -7,25 +7,78 @@
 #
 # SPDX-License-Identifier: MIT
 
+import asyncio
+import collections
 import contextlib
+from datetime import timedelta
 import hashlib
+import os
 import pathlib
-import time
+import sqlite3
+import threading
+from urllib.parse import urlsplit
 
-from django.db import models
-from django.db.models import F
-from django.db.models.aggregates import Sum
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.aggregates import Count, Sum
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete
 from django.conf import settings
+from django.utils import timezone
+
+from kiss_cache.buffers import WriteBehind
+from kiss_cache.compression import SUFFIXES, decompress
+from kiss_cache.fanout import FANOUT
+from kiss_cache.notify import batch_deletions
+
+
+def _can_return():
+    """Return True if the database supports DELETE ... RETURNING"""
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        return sqlite3.sqlite_version_info >= (3, 35)
+    return False
+
+
+# Number of seconds elapsed between EXCLUDED.created_at and the existing row
+ELAPSED_SQL = (
+    "CAST(FLOOR(EXTRACT(EPOCH FROM "
+    "EXCLUDED.created_at - {table}.created_at)) AS integer)"
+)
 
 
 class Resource(models.Model):
-    url = models.URLField(unique=True, max_length=512)
+    # sha256 of the url, used for the lookups: the index is smaller than an
+    # index on the url and the url length is not limited
+    digest = models.BinaryField(max_length=32, unique=True, editable=False)
+    url = models.TextField()
+    # Upstream server (host and port), used to limit the concurrent downloads
+    host = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     ttl = models.IntegerField(default=60 * 60 * 24)
+    # Always equal to created_at + ttl, stored to be indexed
+    expires_at = models.DateTimeField(blank=True, null=True)
     content_length = models.BigIntegerField(blank=True, null=True)
     content_type = models.CharField(max_length=256, blank=True)
+    # Length of the contiguous prefix already written when downloading by
+    # segments: the rest of the preallocated file should not be read yet.
+    watermark = models.BigIntegerField(blank=True, null=True)
+    # Digest of the stored file, set when the file is linked to a blob
+    content_digest = models.BinaryField(max_length=32, blank=True, null=True)
+    # Compression of the file once downloaded ("" when stored as is) and size
+    # of the compressed file
+    compression = models.CharField(max_length=16, blank=True)
+    stored_length = models.BigIntegerField(blank=True, null=True)
+    # Encodings of the variants stored along the file (comma separated) and
+    # their total size
+    variants = models.CharField(max_length=32, blank=True)
+    variants_length = models.BigIntegerField(default=0)
     last_usage = models.DateTimeField(blank=True, null=True)
     usage = models.IntegerField(default=0)
+    # Used by the GDSF eviction policy
+    priority = models.FloatField(default=0)
 
     STATE_SCHEDULED, STATE_DOWNLOADING, STATE_FINISHED = range(3)
     STATE_CHOICES = (
@@ -35,6 +88,49 @@ class Resource(models.Model):
     )
     state = models.IntegerField(choices=STATE_CHOICES, default=STATE_SCHEDULED)
     status_code = models.IntegerField(default=0)
+    # Scheduling: celery queue of the fetch task ("" for the default queue),
+    # number of clients that requested the resource while it was scheduled
+    # and whether a fetch task already picked the resource
+    queue = models.CharField(max_length=64, blank=True)
+    waiting = models.IntegerField(default=0)
+    claimed = models.BooleanField(default=False)
+    # Id of the fetch task that claimed the resource and date of the claim,
+    # refreshed while downloading (see Resource.lost)
+    claimed_by = models.CharField(max_length=255, blank=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["state", "expires_at"], name="resource_expires_at_idx"
+            ),
+            models.Index(fields=["state", "priority"], name="resource_priority_idx"),
+            # Used by the resources browser (keyset pagination)
+            models.Index(
+                fields=["state", "status_code", "last_usage", "id"],
+                name="resource_last_usage_idx",
+            ),
+            models.Index(
+                fields=["state", "status_code", "usage", "id"],
+                name="resource_usage_idx",
+            ),
+            models.Index(
+                fields=["state", "status_code", "content_length", "id"],
+                name="resource_size_idx",
+            ),
+            # Used to count the downloads from each upstream server
+            models.Index(fields=["host", "state"], name="resource_host_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        self.digest = self.digest_for(self.url)
+        self.host = self.host_for(self.url)
+        created_at = self.created_at or timezone.now()
+        self.expires_at = created_at + timedelta(seconds=self.ttl)
+        super().save(*args, **kwargs)
+        if adding and self.content_length:
+            Statistic.size(self.content_length)
 
     @property
     def fullpath(self):
@@ -43,11 +139,112 @@ class Resource(models.Model):
     @property
     def path(self):
         """Compute the path of the local file"""
+        return self.encoded_path(self.compression)
+
+    def encoded_path(self, coding):
+        """Compute the path of the file encoded with coding ("" when plain)"""
         # TODO: take created_at into account
-        m = hashlib.sha256()
-        m.update(self.url.encode("utf-8"))
-        data = m.hexdigest()
-        return str(pathlib.Path(data[0:2]) / data[2:])
+        data = self.digest_for(self.url).hex()
+        return str(pathlib.Path(data[0:2]) / data[2:]) + SUFFIXES.get(coding, "")
+
+    def variants_list(self):
+        return [coding for coding in self.variants.split(",") if coding]
+
+    def encodings(self):
+        """Return the encodings available for the clients, by preference"""
+        stored = [self.compression] if self.compression else []
+        return stored + self.variants_list()
+
+    @classmethod
+    def digest_for(cls, url):
+        return hashlib.sha256(url.encode("utf-8")).digest()
+
+    @classmethod
+    def get_by_url(cls, url):
+        return cls.objects.get(digest=cls.digest_for(url))
+
+    @classmethod
+    def host_for(cls, url):
+        """Return the upstream server (host and port) of the url"""
+        try:
+            netloc = urlsplit(url).netloc
+        except ValueError:
+            return ""
+        return netloc.rpartition("@")[2].lower()[:255]
+
+    @classmethod
+    def claim(cls, queue, task_id=""):
+        """
+        Claim the scheduled resource of the queue with the most waiting
+        clients, skipping the upstream servers already running as many
+        downloads as allowed (see Host.admit).
+
+        Return None if no resource can be claimed.
+        """
+        query = cls.objects.filter(
+            state=cls.STATE_SCHEDULED, queue=queue, claimed=False
+        ).order_by("-waiting", "pk")
+        while True:
+            busy = set()
+            raced = False
+            for res in query[: settings.FETCH_CLAIM_CANDIDATES]:
+                if res.host in busy:
+                    continue
+                with transaction.atomic():
+                    if not Host.admit(res.host):
+                        busy.add(res.host)
+                        continue
+                    # Another task might have claimed it in the meantime
+                    now = timezone.now()
+                    if cls.objects.filter(pk=res.pk, claimed=False).update(
+                        claimed=True, claimed_by=task_id, claimed_at=now
+                    ):
+                        res.claimed = True
+                        res.claimed_by = task_id
+                        res.claimed_at = now
+                        return res
+                raced = True
+            if not raced:
+                return None
+
+    @classmethod
+    def reclaim(cls, task_id):
+        """
+        Take over the unfinished resource claimed by the given task, when the
+        task is delivered again because its worker died.
+
+        Return None if the task did not claim any resource.
+        """
+        if not task_id:
+            return None
+        query = cls.objects.filter(
+            claimed=True,
+            claimed_by=task_id,
+            state__in=[cls.STATE_SCHEDULED, cls.STATE_DOWNLOADING],
+        )
+        res = query.first()
+        if res is None:
+            return None
+        # Start again from scratch
+        if not query.filter(pk=res.pk).update(
+            state=cls.STATE_SCHEDULED, watermark=None, claimed_at=timezone.now()
+        ):
+            return None
+        res.refresh_from_db()
+        return res
+
+    @classmethod
+    def lost(cls):
+        """
+        Return the unfinished resources whose claim was not refreshed for
+        FETCH_CLAIM_TIMEOUT seconds: the fetch task died with its worker.
+        """
+        limit = timezone.now() - timedelta(seconds=settings.FETCH_CLAIM_TIMEOUT)
+        return cls.objects.filter(
+            Q(claimed_at__lt=limit) | Q(claimed_at=None),
+            claimed=True,
+            state__in=[cls.STATE_SCHEDULED, cls.STATE_DOWNLOADING],
+        )
 
     @classmethod
     def parse_ttl(cls, val):
@@ -72,17 +269,185 @@ class Resource(models.Model):
             raise Exception("The TTL should be positive")
         return ttl
 
+    @classmethod
+    def delete_batch(cls, query, limit):
+        """
+        Delete at most "limit" resources matching the query.
+
+        When the database supports it, the resources are deleted with a single
+        DELETE ... RETURNING statement and the post_delete signal is sent for
+        each returned row. The deletions are notified to the other processes at
+        once, the blobs are released and the size is updated with a single
+        query. Return the list of deleted resources.
+        """
+        with batch_deletions(), batch_releases():
+            return cls._delete_batch(query, limit)
+
+    @classmethod
+    def _delete_batch(cls, query, limit):
+        if not _can_return():
+            resources = list(query[:limit])
+            cls.objects.filter(pk__in=[res.pk for res in resources]).delete()
+            return resources
+
+        fields = cls._meta.concrete_fields
+        sql, params = query.values("pk")[:limit].query.sql_with_params()
+        table = connection.ops.quote_name(cls._meta.db_table)
+        pk = connection.ops.quote_name(cls._meta.pk.column)
+        columns = ", ".join(connection.ops.quote_name(f.column) for f in fields)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {table} WHERE {pk} IN ({sql}) RETURNING {columns}",
+                params,
+            )
+            rows = cursor.fetchall()
+
+        resources = cls._from_rows(fields, rows)
+        for res in resources:
+            post_delete.send(sender=cls, instance=res, using=connection.alias)
+        return resources
+
+    @classmethod
+    def _from_rows(cls, fields, rows):
+        """Build instances from raw rows, converting the values like the ORM"""
+        cols = [f.get_col(cls._meta.db_table) for f in fields]
+        converters = [
+            connection.ops.get_db_converters(col) + col.get_db_converters(connection)
+            for col in cols
+        ]
+        resources = []
+        for row in rows:
+            values = list(row)
+            for index, col in enumerate(cols):
+                for converter in converters[index]:
+                    values[index] = converter(values[index], col, connection)
+            resources.append(
+                cls.from_db(connection.alias, [f.attname for f in fields], values)
+            )
+        return resources
+
+    @classmethod
+    def get_or_create_with_ttl(cls, url, ttl):
+        """
+        Return the resource for the given url, creating it if needed.
+
+        For an existing resource, the TTL is shortened when the resulting
+        expiration date is earlier. On PostgreSQL, this is done with a single
+        INSERT ... ON CONFLICT DO UPDATE ... RETURNING statement.
+        Return a tuple (resource, created).
+        """
+        now = timezone.now()
+        # Only PostgreSQL tells whether the row was inserted or updated
+        if connection.vendor != "postgresql":
+            return cls._get_or_create_with_ttl(url, ttl, now)
+
+        res = cls(
+            url=url,
+            digest=cls.digest_for(url),
+            host=cls.host_for(url),
+            ttl=ttl,
+            created_at=now,
+        )
+        res.expires_at = now + timedelta(seconds=ttl)
+        fields = cls._meta.concrete_fields
+        inserted = [f for f in fields if not f.primary_key]
+        quote = connection.ops.quote_name
+        table = quote(cls._meta.db_table)
+        columns = ", ".join(quote(f.column) for f in inserted)
+        returning = ", ".join(f"{table}.{quote(f.column)}" for f in fields)
+        placeholders = ", ".join(["%s"] * len(inserted))
+        params = [
+            f.get_db_prep_save(getattr(res, f.attname), connection) for f in inserted
+        ]
+        shorter = f"{table}.expires_at > EXCLUDED.expires_at"
+        elapsed = ELAPSED_SQL.format(table=table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({columns}) VALUES ({placeholders}) "
+                "ON CONFLICT (digest) DO UPDATE SET "
+                f"ttl = CASE WHEN {shorter} THEN {elapsed} + EXCLUDED.ttl "
+                f"ELSE {table}.ttl END, "
+                f"expires_at = CASE WHEN {shorter} THEN EXCLUDED.expires_at "
+                f"ELSE {table}.expires_at END "
+                # xmax is 0 for the rows inserted by this statement
+                f"RETURNING {returning}, ({table}.xmax = 0)",
+                params,
+            )
+            row = cursor.fetchone()
+        res = cls._from_rows(fields, [row[:-1]])[0]
+        return (res, row[-1])
+
+    @classmethod
+    def _get_or_create_with_ttl(cls, url, ttl, now):
+        try:
+            res, created = cls.objects.get_or_create(
+                digest=cls.digest_for(url),
+                defaults={"url": url, "host": cls.host_for(url), "ttl": ttl},
+            )
+        except IntegrityError:
+            res, created = cls.get_by_url(url), False
+        if not created:
+            # Set the TTL if the resulting date is earlier
+            new_end = now + timedelta(seconds=ttl)
+            if res.created_at + timedelta(seconds=res.ttl) > new_end:
+                res.ttl = (now - res.created_at).total_seconds() + ttl
+                res.expires_at = new_end
+                cls.objects.filter(pk=res.pk).update(ttl=res.ttl, expires_at=new_end)
+        return (res, created)
+
     @classmethod
     def total_size(cls):
-        """Compute the sum of the size of all Resources"""
-        size = cls.objects.aggregate(size=Sum("content_length"))["size"]
-        return 0 if size is None else size
+        """
+        Return the sum of the size of all Resources.
+
+        The value is maintained incrementally when the content_length is set and
+        when resources are deleted. The content shared by several resources is
+        only counted once.
+        """
+        return Statistic.size()
+
+    @classmethod
+    def counts(cls):
+        """Count the resources by state and sum the usages with one query"""
+        finished = Q(state=cls.STATE_FINISHED)
+        return cls.objects.aggregate(
+            scheduled=Count("pk", filter=Q(state=cls.STATE_SCHEDULED)),
+            downloading=Count("pk", filter=Q(state=cls.STATE_DOWNLOADING)),
+            successes=Count("pk", filter=finished & Q(status_code=200)),
+            failures=Count("pk", filter=finished & ~Q(status_code=200)),
+            usage=Coalesce(Sum("usage"), 0),
+        )
 
     @classmethod
     def total_usage(cls):
         usage = cls.objects.aggregate(usage=Sum("usage"))["usage"]
         return 0 if usage is None else usage
 
+    @classmethod
+    def use(cls, pk):
+        """Increase the usage counter and set the last usage (in batches)"""
+        USAGES.add(pk, (1, timezone.now()))
+
+    @classmethod
+    def _flush_usages(cls, values):
+        """Update the usage of many resources with a single query by batch"""
+        from kiss_cache.eviction import (  # pylint: disable=import-outside-toplevel
+            get_policy,
+        )
+
+        policy = get_policy()
+        items = sorted(values.items())
+        for index in range(0, len(items), 500):
+            batch = items[index : index + 500]
+            usages = [When(pk=pk, then=Value(usage)) for (pk, (usage, _)) in batch]
+            usages = Case(*usages, output_field=models.IntegerField())
+            last_usages = [When(pk=pk, then=Value(last)) for (pk, (_, last)) in batch]
+            cls.objects.filter(pk__in=[pk for (pk, _) in batch]).update(
+                usage=F("usage") + usages,
+                last_usage=Case(*last_usages, output_field=models.DateTimeField()),
+                **policy.usage_updates(usages),
+            )
+
     @classmethod
     def is_over_quota(cls):
         """Returns True if the quota is already fully used"""
@@ -92,91 +457,188 @@ class Resource(models.Model):
 
     def progress(self):
         """Return a string with the download progress"""
-        size = 0
-        with contextlib.suppress(Exception):
-            size = (pathlib.Path(settings.DOWNLOAD_PATH) / self.path).stat().st_size
+        size = self.watermark or 0
+        if self.watermark is None:
+            with contextlib.suppress(Exception):
+                size = (pathlib.Path(settings.DOWNLOAD_PATH) / self.path).stat().st_size
         max_size = self.content_length
         with contextlib.suppress(Exception):
             return int(size / max_size * 100)
         return "??"
 
-    def open(self, mode):
-        """Open the underlying file and return the file object"""
-        return (pathlib.Path(settings.DOWNLOAD_PATH) / self.path).open(mode)
+    def open(self, mode, coding=None):
+        """
+        Open the underlying file, or the variant encoded with coding, and
+        return the file object
+        """
+        if coding is None:
+            coding = self.compression
+        path = pathlib.Path(settings.DOWNLOAD_PATH) / self.encoded_path(coding)
+        # The file might be a link to a blob: never truncate it
+        if "w" in mode:
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+        return path.open(mode)
 
-    def stream(self):
+    def stream(self, start=0, end=None):
         """
         Stream the resource while it's being downloaded.
 
+        When end is set, only the range from start to end (excluded) is
+        streamed: the data already on disk is sent without waiting.
+
         While the content is streamed, the number of bytes send is counted.
         If the resource is deleted, the function will continue to stream the
         content anyway. If the final count of byte is the same as content_length then
         the file was fully streamed correctly.
         This allow to delete resources while they are in use and in STATE_FINISHED.
+
+        The clients streaming the same resource in this process share the
+        file descriptor and a buffer of the last chunks read (see fanout).
+        Compressed resources are decompressed on the fly.
         """
-        current_length = 0
-        deleted = False
+        with contextlib.ExitStack() as stack:
+            try:
+                tail = self._tail(stack)
+            except FileNotFoundError:
+                # Replaced by the compressed file once downloaded
+                self.refresh_from_db()
+                if not self.compression:
+                    raise
+                tail = None
+            if tail is None:
+                yield from self._decompress(start, end)
+            elif end is not None:
+                yield from tail.read_range(start, end)
+            else:
+                yield from tail.read()
 
-        # The underlying file is opened. Even if the resource is removed, the
-        # file won't be removed by the OS until the file descriptor is removed.
-        with self.open("rb") as f_in:
-            while self.state != Resource.STATE_FINISHED:
-                # Send as most data as possible
-                data = f_in.read()
-                while data:
-                    current_length += len(data)
+    async def stream_async(self, start=0, end=None):
+        """
+        Same as stream(), as an async generator.
+
+        Waiting for the fetch task does not hold a thread: the file is watched
+        and the notifications are received by the event loop. The file is read
+        by the default executor.
+        """
+        with contextlib.ExitStack() as stack:
+            try:
+                tail = self._tail(stack)
+            except FileNotFoundError:
+                await sync_to_async(self.refresh_from_db)()
+                if not self.compression:
+                    raise
+                tail = None
+            if tail is None:
+                loop = asyncio.get_running_loop()
+                chunks = self._decompress(start, end)
+                while True:
+                    data = await loop.run_in_executor(None, next, chunks, None)
+                    if data is None:
+                        break
                     yield data
-                    data = f_in.read()
-
-                # Refresh from database
-                try:
-                    time.sleep(1)
-                    self.refresh_from_db()
-                except Resource.DoesNotExist:
-                    # The object was removed from the db
-                    # Continue to stream the data
-                    self.state = Resource.STATE_FINISHED
-                    deleted = True
-
-            # Send the remaining data
-            data = f_in.read()
-            while data:
-                current_length += len(data)
-                yield data
-                data = f_in.read()
-
-            # Check the length of the content
-            if self.content_length:
-                if current_length != self.content_length:
-                    if deleted:
-                        raise Exception(
-                            f"Resource was deleted and streamed length is wrong: {current_length} vs {self.content_length}"
-                        )
-                    else:
-                        raise Exception(
-                            f"Resource length streamed is wrong: {current_length} vs {self.content_length}"
-                        )
-            elif deleted:
-                raise Exception("Resource was deleted and length is unknown")
+            elif end is not None:
+                async for data in tail.read_range_async(start, end):
+                    yield data
+            else:
+                async for data in tail.read_async():
+                    yield data
+
+    def chunks(self):
+        """Generate the content of the finished resource"""
+        if self.compression:
+            yield from self._decompress()
+            return
+        with self.open("rb") as f_in:
+            yield from iter(lambda: f_in.read(settings.STREAM_CHUNK_SIZE), b"")
+
+    def _tail(self, stack):
+        """Return the tail of the file or None if the file is compressed"""
+        if self.compression:
+            return None
+        return stack.enter_context(FANOUT.acquire(self))
+
+    def _decompress(self, start=0, end=None):
+        fd = os.open(self.fullpath, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            yield from decompress(fd, start, end)
+        finally:
+            os.close(fd)
+
+    def _check_streamed_length(self, current_length, deleted):
+        if self.content_length:
+            if current_length != self.content_length:
+                if deleted:
+                    raise Exception(
+                        f"Resource was deleted and streamed length is wrong: {current_length} vs {self.content_length}"
+                    )
+                else:
+                    raise Exception(
+                        f"Resource length streamed is wrong: {current_length} vs {self.content_length}"
+                    )
+        elif deleted:
+            raise Exception("Resource was deleted and length is unknown")
 
 
 class Statistic(models.Model):
-    STAT_DOWNLOAD, STAT_UPLOAD, STAT_SUCCESSES, STAT_FAILURES, STAT_REQUESTS = range(5)
+    (
+        STAT_DOWNLOAD,
+        STAT_UPLOAD,
+        STAT_SUCCESSES,
+        STAT_FAILURES,
+        STAT_REQUESTS,
+        STAT_SIZE,
+        STAT_ARC_TARGET,
+    ) = range(7)
     STAT_CHOICES = (
         (STAT_DOWNLOAD, "Download"),
         (STAT_UPLOAD, "Upload"),
         (STAT_SUCCESSES, "Successes"),
         (STAT_FAILURES, "Failures"),
         (STAT_REQUESTS, "Requests"),
+        (STAT_SIZE, "Size"),
+        (STAT_ARC_TARGET, "ARC target"),
     )
-    stat = models.IntegerField(choices=STAT_CHOICES, primary_key=True)
+    stat = models.IntegerField(choices=STAT_CHOICES)
+    # Each process writes to its own shard to avoid contention on a single row
+    shard = models.IntegerField(default=0)
     value = models.BigIntegerField(default=0)
 
+    class Meta:
+        unique_together = ("stat", "shard")
+
     @classmethod
-    def _accessor(cls, stat, value):
+    def _accessor(cls, stat, value, buffered=True):
         if value is None:
-            return Statistic.objects.get(stat=stat).value
-        Statistic.objects.filter(stat=stat).update(value=F("value") + value)
+            value = cls.objects.filter(stat=stat).aggregate(value=Sum("value"))
+            return value["value"] or 0
+        if buffered:
+            STATISTICS.add(stat, value)
+        else:
+            cls._flush({stat: value})
+
+    @classmethod
+    def _flush(cls, values):
+        """Add the values to the shard of the current process"""
+        shard = os.getpid() % settings.STATISTIC_SHARDS
+        for stat, value in sorted(values.items()):
+            query = cls.objects.filter(stat=stat, shard=shard)
+            if query.update(value=F("value") + value):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(stat=stat, shard=shard, value=value)
+            except IntegrityError:
+                # Created by another process in the meantime
+                query.update(value=F("value") + value)
+
+    @classmethod
+    def snapshot(cls):
+        """Return the value of every statistic with one query"""
+        values = dict.fromkeys((stat for (stat, _) in cls.STAT_CHOICES), 0)
+        query = cls.objects.values_list("stat").annotate(value=Sum("value"))
+        values.update(query.order_by())
+        return values
 
     @classmethod
     def download(cls, value=None):
@@ -197,3 +659,221 @@ class Statistic(models.Model):
     @classmethod
     def requests(cls, value=None):
         return cls._accessor(Statistic.STAT_REQUESTS, value)
+
+    @classmethod
+    def size(cls, value=None):
+        # Used for the quota: always written immediately, after the batch
+        if value is not None and getattr(_RELEASES, "size", None) is not None:
+            _RELEASES.size += value
+            return None
+        return cls._accessor(Statistic.STAT_SIZE, value, buffered=False)
+
+    @classmethod
+    def arc_target(cls, value=None):
+        # Target size of the recently used resources for the ARC policy
+        return cls._accessor(Statistic.STAT_ARC_TARGET, value, buffered=False)
+
+
+class Ghost(models.Model):
+    """Recently evicted resource, used by the ARC eviction policy"""
+
+    key = models.CharField(max_length=64, unique=True)
+    frequent = models.BooleanField(default=False)
+    size = models.BigIntegerField(default=0)
+
+    @classmethod
+    def key_for(cls, url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+class Host(models.Model):
+    """
+    Adaptive limit of the concurrent downloads from an upstream server.
+
+    The limit follows an AIMD (additive increase, multiplicative decrease)
+    rule: it grows by 1/limit after each successful download and is
+    multiplied by HOST_LIMIT_DECREASE after an error or when the throughput
+    of a download drops below HOST_LIMIT_SLOWDOWN times the average.
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    limit = models.FloatField()
+    # Moving average of the throughput of a download, in bytes per second
+    throughput = models.FloatField(default=0)
+
+    @classmethod
+    def _lock(cls, name):
+        """Return the locked row, should be called in a transaction"""
+        host, _ = cls.objects.select_for_update().get_or_create(
+            name=name, defaults={"limit": settings.HOST_LIMIT_INITIAL}
+        )
+        return host
+
+    @classmethod
+    def admit(cls, name):
+        """
+        Check if one more download from this server is allowed. Should be
+        called in the transaction claiming the resource.
+        """
+        # The lock serializes the admissions for this server
+        host = cls._lock(name)
+        # The lost claims (see Resource.lost) don't hold a slot
+        limit = timezone.now() - timedelta(seconds=settings.FETCH_CLAIM_TIMEOUT)
+        running = Resource.objects.filter(
+            host=name,
+            claimed=True,
+            claimed_at__gte=limit,
+            state__in=[Resource.STATE_SCHEDULED, Resource.STATE_DOWNLOADING],
+        ).count()
+        return running < max(1, int(host.limit))
+
+    @classmethod
+    def feedback(cls, name, size=0, elapsed=0, error=False):
+        """Adapt the limit after a download"""
+        with transaction.atomic():
+            host = cls._lock(name)
+            decrease = error
+            if not error and size >= settings.HOST_LIMIT_MIN_SIZE and elapsed > 0:
+                throughput = size / elapsed
+                if host.throughput:
+                    decrease = (
+                        throughput < host.throughput * settings.HOST_LIMIT_SLOWDOWN
+                    )
+                    host.throughput = 0.8 * host.throughput + 0.2 * throughput
+                else:
+                    host.throughput = throughput
+            if decrease:
+                host.limit = host.limit * settings.HOST_LIMIT_DECREASE
+            else:
+                host.limit = host.limit + 1 / host.limit
+            host.limit = min(
+                max(host.limit, settings.HOST_LIMIT_MIN), settings.HOST_LIMIT_MAX
+            )
+            host.save(update_fields=["limit", "throughput"])
+
+
+def _link(src, dst):
+    """Atomically replace dst by a hard link to src"""
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    os.link(src, tmp)
+    try:
+        os.replace(tmp, dst)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+
+class Blob(models.Model):
+    """
+    Content of the finished resources, stored once whatever the url.
+
+    The files of the resources are hard links to the blob, "refs" counts the
+    resources linked to it. The blob is removed with the last resource.
+    """
+
+    digest = models.BinaryField(max_length=32, unique=True, editable=False)
+    size = models.BigIntegerField()
+    refs = models.IntegerField(default=0)
+
+    @classmethod
+    def path_for(cls, digest):
+        data = digest.hex()
+        return str(pathlib.Path("blobs") / data[0:2] / data[2:])
+
+    @classmethod
+    def store(cls, res, digest, size):
+        """
+        Link the file of the downloaded resource to the blob, creating it if
+        needed. Return True if the content was already stored.
+        """
+        path = pathlib.Path(settings.DOWNLOAD_PATH) / cls.path_for(digest)
+        with transaction.atomic():
+            # The lock serializes the links to this blob
+            blob, created = cls.objects.select_for_update().get_or_create(
+                digest=digest, defaults={"size": size}
+            )
+            # The resource might have been removed in the meantime
+            if not Resource.objects.filter(pk=res.pk).update(content_digest=digest):
+                transaction.set_rollback(True)
+                return False
+            if created:
+                path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+                _link(res.fullpath, path)
+            else:
+                _link(path, res.fullpath)
+            cls.objects.filter(pk=blob.pk).update(refs=F("refs") + 1)
+        if not created:
+            # The content of this resource is not stored twice
+            Statistic.size(-size)
+        return not created
+
+    @classmethod
+    def release(cls, digest):
+        """Drop a reference to the blob, removing it with the last one"""
+        digests = getattr(_RELEASES, "digests", None)
+        if digests is not None:
+            digests.append(digest)
+            return
+        cls._release([digest])
+
+    @classmethod
+    def _release(cls, digests):
+        """Drop a reference for each digest (that might be repeated)"""
+        counts = collections.Counter(digests)
+        decrements = collections.defaultdict(list)
+        with transaction.atomic():
+            query = cls.objects.select_for_update().filter(digest__in=list(counts))
+            freed = []
+            for blob in query.order_by("pk"):
+                count = counts[bytes(blob.digest)]
+                if blob.refs > count:
+                    decrements[count].append(blob.pk)
+                else:
+                    freed.append(blob)
+            for count, pks in decrements.items():
+                cls.objects.filter(pk__in=pks).update(refs=F("refs") - count)
+            if freed:
+                cls.objects.filter(pk__in=[blob.pk for blob in freed]).delete()
+        base = pathlib.Path(settings.DOWNLOAD_PATH)
+        for blob in freed:
+            with contextlib.suppress(OSError):
+                (base / cls.path_for(bytes(blob.digest))).unlink()
+        if freed:
+            Statistic.size(-sum(blob.size for blob in freed))
+
+
+# Releases accumulated by batch_releases() in the current thread
+_RELEASES = threading.local()
+
+
+@contextlib.contextmanager
+def batch_releases():
+    """
+    Release the blobs in a single transaction and update the size with a
+    single query for the resources deleted in the block.
+    """
+    if getattr(_RELEASES, "size", None) is not None:
+        yield
+        return
+    _RELEASES.size, _RELEASES.digests = 0, []
+    try:
+        yield
+    finally:
+        digests, _RELEASES.digests = _RELEASES.digests, None
+        if digests:
+            Blob._release(digests)
+        size, _RELEASES.size = _RELEASES.size, None
+        if size:
+            Statistic.size(size)
+
+
+def _merge_usages(old, new):
+    return (old[0] + new[0], max(old[1], new[1]))
+
+
+# Usages are accumulated in memory and flushed every few seconds
+USAGES = WriteBehind(Resource._flush_usages, "USAGE_FLUSH_INTERVAL", _merge_usages)
+
+# Statistics are accumulated in memory and flushed every few seconds
+STATISTICS = WriteBehind(Statistic._flush, "STATISTIC_FLUSH_INTERVAL")
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import contextlib
+import logging
+import os
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, connections
+
+from kiss_cache.metadata import METADATA
+
+LOG = logging.getLogger(__name__)
+
+CHANNEL = "kiss_cache"
+
+
+class Dispatcher:
+    """
+    Dispatch the notifications received by the listener thread to the waiting
+    threads of the current process.
+
+    A single listener (database connection or redis subscription) is used by
+    process, whatever the number of waiting clients.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conditions = {}
+        self.generations = {}
+        self.subscribers = {}
+        # Futures of the coroutines waiting for each resource
+        self.futures = {}
+        self.pid = None
+
+    def subscribe(self, pk):
+        with self.lock:
+            if pk not in self.subscribers:
+                self.conditions[pk] = threading.Condition(self.lock)
+                self.generations[pk] = (0, 0)
+                self.subscribers[pk] = 0
+                self.futures[pk] = set()
+            self.subscribers[pk] += 1
+            return self.generations[pk]
+
+    def unsubscribe(self, pk):
+        with self.lock:
+            self.subscribers[pk] -= 1
+            if not self.subscribers[pk]:
+                del self.conditions[pk]
+                del self.generations[pk]
+                del self.subscribers[pk]
+                del self.futures[pk]
+
+    def dispatch(self, pk, progress):
+        with self.lock:
+            if pk not in self.subscribers:
+                return
+            updates, states = self.generations[pk]
+            self.generations[pk] = (updates + 1, states if progress else states + 1)
+            self.conditions[pk].notify_all()
+            for loop, future in self.futures[pk]:
+                loop.call_soon_threadsafe(_set_result, future)
+
+    def wait(self, pk, generation, timeout):
+        with self.lock:
+            self.conditions[pk].wait_for(
+                lambda: self.generations[pk][0] != generation[0], timeout
+            )
+            return self.generations[pk]
+
+    async def wait_async(self, pk, generation, timeout):
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self.lock:
+            if self.generations[pk][0] != generation[0]:
+                return self.generations[pk]
+            self.futures[pk].add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                self.futures[pk].discard(waiter)
+        with self.lock:
+            return self.generations[pk]
+
+
+def _set_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+DISPATCHER = Dispatcher()
+
+
+class Subscription:
+    def __init__(self, pk):
+        self.pk = pk
+        self.generation = None
+
+    def __enter__(self):
+        if settings.NOTIFY_BACKEND != "polling":
+            start_listener()
+            self.generation = DISPATCHER.subscribe(self.pk)
+        return self
+
+    def __exit__(self, *args):
+        if self.generation is not None:
+            DISPATCHER.unsubscribe(self.pk)
+
+    def wait(self):
+        """
+        Wait for an update of the resource.
+
+        Return True when the state of the resource might have changed (hence
+        the caller should refresh it from the database) and False when only the
+        download progressed.
+        """
+        if self.generation is None:
+            time.sleep(settings.NOTIFY_POLLING_INTERVAL)
+            return True
+
+        generation = DISPATCHER.wait(self.pk, self.generation, settings.NOTIFY_TIMEOUT)
+        return self._update(generation)
+
+    async def wait_async(self):
+        """Same as wait() without blocking the event loop"""
+        if self.generation is None:
+            await asyncio.sleep(settings.NOTIFY_POLLING_INTERVAL)
+            return True
+
+        generation = await DISPATCHER.wait_async(
+            self.pk, self.generation, settings.NOTIFY_TIMEOUT
+        )
+        return self._update(generation)
+
+    def _update(self, generation):
+        state_changed = generation[1] != self.generation[1]
+        timed_out = generation[0] == self.generation[0]
+        self.generation = generation
+        return state_changed or timed_out
+
+
+def subscribe(pk):
+    """Subscribe to the notifications of the given resource"""
+    return Subscription(pk)
+
+
+def _payload(pk, progress):
+    return f"{pk}:progress" if progress else str(pk)
+
+
+def _parse(payload):
+    if isinstance(payload, bytes):
+        payload = payload.decode("utf-8")
+    pk, _, kind = payload.partition(":")
+    return (int(pk), kind == "progress")
+
+
+def _handle(payload):
+    if isinstance(payload, bytes):
+        payload = payload.decode("utf-8")
+    if payload.startswith("deleted:"):
+        METADATA.invalidate([int(pk) for pk in payload[8:].split(",")])
+    else:
+        DISPATCHER.dispatch(*_parse(payload))
+
+
+_REDIS = {}
+
+
+def _redis_client():
+    import redis  # pylint: disable=import-outside-toplevel
+
+    pid = os.getpid()
+    if pid not in _REDIS:
+        _REDIS.clear()
+        _REDIS[pid] = redis.Redis.from_url(settings.NOTIFY_REDIS_URL)
+    return _REDIS[pid]
+
+
+def notify(pk, progress=False):
+    """
+    Notify the waiting clients that the resource was updated.
+
+    Set progress to True when only the content of the file was updated.
+    """
+    try:
+        _publish(_payload(pk, progress))
+    except NotImplementedError:
+        raise
+    except Exception as exc:
+        # Waiting clients will check the database after NOTIFY_TIMEOUT anyway
+        LOG.error("Unable to notify for resource %d", pk)
+        LOG.exception(exc)
+
+
+# Deletions accumulated by batch_deletions() in the current thread
+_DELETIONS = threading.local()
+
+
+@contextlib.contextmanager
+def batch_deletions():
+    """Send the deletions notified in the block with a single notification"""
+    if getattr(_DELETIONS, "pks", None) is not None:
+        yield
+        return
+    _DELETIONS.pks = []
+    try:
+        yield
+    finally:
+        pks, _DELETIONS.pks = _DELETIONS.pks, None
+        if pks:
+            notify_deleted(pks)
+
+
+def notify_deleted(pks):
+    """Notify every process that the resources were deleted"""
+    METADATA.invalidate(pks)
+    batch = getattr(_DELETIONS, "pks", None)
+    if batch is not None:
+        batch.extend(pks)
+        return
+    try:
+        # Keep the payloads below the 8000 bytes limit of pg_notify
+        for index in range(0, len(pks), 500):
+            pks_str = ",".join(str(pk) for pk in pks[index : index + 500])
+            _publish(f"deleted:{pks_str}")
+    except NotImplementedError:
+        raise
+    except Exception as exc:
+        # Cached metadata will expire after METADATA_CACHE_TIMEOUT anyway
+        LOG.error("Unable to notify the deletion of %d resources", len(pks))
+        LOG.exception(exc)
+
+
+def _publish(payload):
+    backend = settings.NOTIFY_BACKEND
+    if backend == "polling":
+        return
+    if backend == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [CHANNEL, payload])
+    elif backend == "redis":
+        _redis_client().publish(CHANNEL, payload)
+    else:
+        raise NotImplementedError("Unknown notify backend")
+
+
+def _listen_postgresql():
+    conn = connections["default"]
+    pg_conn = conn.get_new_connection(conn.get_connection_params())
+    try:
+        pg_conn.autocommit = True
+        with pg_conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        while True:
+            if select.select([pg_conn], [], [], 60) == ([], [], []):
+                continue
+            pg_conn.poll()
+            while pg_conn.notifies:
+                _handle(pg_conn.notifies.pop(0).payload)
+    finally:
+        with contextlib.suppress(Exception):
+            pg_conn.close()
+
+
+def _listen_redis():
+    pubsub = _redis_client().pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(CHANNEL)
+        for message in pubsub.listen():
+            _handle(message["data"])
+    finally:
+        with contextlib.suppress(Exception):
+            pubsub.close()
+
+
+def _listen(backend):
+    listener = {"postgresql": _listen_postgresql, "redis": _listen_redis}[backend]
+    while True:
+        try:
+            listener()
+        except Exception as exc:
+            LOG.error("Notification listener crashed, restarting in 1 second")
+            LOG.exception(exc)
+        time.sleep(1)
+
+
+def start_listener():
+    """Start the listener thread (once per process)"""
+    pid = os.getpid()
+    if DISPATCHER.pid == pid:
+        return
+    with DISPATCHER.lock:
+        if DISPATCHER.pid == pid:
+            return
+        # The thread does not survive a fork: start a new one in each process
+        thread = threading.Thread(
+            target=_listen,
+            args=(settings.NOTIFY_BACKEND,),
+            name="kiss-cache-notify",
+            daemon=True,
+        )
+        thread.start()
+        DISPATCHER.pid = pid
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import base64
+import datetime
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class Page:
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class KeysetPaginator:
+    """
+    Paginate a query by seeking after (or before) the last row of the current
+    page instead of using OFFSET, so each page costs the same, however deep.
+
+    The query is ordered by the given column then by primary key. NULL values
+    are sorted last in ascending order (like PostgreSQL indexes) so that an
+    index on (..., column, id) can be used in both directions.
+    """
+
+    def __init__(self, query, order, per_page):
+        self.query = query
+        self.descending = order.startswith("-")
+        self.column = order.lstrip("-")
+        self.field = query.model._meta.get_field(self.column)
+        self.per_page = per_page
+
+    def _order_by(self, descending):
+        if descending:
+            return (F(self.column).desc(nulls_first=True), F("pk").desc())
+        return (F(self.column).asc(nulls_last=True), F("pk").asc())
+
+    def _seek(self, value, pk, descending):
+        """Rows strictly after (value, pk) in the given order"""
+        col = self.column
+        if descending:
+            if value is None:
+                return Q(**{f"{col}__isnull": True, "pk__lt": pk}) | Q(
+                    **{f"{col}__isnull": False}
+                )
+            return Q(**{f"{col}__lt": value}) | Q(**{col: value, "pk__lt": pk})
+        if value is None:
+            return Q(**{f"{col}__isnull": True, "pk__gt": pk})
+        return (
+            Q(**{f"{col}__gt": value})
+            | Q(**{col: value, "pk__gt": pk})
+            | Q(**{f"{col}__isnull": True})
+        )
+
+    def _encode(self, obj):
+        value = getattr(obj, self.column)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        data = json.dumps([value, obj.pk]).encode("utf-8")
+        return base64.urlsafe_b64encode(data).decode("ascii")
+
+    def _decode(self, cursor):
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            if value is not None:
+                value = self.field.to_python(value)
+            return (value, int(pk))
+        except (TypeError, ValueError, ValidationError) as exc:
+            raise InvalidCursor() from exc
+
+    def page(self, after=None, before=None):
+        """
+        Return the page after (or before) the given cursor.
+
+        Raise InvalidCursor if the cursor cannot be decoded.
+        """
+        cursor = after or before
+        backward = before is not None and after is None
+        # Walking backward: reverse the order and the results
+        descending = self.descending != backward
+        query = self.query.order_by(*self._order_by(descending))
+        if cursor is not None:
+            query = query.filter(self._seek(*self._decode(cursor), descending))
+
+        objects = list(query[: self.per_page + 1])
+        more = len(objects) > self.per_page
+        objects = objects[: self.per_page]
+        if backward:
+            objects.reverse()
+
+        first = self._encode(objects[0]) if objects else None
+        last = self._encode(objects[-1]) if objects else None
+        if backward:
+            return Page(objects, last if cursor else None, first if more else None)
+        return Page(objects, last if more else None, first if cursor else None)
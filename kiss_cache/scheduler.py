@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import logging
+import requests
+
+from django.conf import settings
+
+from kiss_cache.__about__ import __version__
+from kiss_cache.models import Resource
+from kiss_cache.tasks import fetch
+
+LOG = logging.getLogger(__name__)
+
+
+def probe(url):
+    """Return the size announced by the upstream server or None"""
+    try:
+        req = requests.head(
+            url,
+            allow_redirects=True,
+            headers={"Accept-Encoding": "", "User-Agent": f"KissCache/{__version__}"},
+            timeout=settings.FETCH_PROBE_TIMEOUT,
+        )
+        req.close()
+        if req.status_code != 200:
+            return None
+        return int(req.headers["Content-Length"])
+    except (KeyError, ValueError, requests.RequestException) as exc:
+        LOG.debug("Unable to probe '%s': %s", url, exc)
+        return None
+
+
+def queue_for(url):
+    """Return the queue of the fetch task, "" for the default queue"""
+    if not settings.FETCH_LARGE_QUEUE:
+        return ""
+    size = probe(url)
+    if size is not None and size >= settings.FETCH_LARGE_SIZE:
+        return settings.FETCH_LARGE_QUEUE
+    return ""
+
+
+def schedule(res):
+    """
+    Queue a fetch task for the resource.
+
+    Each task fetches the scheduled resource of its queue with the most
+    waiting clients (see Resource.claim), not necessarily this one.
+    """
+    queue = queue_for(res.url)
+    if queue:
+        Resource.objects.filter(pk=res.pk).update(queue=queue)
+        fetch.apply_async((res.url,), queue=queue)
+    else:
+        fetch.delay(res.url)
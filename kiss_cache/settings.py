@@ -19,11 +19,82 @@ DOWNLOAD_RETRY = 15
 # 0.2s, 0.4s, …] between retries.
 DOWNLOAD_BACKOFF_FACTOR = 0.1
 
+# Download engine used by the fetch task:
+# * "threads": download in the celery worker process, one resource at a time
+# * "asyncio": hand the download over to an event loop running up to
+#   FETCH_ASYNC_CONCURRENCY downloads in each worker process (requires aiohttp)
+#   The task is acknowledged once handed over, so CELERY_TASK_ACKS_LATE does
+#   not protect the downloads: the ones lost with a worker are scheduled again
+#   after FETCH_CLAIM_TIMEOUT. A warm shutdown waits for the downloads.
+FETCH_ENGINE = "threads"
+FETCH_ASYNC_CONCURRENCY = 200
+
+# Route the fetch tasks of the large resources (as announced by a HEAD
+# request) to FETCH_LARGE_QUEUE so they can't starve the small ones. A celery
+# worker should consume this queue. Set to "" to use a single queue.
+FETCH_LARGE_QUEUE = ""
+FETCH_LARGE_SIZE = 512 * 1024 * 1024
+# Timeout (in seconds) of the HEAD request
+FETCH_PROBE_TIMEOUT = 5
+
+# Limit the concurrent downloads from each upstream server, across every
+# worker. The limit (see kiss_cache.models.Host) grows by 1/limit after each
+# successful download and is multiplied by HOST_LIMIT_DECREASE after an error
+# (429, 502, 503 or 504) or when the throughput of a download drops below
+# HOST_LIMIT_SLOWDOWN times the average throughput.
+HOST_LIMIT_INITIAL = 4
+HOST_LIMIT_MIN = 1
+HOST_LIMIT_MAX = 32
+HOST_LIMIT_DECREASE = 0.5
+HOST_LIMIT_SLOWDOWN = 0.5
+# Smaller downloads are not used to measure the throughput
+HOST_LIMIT_MIN_SIZE = 1024 * 1024
+# Delay (in seconds) before trying again when every server is busy
+HOST_LIMIT_RETRY_DELAY = 5
+# Number of scheduled resources considered by a fetch task
+FETCH_CLAIM_CANDIDATES = 100
+# The fetch tasks refresh their claim every FETCH_CLAIM_HEARTBEAT seconds while
+# downloading. A claim not refreshed for FETCH_CLAIM_TIMEOUT seconds is lost
+# (the worker died): the expire task schedules the resource again.
+FETCH_CLAIM_HEARTBEAT = 60
+FETCH_CLAIM_TIMEOUT = 3 * DOWNLOAD_TIMEOUT
+
+# Connections to the upstream servers are kept alive and shared by the fetch
+# tasks of each worker process.
+# Number of upstream servers with a connection pool
+DOWNLOAD_POOL_HOSTS = 32
+# Number of connections kept alive for each server and overrides by hostname
+# like {"images.example.com": 20}
+DOWNLOAD_POOL_SIZE = 10
+DOWNLOAD_POOL_SIZES = {}
+# Cache the address of the upstream servers (set the size to 0 to disable)
+DOWNLOAD_DNS_CACHE_SIZE = 256
+DOWNLOAD_DNS_CACHE_TIMEOUT = 60
+
 # base directory
 DOWNLOAD_PATH = "/var/cache/kiss-cache"
 
-# Download 1kB by 1kB
-DOWNLOAD_CHUNK_SIZE = 1024
+# Bounds of the download buffer. The buffer size adapts to the throughput so
+# that one read lasts about NOTIFY_PROGRESS_INTERVAL.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_CHUNK_MAX_SIZE = 8 * 1024 * 1024
+
+# Download large resources with concurrent range requests when the upstream
+# server supports them. Set DOWNLOAD_SEGMENTS to 1 to disable.
+DOWNLOAD_SEGMENTS = 4
+DOWNLOAD_SEGMENTS_MIN_SIZE = 256 * 1024 * 1024
+
+# Content codings accepted from the upstream servers: any of "gzip", "br"
+# (requires brotli) and "zstd" (requires zstandard). The content is decoded
+# while downloading, hence the size is only known once downloaded. The
+# encoded resources are never downloaded by segments.
+DOWNLOAD_ENCODINGS = []
+
+# Size of the chunks sent to the clients while streaming
+STREAM_CHUNK_SIZE = 64 * 1024
+# Size of the buffer shared, in each process, by the clients streaming the same
+# resource. Clients lagging behind the buffer read the file directly.
+STREAM_FANOUT_BUFFER_SIZE = 16 * 1024 * 1024
 
 # By default, keep the resources for 10 days
 DEFAULT_TTL = "10d"
@@ -48,17 +119,111 @@ CELERY_BEAT_MAX_LOOP_INTERVAL = 30
 # By default the instance is fully open
 ALLOWED_NETWORKS = []
 
+# Expired resources are deleted by batches of N resources
+RESOURCE_EXPIRE_BATCH_SIZE = 1000
+# Maximum duration (in seconds) of the expire task, that runs every minute
+RESOURCE_EXPIRE_TIME_BUDGET = 45
+
 # Default quota of 5G
 RESOURCE_QUOTA = 5 * 1024 * 1024 * 1024
 # Automatically remove old resources when the quota usage is above this value
 # (percent)
 RESOURCE_QUOTA_AUTO_CLEAN = 75
+# When cleaning, remove resources until the quota usage is below this value
+# (percent)
+RESOURCE_QUOTA_AUTO_CLEAN_LOW = 60
 # Only consider resources that where not used for N seconds
 RESOURCE_QUOTA_AUTO_CLEAN_DELAY = 3600
 
+# Eviction policy used when the quota usage is above RESOURCE_QUOTA_AUTO_CLEAN:
+# * "lru": least recently used
+# * "lfu": least frequently used
+# * "gdsf": greedy-dual-size-frequency, keep small and often used resources
+# * "arc": adaptive replacement cache
+RESOURCE_EVICTION_POLICY = "lru"
+# Number of evicted resources remembered by the "arc" policy
+RESOURCE_EVICTION_GHOSTS = 10000
+
 # Partial download retries
 RESOURCE_PARTIAL_DOWLOAD_RETRIES = 10
 
+# Store identical content only once, whatever the url. The files of the
+# resources are hard links to a blob named after the sha256 of the content
+# (in DOWNLOAD_PATH/blobs).
+RESOURCE_DEDUPLICATION = True
+
+# Compress the resources once downloaded: "" (disabled) or "zstd" (requires
+# zstandard). The clients accepting the encoding receive the compressed file,
+# the content is decompressed on the fly for the others.
+RESOURCE_COMPRESSION = ""
+# Content types worth compressing (prefixes)
+RESOURCE_COMPRESSION_TYPES = [
+    "application/json",
+    "application/octet-stream",
+    "application/x-cpio",
+    "application/x-tar",
+    "application/xml",
+    "text/",
+]
+RESOURCE_COMPRESSION_LEVEL = 3
+# The file is compressed by independent frames of N bytes, so the
+# decompression can start at any frame.
+RESOURCE_COMPRESSION_FRAME_SIZE = 4 * 1024 * 1024
+# Keep the file uncompressed if the first frame is not smaller than this ratio
+RESOURCE_COMPRESSION_MAX_RATIO = 0.9
+
+# Encoded variants of the compressible resources, created in the background
+# once downloaded. The clients receive the variant matching their
+# Accept-Encoding, by order of preference: "zstd" (requires zstandard), "br"
+# (requires brotli) and "gzip".
+RESOURCE_VARIANTS = []
+RESOURCE_VARIANTS_GZIP_LEVEL = 6
+RESOURCE_VARIANTS_BROTLI_QUALITY = 5
+
+# Statistics are accumulated in memory and written to the database every N
+# seconds. Set to 0 to write them immediately.
+STATISTIC_FLUSH_INTERVAL = 5
+# Number of rows used for each statistic. Each process updates its own row to
+# limit the contention.
+STATISTIC_SHARDS = 8
+
+# Resource usage counters and last usage dates are accumulated in memory and
+# written to the database every N seconds. Set to 0 to write them immediately.
+USAGE_FLUSH_INTERVAL = 5
+
+# How to wake up the clients waiting for a resource to be scheduled or
+# downloaded:
+# * "polling": check the database every NOTIFY_POLLING_INTERVAL seconds
+# * "postgresql": use LISTEN/NOTIFY on the default database
+# * "redis": use redis pub/sub on NOTIFY_REDIS_URL
+NOTIFY_BACKEND = "polling"
+NOTIFY_POLLING_INTERVAL = 1
+NOTIFY_REDIS_URL = "redis://localhost:6379/0"
+# With "postgresql" and "redis" backends, check the database anyway after this
+# delay (in seconds) in case a notification was lost
+NOTIFY_TIMEOUT = 10
+# Minimal delay (in seconds) between two progress notifications
+NOTIFY_PROGRESS_INTERVAL = 0.2
+
+# Number of finished resources cached by each process, answering the requests
+# without any database query. Set to 0 to disable the cache. The cache is only
+# used with the "postgresql" and "redis" backends, that notify the deletions to
+# every process.
+METADATA_CACHE_SIZE = 10000
+# Drop the cached resources after this delay (in seconds) in case a deletion
+# notification was lost.
+METADATA_CACHE_TIMEOUT = 60
+
+# Cache the resource counts and statistics displayed by the status and
+# statistics pages for this delay (in seconds). The cache is shared between
+# the processes when a shared django cache backend is configured.
+SNAPSHOT_CACHE_TIMEOUT = 5
+
+# Serve api/v1/fetch/ with an async view. Only enable it when running under an
+# ASGI server (uvicorn, daphne, ...): waiting and streaming clients will then
+# cost coroutines instead of threads.
+ASYNC_API = False
+
 # Use the apache2 xsendfile module
 USE_XSENDFILE = True
 # xsendfile backend ("nginx" or "apache2")
@@ -14,12 +14,27 @@ from django.conf import settings
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
 
-from kiss_cache.models import Resource
+from kiss_cache.models import Blob, Resource, Statistic
+from kiss_cache.notify import notify_deleted
 
 
 @receiver(post_delete, sender=Resource)
 def resource_post_delete(sender, **kwargs):
     resource = kwargs["instance"]
+    # Drop the resource from the cache of every process
+    notify_deleted([resource.pk])
     base = pathlib.Path(settings.DOWNLOAD_PATH)
     with contextlib.suppress(Exception):
         (base / resource.path).unlink()
+    for coding in resource.variants_list():
+        with contextlib.suppress(Exception):
+            (base / resource.encoded_path(coding)).unlink()
+    if resource.variants_length:
+        Statistic.size(-resource.variants_length)
+    # The content shared with other resources is still on disk
+    if resource.content_digest is not None:
+        Blob.release(bytes(resource.content_digest))
+    elif resource.stored_length is not None:
+        Statistic.size(-resource.stored_length)
+    elif resource.content_length:
+        Statistic.size(-resource.content_length)
@@ -7,42 +7,515 @@
 #
 # SPDX-License-Identifier: MIT
 
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 import contextlib
 from datetime import timedelta
+import hashlib
 import logging
 import math
+import os
 import pathlib
 import requests
+from requests.packages.urllib3.exceptions import (
+    ProtocolError,
+    ReadTimeoutError,
+    SSLError,
+)
+import threading
 import time
 
 from celery import shared_task
 from celery.utils.log import get_task_logger
 
 from django.conf import settings
+from django.db.models import F
 from django.template.defaultfilters import filesizeformat
 from django.utils import timezone
 
+from kiss_cache import compression
 from kiss_cache.__about__ import __version__
-from kiss_cache.models import Resource, Statistic
+from kiss_cache.eviction import get_policy
+from kiss_cache.models import Blob, Host, Resource, Statistic
+from kiss_cache.notify import notify
 from kiss_cache.utils import requests_retry
 
-
 # Setup the loggers
 logging.getLogger("requests").setLevel(logging.WARNING)
 LOG = get_task_logger(__name__)
 
 
+def _high_watermark():
+    return settings.RESOURCE_QUOTA * settings.RESOURCE_QUOTA_AUTO_CLEAN / 100
+
+
+def _update_size(old, new):
+    """Update the total size and start cleaning above the high watermark"""
+    delta = (new or 0) - (old or 0)
+    if not delta:
+        return
+    Statistic.size(delta)
+    if delta > 0 and settings.RESOURCE_QUOTA > 0:
+        if Resource.total_size() > _high_watermark():
+            evict.delay()
+
+
+def _log_progress(size, content_length, last_logged_value):
+    """Log the progress every 5% (or 25MB), return the last logged value"""
+    if content_length:
+        percent = math.floor(size / float(content_length) * 100)
+        if percent >= last_logged_value + 5:
+            LOG.info("progress %3d%% (%dMB)", percent, int(size / (1024 * 1024)))
+            return percent
+    elif size >= last_logged_value + 25 * 1024 * 1024:
+        LOG.info("progress %dMB", int(size / (1024 * 1024)))
+        return size
+    return last_logged_value
+
+
+def _log_speed(size, start):
+    end = time.time()
+    speed = "??"
+    with contextlib.suppress(ZeroDivisionError):
+        speed = "%0.2f" % round(size / (1024 * 1024 * (end - start)), 2)
+    LOG.info(
+        "%dMB downloaded in %0.2fs (%sMB/s)",
+        size / (1024 * 1024),
+        round(end - start, 2),
+        speed,
+    )
+
+
+def _iter_raw(req):
+    """
+    Read the body into a reusable buffer, yielding memoryviews of it.
+
+    Each chunk should be consumed before asking for the next one. The size
+    of the buffer adapts to the throughput: it's doubled when a read takes
+    less than a quarter of NOTIFY_PROGRESS_INTERVAL and halved when it takes
+    longer than NOTIFY_PROGRESS_INTERVAL.
+    """
+    min_size = settings.DOWNLOAD_CHUNK_SIZE
+    max_size = max(min_size, settings.DOWNLOAD_CHUNK_MAX_SIZE)
+    interval = settings.NOTIFY_PROGRESS_INTERVAL
+    size = min_size
+    view = memoryview(bytearray(size))
+    while True:
+        start = time.monotonic()
+        # Same translation of the urllib3 errors as requests.iter_content
+        try:
+            length = req.raw.readinto(view[:size])
+        except ProtocolError as exc:
+            raise requests.exceptions.ChunkedEncodingError(exc)
+        except ReadTimeoutError as exc:
+            raise requests.exceptions.ConnectionError(exc)
+        except SSLError as exc:
+            raise requests.exceptions.SSLError(exc)
+        if not length:
+            return
+        yield view[:length]
+
+        elapsed = time.monotonic() - start
+        if length == size and elapsed < interval / 4 and size < max_size:
+            size = min(size * 2, max_size)
+            if size > len(view):
+                view = memoryview(bytearray(size))
+        elif elapsed > interval and size > min_size:
+            size = max(size // 2, min_size)
+
+
+def _can_segment(req, content_length):
+    """Check if the resource can be downloaded by segments"""
+    if settings.DOWNLOAD_SEGMENTS <= 1 or not content_length:
+        return False
+    if req.headers.get("Accept-Ranges") != "bytes":
+        return False
+    return content_length >= settings.DOWNLOAD_SEGMENTS_MIN_SIZE
+
+
+def _preallocate(fd, length):
+    try:
+        os.posix_fallocate(fd, 0, length)
+    except (AttributeError, OSError):
+        # Not supported by the OS or the filesystem
+        os.ftruncate(fd, length)
+
+
+def _fetch_segment(url, fd, start, end, progress, index, stop):
+    """
+    Download the bytes [start, end[ at the same offset in the file.
+
+    progress[index] is the number of bytes written from start.
+    """
+    session = requests_retry()
+    offset = start
+    retries = 0
+    while offset < end and not stop.is_set():
+        try:
+            req = session.get(
+                url,
+                stream=True,
+                headers={
+                    "Accept-Encoding": "",
+                    "Range": f"bytes={offset}-{end - 1}",
+                    "User-Agent": f"KissCache/{__version__}",
+                },
+                timeout=settings.DOWNLOAD_TIMEOUT,
+            )
+            if req.status_code != 206:
+                req.close()
+                raise Exception(f"Range request returned {req.status_code}")
+            try:
+                for data in _iter_raw(req):
+                    data = data[: end - offset]
+                    offset += os.pwrite(fd, data, offset)
+                    progress[index] = offset - start
+                    if offset >= end or stop.is_set():
+                        break
+            finally:
+                req.close()
+        except requests.RequestException as exc:
+            LOG.error("Unable to fetch segment %d of '%s'", index, url)
+            LOG.exception(exc)
+
+        if offset < end and not stop.is_set():
+            retries += 1
+            if retries >= settings.RESOURCE_PARTIAL_DOWLOAD_RETRIES:
+                raise Exception(f"Unable to fetch segment {index}")
+            LOG.warning(
+                "Retrying segment %d (%d/%d) after 5 seconds",
+                index,
+                retries,
+                settings.RESOURCE_PARTIAL_DOWLOAD_RETRIES,
+            )
+            time.sleep(5)
+
+
+def _watermark(bounds, progress):
+    """Length of the contiguous prefix already downloaded"""
+    watermark = 0
+    for index, done in enumerate(progress):
+        watermark = bounds[index] + done
+        if watermark < bounds[index + 1]:
+            break
+    return watermark
+
+
+def _fetch_segments(res):
+    """
+    Download the resource with concurrent range requests into a preallocated
+    file. Only the contiguous prefix (the watermark) is advertised to the
+    streaming clients.
+
+    Return the number of bytes downloaded.
+    """
+    count = settings.DOWNLOAD_SEGMENTS
+    length = res.content_length
+    bounds = [length * index // count for index in range(count + 1)]
+    progress = [0] * count
+    stop = threading.Event()
+    LOG.info("Downloading %d segments", count)
+
+    start = time.time()
+    with res.open(mode="wb") as f_out:
+        fd = f_out.fileno()
+        _preallocate(fd, length)
+        # Informe the caller about the current state
+        Resource.objects.filter(pk=res.pk).update(
+            state=Resource.STATE_DOWNLOADING, watermark=0, claimed_at=timezone.now()
+        )
+        notify(res.pk)
+
+        watermark = 0
+        last_heartbeat = time.monotonic()
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            futures = [
+                executor.submit(
+                    _fetch_segment,
+                    res.url,
+                    fd,
+                    bounds[index],
+                    bounds[index + 1],
+                    progress,
+                    index,
+                    stop,
+                )
+                for index in range(count)
+            ]
+            try:
+                while True:
+                    done, pending = wait(
+                        futures,
+                        timeout=settings.NOTIFY_PROGRESS_INTERVAL,
+                        return_when=FIRST_EXCEPTION,
+                    )
+                    # Wake up the streaming clients
+                    current = _watermark(bounds, progress)
+                    if current != watermark:
+                        watermark = current
+                        Resource.objects.filter(pk=res.pk).update(watermark=watermark)
+                        notify(res.pk, progress=True)
+                    now = time.monotonic()
+                    if now - last_heartbeat >= settings.FETCH_CLAIM_HEARTBEAT:
+                        last_heartbeat = now
+                        _heartbeat(res)
+                    if not pending or any(f.exception() for f in done):
+                        break
+            finally:
+                stop.set()
+            for future in futures:
+                future.result()
+
+    size = sum(progress)
+    _log_speed(size, start)
+    return size
+
+
+# Status codes meaning that the upstream server is overloaded
+HOST_ERRORS = [429, 502, 503, 504]
+
+
+def _failed(res, status_code):
+    """Mark the download as failed"""
+    Resource.objects.filter(pk=res.pk).update(
+        state=Resource.STATE_FINISHED, status_code=status_code
+    )
+    notify(res.pk)
+    Statistic.failures(1)
+    Host.feedback(res.host, error=status_code in HOST_ERRORS)
+
+
+def _hash_file(res):
+    checksum = hashlib.sha256()
+    with res.open(mode="rb") as f_in:
+        for data in iter(lambda: f_in.read(settings.DOWNLOAD_CHUNK_MAX_SIZE), b""):
+            checksum.update(data)
+    return checksum
+
+
+def _checksum(res):
+    """
+    Return the sha256 to update while downloading or None when the digest of
+    the content is not needed: without deduplication or when the file will be
+    compressed (the digest of the compressed file is used).
+    """
+    if not settings.RESOURCE_DEDUPLICATION:
+        return None
+    if settings.RESOURCE_COMPRESSION and compression.is_compressible(res.content_type):
+        return None
+    return hashlib.sha256()
+
+
+def _deduplicate(res, size, checksum):
+    """Link the file to the blob with the same content"""
+    try:
+        if checksum is None:
+            checksum = _hash_file(res)
+        if Blob.store(res, checksum.digest(), size):
+            LOG.info("'%s' is already stored, linking to it", res.url)
+    except OSError as exc:
+        # The file is kept as is
+        LOG.error("Unable to deduplicate '%s'", res.url)
+        LOG.exception(exc)
+
+
+def _compress(res, size):
+    """
+    Compress the downloaded file if worth it. Return the sha256 and the size
+    of the compressed file or None.
+    """
+    if not compression.is_compressible(res.content_type):
+        return None
+    src = res.fullpath
+    res.compression = settings.RESOURCE_COMPRESSION
+    dst = res.fullpath
+    try:
+        checksum = compression.compress(src, dst)
+        if checksum is not None:
+            stored = os.stat(dst).st_size
+            # The resource might have been removed in the meantime
+            if Resource.objects.filter(pk=res.pk).update(
+                compression=res.compression, stored_length=stored
+            ):
+                LOG.info("Compressed to %s", filesizeformat(stored))
+                res.stored_length = stored
+                Statistic.size(stored - size)
+                return (checksum, stored)
+    except (OSError, compression.zstandard.ZstdError) as exc:
+        LOG.error("Unable to compress '%s'", res.url)
+        LOG.exception(exc)
+    res.compression = ""
+    with contextlib.suppress(OSError):
+        os.unlink(dst)
+    return None
+
+
+def _fetched(res, size, elapsed, checksum=None):
+    """
+    Check the size, update the statistics and mark the download as done.
+    checksum is the sha256 of the content, when computed while downloading.
+    """
+    # Compressing and hashing large files takes a while
+    _heartbeat(res)
+    error = False
+    # Check or save the size
+    if res.content_length:
+        if res.content_length != size:
+            error = True
+            LOG.error(
+                "The total size (%d) is not equal to the Content-Length (%d)",
+                size,
+                res.content_length,
+            )
+            # Set the status_code to 502 so it will be removed soon
+            Resource.objects.filter(pk=res.pk).update(
+                state=Resource.STATE_FINISHED, status_code=504
+            )
+            Statistic.download(size)
+            Statistic.failures(1)
+    else:
+        Resource.objects.filter(pk=res.pk).update(content_length=size)
+        _update_size(None, size)
+
+    # Update the statistics
+    Statistic.download(size)
+    Statistic.successes(1)
+
+    plain = res.fullpath
+    if not error:
+        stored = size
+        if settings.RESOURCE_COMPRESSION and size:
+            compressed = _compress(res, size)
+            if compressed is not None:
+                checksum, stored = compressed
+        if settings.RESOURCE_DEDUPLICATION:
+            _deduplicate(res, stored, checksum)
+
+    # Mark the task as done
+    Resource.objects.filter(pk=res.pk).update(
+        state=Resource.STATE_FINISHED, watermark=None
+    )
+    notify(res.pk)
+    # The streaming clients already opened the uncompressed file
+    if res.compression:
+        with contextlib.suppress(OSError):
+            os.unlink(plain)
+    get_policy().fetched(res.pk)
+    Host.feedback(res.host, size, elapsed, error)
+
+    # Encode the variants in the background
+    if (
+        not error
+        and size
+        and settings.RESOURCE_VARIANTS
+        and compression.is_compressible(res.content_type)
+    ):
+        encode.delay(res.url)
+
+
+def _claim(url, task_id="", redelivered=False):
+    """
+    Claim the resource to fetch: the scheduled resource with the most waiting
+    clients in the queue of the url.
+
+    As each task fetches one resource, every resource will be fetched. A task
+    delivered again (its worker died) fetches the resource it claimed again.
+    """
+    if redelivered:
+        claimed = Resource.reclaim(task_id)
+        if claimed is not None:
+            LOG.warning("Fetching '%s' again (task redelivered)", claimed.url)
+            return claimed
+
+    # Grab the object from the database
+    try:
+        res = Resource.get_by_url(url)
+    except Resource.DoesNotExist:
+        LOG.error("Resource db object does not exist for '%s'", url)
+        return None
+    claimed = Resource.claim(res.queue, task_id)
+    if claimed is None:
+        query = Resource.objects.filter(
+            state=Resource.STATE_SCHEDULED, queue=res.queue, claimed=False
+        )
+        if query.exists():
+            # Every upstream server is busy: try again later
+            LOG.info(
+                "Upstream servers are busy, retrying in %ds",
+                settings.HOST_LIMIT_RETRY_DELAY,
+            )
+            fetch.apply_async(
+                (url,),
+                queue=res.queue or None,
+                countdown=settings.HOST_LIMIT_RETRY_DELAY,
+            )
+        else:
+            LOG.info("No resource left to fetch")
+    elif claimed.pk != res.pk:
+        LOG.info(
+            "Fetching '%s' first (%d waiting clients)", claimed.url, claimed.waiting
+        )
+    return claimed
+
+
+def _heartbeat(res):
+    """Refresh the claim of the resource (see Resource.lost)"""
+    Resource.objects.filter(pk=res.pk, claimed=True).update(claimed_at=timezone.now())
+
+
+def _accept_encoding():
+    """Accept-Encoding header sent to the upstream servers"""
+    return ", ".join(settings.DOWNLOAD_ENCODINGS)
+
+
+def _decoder_for(headers):
+    """Return the decoder for the content coding of the response or None"""
+    coding = headers.get("Content-Encoding", "").strip().lower()
+    if coding in settings.DOWNLOAD_ENCODINGS:
+        return compression.Decoder(coding)
+    return None
+
+
+def _encoded_length(headers):
+    content_length = headers.get("Content-Length")
+    return None if content_length is None else int(content_length)
+
+
+def _store_headers(res, headers, encoded=False):
+    """
+    Store Content-Length and Content-Type. The length of an encoded content is
+    only known once decoded.
+    """
+    content_length = None if encoded else _encoded_length(headers)
+    Resource.objects.filter(pk=res.pk).update(
+        content_length=content_length,
+        content_type=headers.get("Content-Type", ""),
+    )
+    _update_size(res.content_length, content_length)
+    res.refresh_from_db()
+
+
 @shared_task(ignore_result=True)
 def fetch(url):
+    compression.check()
+    if settings.FETCH_ENGINE == "asyncio":
+        from kiss_cache.engine import ENGINE  # pylint: disable=import-outside-toplevel
+
+        ENGINE.submit(url)
+        return
+    if settings.FETCH_ENGINE != "threads":
+        raise NotImplementedError("Unknown fetch engine")
+
     # TODO: should the resource be removed from the db if an exception is
     # raised (instead of setting a 50x status_code?)
     LOG.info("Fetching '%s'", url)
-    # Grab the object from the database
-    try:
-        res = Resource.objects.get(url=url)
-    except Resource.DoesNotExist:
-        LOG.error("Resource db object does not exist for '%s'", url)
+    request = fetch.request
+    res = _claim(
+        url, request.id or "", (request.delivery_info or {}).get("redelivered")
+    )
+    if res is None:
         return
+    url = res.url
+    started = time.monotonic()
 
     # Create the directory
     try:
@@ -51,14 +524,16 @@ def fetch(url):
     except OSError as exc:
         LOG.error("Unable to create the directory '%s'", str((base / res.path)))
         LOG.exception(exc)
-        Resource.objects.filter(pk=res.pk).update(
-            state=Resource.STATE_FINISHED, status_code=500
-        )
-        Statistic.failures(1)
+        _failed(res, 500)
         return
 
-    # Keep track of the total amount of data
+    # Keep track of the total amount of data, and of the data received when
+    # the content is encoded
     size = 0
+    received = 0
+    decoder = None
+    encoded_length = None
+    checksum = None
     retries = 0
     max_retries = settings.RESOURCE_PARTIAL_DOWLOAD_RETRIES
     # TODO: make this idempotent to allow for task restart
@@ -66,16 +541,18 @@ def fetch(url):
         while retries < max_retries:
             # Download the resource
             # * stream back the result
-            # * only accept plain content (not gzipped) so Content-Length is known
+            # * only accept the DOWNLOAD_ENCODINGS, so Content-Length is known
+            #   for the plain content
             # * with a timeout
             try:
-                # Use a range header if this is a retry
+                # Use a range header if this is a retry. The range of an
+                # encoded content is relative to the encoded data.
                 headers = {
-                    "Accept-Encoding": "",
+                    "Accept-Encoding": _accept_encoding(),
                     "User-Agent": f"KissCache/{__version__}",
                 }
-                if size:
-                    headers["Range"] = f"bytes={size}-"
+                if received:
+                    headers["Range"] = f"bytes={received}-"
 
                 req = requests_retry().get(
                     res.url,
@@ -86,103 +563,117 @@ def fetch(url):
             except requests.RequestException as exc:
                 LOG.error("Unable to connect to '%s'", url)
                 LOG.exception(exc)
-                Resource.objects.filter(pk=res.pk).update(
-                    state=Resource.STATE_FINISHED, status_code=502
-                )
-                Statistic.failures(1)
+                _failed(res, 502)
                 return
 
             # When retrying range requests should work, hence status_code is 206
-            if retries > 0 and size:
+            if retries > 0 and received:
                 if req.status_code != 206:
                     LOG.error("Unable to issue range requests when retrying")
                     req.status_code = 502
+                elif (
+                    decoder is not None
+                    and decoder.coding
+                    != req.headers.get("Content-Encoding", "").strip().lower()
+                ):
+                    LOG.error("The content encoding changed when retrying")
+                    req.status_code = 502
                 else:
                     req.status_code = 200
 
             # Update the status code
             if req.status_code != 200:
-                Resource.objects.filter(pk=res.pk).update(
-                    status_code=req.status_code, state=Resource.STATE_FINISHED
-                )
-                Statistic.failures(1)
+                _failed(res, req.status_code)
                 LOG.error("'%s' returned %d", url, req.status_code)
                 req.close()
                 return
             Resource.objects.filter(pk=res.pk).update(status_code=200)
             res.refresh_from_db()
 
+            if not received:
+                decoder = _decoder_for(req.headers)
             if retries == 0:
-                # Store Content-Length and Content-Type
-                Resource.objects.filter(pk=res.pk).update(
-                    content_length=req.headers.get("Content-Length"),
-                    content_type=req.headers.get("Content-Type", ""),
-                )
-                res.refresh_from_db()
+                _store_headers(res, req.headers, decoder is not None)
+                checksum = _checksum(res)
+                if decoder is not None:
+                    encoded_length = _encoded_length(req.headers)
+                elif _can_segment(req, res.content_length):
+                    req.close()
+                    size = _fetch_segments(res)
+                    # Hashed once the file is complete
+                    checksum = None
+                    break
 
             # When retrying, append to the file
             mode = "wb" if retries == 0 else "ab"
             with res.open(mode=mode) as f_out:
                 # Informe the caller about the current state
                 Resource.objects.filter(pk=res.pk).update(
-                    state=Resource.STATE_DOWNLOADING
+                    state=Resource.STATE_DOWNLOADING, claimed_at=timezone.now()
                 )
+                notify(res.pk)
                 res.refresh_from_db()
 
                 # variables to log progress
                 last_logged_value = 0
                 start = time.time()
+                last_notified = last_heartbeat = time.monotonic()
 
                 force_retry = False
                 try:
-                    # Loop on the data
-                    iterator = req.iter_content(
-                        chunk_size=settings.DOWNLOAD_CHUNK_SIZE, decode_unicode=False
-                    )
-                    for data in iterator:
+                    # Loop on the data. The bookkeeping is rate limited so
+                    # that the loop only writes.
+                    for data in _iter_raw(req):
+                        received += len(data)
+                        if decoder is not None:
+                            data = decoder.decode(data)
                         size += f_out.write(data)
+                        if checksum is not None:
+                            checksum.update(data)
+
+                        now = time.monotonic()
+                        if now - last_notified < settings.NOTIFY_PROGRESS_INTERVAL:
+                            continue
+                        last_notified = now
+
+                        # Wake up the streaming clients
+                        f_out.flush()
+                        notify(res.pk, progress=True)
+                        if now - last_heartbeat >= settings.FETCH_CLAIM_HEARTBEAT:
+                            last_heartbeat = now
+                            _heartbeat(res)
 
-                        if res.content_length:
-                            percent = math.floor(size / float(res.content_length) * 100)
-                            if percent >= last_logged_value + 5:
-                                last_logged_value = percent
-                                LOG.info(
-                                    "progress %3d%% (%dMB)",
-                                    percent,
-                                    int(size / (1024 * 1024)),
-                                )
-                        else:
-                            if size >= last_logged_value + 25 * 1024 * 1024:
-                                last_logged_value = size
-                                LOG.info("progress %dMB", int(size / (1024 * 1024)))
+                        last_logged_value = _log_progress(
+                            size, res.content_length, last_logged_value
+                        )
                 except requests.RequestException as exc:
                     LOG.error("Unable to fetch '%s'", url)
                     LOG.exception(exc)
                     force_retry = True
 
-                # Log the speed
-                end = time.time()
-                speed = "??"
-                with contextlib.suppress(ZeroDivisionError):
-                    speed = "%0.2f" % round(size / (1024 * 1024 * (end - start)), 2)
-                LOG.info(
-                    "%dMB downloaded in %0.2fs (%sMB/s)",
-                    size / (1024 * 1024),
-                    round(end - start, 2),
-                    speed,
-                )
+                _log_speed(size, start)
             # Retry if kisscache was unable to download the full file
             if not force_retry:
-                if not res.content_length:
+                if decoder is not None:
+                    if decoder.finished() and encoded_length in [None, received]:
+                        break
+                elif not res.content_length:
                     break
-                if res.content_length == size:
+                elif res.content_length == size:
                     break
 
-            LOG.warning(
-                "The total size (%d) is not equal to the Content-Length (%d)",
-                size,
-                res.content_length,
-            )
+            if decoder is not None:
+                LOG.warning(
+                    "The encoded size (%d) is not equal to the Content-Length (%s)",
+                    received,
+                    encoded_length,
+                )
+            else:
+                LOG.warning(
+                    "The total size (%d) is not equal to the Content-Length (%d)",
+                    size,
+                    res.content_length,
+                )
             LOG.warning("Retrying (%d/%d) after 5 seconds", retries, max_retries)
             time.sleep(5)
             retries += 1
@@ -190,73 +681,169 @@ def fetch(url):
     except Exception as exc:
         LOG.error("Unable to fetch '%s'", url)
         LOG.exception(exc)
-        Resource.objects.filter(pk=res.pk).update(
-            state=Resource.STATE_FINISHED, status_code=504
-        )
-        Statistic.failures(1)
+        _failed(res, 504)
         return
 
-    # Check or save the size
-    if res.content_length:
-        if res.content_length != size:
-            LOG.error(
-                "The total size (%d) is not equal to the Content-Length (%d)",
-                size,
-                res.content_length,
-            )
-            # Set the status_code to 502 so it will be removed soon
-            Resource.objects.filter(pk=res.pk).update(
-                state=Resource.STATE_FINISHED, status_code=504
-            )
-            Statistic.download(size)
-            Statistic.failures(1)
-    else:
-        Resource.objects.filter(pk=res.pk).update(content_length=size)
+    _fetched(res, size, time.monotonic() - started, checksum)
 
-    # Update the statistics
-    Statistic.download(size)
-    Statistic.successes(1)
 
-    # Mark the task as done
-    Resource.objects.filter(pk=res.pk).update(state=Resource.STATE_FINISHED)
+@shared_task(ignore_result=True)
+def encode(url):
+    """Store the variants of the resource, encoded for the clients"""
+    try:
+        res = Resource.get_by_url(url)
+    except Resource.DoesNotExist:
+        LOG.error("Resource not found for '%s'", url)
+        return
+    if res.state != Resource.STATE_FINISHED or res.status_code != 200:
+        return
+
+    variants = res.variants_list()
+    base = pathlib.Path(settings.DOWNLOAD_PATH)
+    for coding in settings.RESOURCE_VARIANTS:
+        if coding in res.encodings():
+            continue
+        path = base / res.encoded_path(coding)
+        tmp = path.with_name(path.name + ".tmp")
+        try:
+            size = compression.encode(coding, res.chunks(), tmp)
+            if size > res.content_length * settings.RESOURCE_COMPRESSION_MAX_RATIO:
+                LOG.info("'%s' variant of '%s' is not worth it", coding, url)
+                tmp.unlink()
+                continue
+            os.replace(tmp, path)
+        except Exception as exc:
+            LOG.error("Unable to encode '%s' with '%s'", url, coding)
+            LOG.exception(exc)
+            with contextlib.suppress(OSError):
+                tmp.unlink()
+            continue
+
+        variants.append(coding)
+        # The resource might have been removed in the meantime
+        if not Resource.objects.filter(pk=res.pk).update(
+            variants=",".join(variants), variants_length=F("variants_length") + size
+        ):
+            with contextlib.suppress(OSError):
+                path.unlink()
+            return
+        res.variants = ",".join(variants)
+        Statistic.size(size)
+        LOG.info("'%s' variant: %s", coding, filesizeformat(size))
+
+
+def _delete(query, deadline):
+    """
+    Delete the resources by batches until the deadline.
+
+    Return False if the time budget was exhausted.
+    """
+    batch_size = settings.RESOURCE_EXPIRE_BATCH_SIZE
+    while True:
+        if time.monotonic() >= deadline:
+            LOG.warning("* Time budget exhausted, resuming on next run")
+            return False
+        resources = Resource.delete_batch(query, batch_size)
+        for res in resources:
+            LOG.info("* '%s'", res.url)
+        if len(resources) < batch_size:
+            return True
 
 
 @shared_task(ignore_result=True)
 def expire():
+    # Stop before the next run of this task. As the resources are deleted in
+    # order, the next run will resume where this one stopped.
+    deadline = time.monotonic() + settings.RESOURCE_EXPIRE_TIME_BUDGET
+
     LOG.info("Removing failed resources")
     query = Resource.objects.filter(state=Resource.STATE_FINISHED)
-    for res in query.exclude(status_code=200):
-        LOG.info("* '%s'", res.url)
-        res.delete()
+    _delete(query.exclude(status_code=200).order_by("pk"), deadline)
     LOG.info("done")
 
     LOG.info("Expiring resources")
-    for res in Resource.objects.filter(state=Resource.STATE_FINISHED):
-        if res.created_at + timedelta(seconds=res.ttl) < timezone.now():
+    query = Resource.objects.filter(
+        state=Resource.STATE_FINISHED, expires_at__lt=timezone.now()
+    )
+    _delete(query.order_by("expires_at"), deadline)
+    LOG.info("done")
+
+    LOG.info("Scheduling the lost downloads again")
+    query = Resource.lost()
+    for res in query:
+        if time.monotonic() >= deadline:
+            LOG.warning("* Time budget exhausted, resuming on next run")
+            break
+        # The claim might have been refreshed in the meantime
+        if query.filter(pk=res.pk).update(
+            state=Resource.STATE_SCHEDULED,
+            watermark=None,
+            claimed=False,
+            claimed_by="",
+            claimed_at=None,
+        ):
             LOG.info("* '%s'", res.url)
-            res.delete()
+            fetch.apply_async((res.url,), queue=res.queue or None)
     LOG.info("done")
 
+    # Evicting might take long: run it in its own task
+    evict.delay()
+
+
+def _freed(blobs, content_length, digest, stored_length, variants_length):
+    """
+    Return the size freed by the deletion of the resource, as counted by
+    total_size(). "blobs" keeps the references and size of the blobs of the
+    resources already deleted.
+    """
+    if digest is None:
+        if stored_length is not None:
+            return stored_length + variants_length
+        return (content_length or 0) + variants_length
+    digest = bytes(digest)
+    if digest not in blobs:
+        blob = Blob.objects.filter(digest=digest).values_list("refs", "size")
+        blobs[digest] = list(blob.first() or (0, 0))
+    blobs[digest][0] -= 1
+    # The blob is only removed with its last resource
+    if blobs[digest][0] == 0:
+        return blobs[digest][1] + variants_length
+    return variants_length
+
+
+@shared_task(ignore_result=True)
+def evict():
     LOG.info("Checking quota usage")
-    limit = settings.RESOURCE_QUOTA * settings.RESOURCE_QUOTA_AUTO_CLEAN / 100
-    if Resource.total_size() > limit:
+    size = Resource.total_size()
+    limit = _high_watermark()
+    if size > limit:
+        policy = get_policy()
         LOG.info(
-            "* Cleaning by last usage (%s > %s)",
-            filesizeformat(Resource.total_size()),
+            "* Cleaning by %s (%s > %s)",
+            policy.description,
+            filesizeformat(size),
             filesizeformat(limit),
         )
+        # Remove enough resources to go below the low watermark
+        target = settings.RESOURCE_QUOTA * settings.RESOURCE_QUOTA_AUTO_CLEAN_LOW / 100
         last_usage_limit = timezone.now() - timedelta(
             seconds=settings.RESOURCE_QUOTA_AUTO_CLEAN_DELAY
         )
-        while Resource.total_size() > limit:
-            try:
-                q = Resource.objects.filter(state=Resource.STATE_FINISHED)
-                q = q.filter(last_usage__lt=last_usage_limit)
-                res = q.order_by("last_usage")[0]
-                LOG.info("  - %s: '%s'", filesizeformat(res.content_length), res.url)
-                res.delete()
-            except IndexError:
-                LOG.info("* No more resources to clean")
+        query = Resource.objects.filter(
+            state=Resource.STATE_FINISHED, last_usage__lt=last_usage_limit
+        )
+        pks = []
+        blobs = {}
+        for pk, url, content_length, *stored in policy.candidates(query):
+            LOG.info("  - %s: '%s'", filesizeformat(content_length), url)
+            pks.append(pk)
+            size -= _freed(blobs, content_length, *stored)
+            if size <= target:
                 break
+        else:
+            LOG.info("* No more resources to clean")
+        if pks:
+            query = Resource.objects.filter(pk__in=pks)
+            policy.evicted(Resource.delete_batch(query, len(pks)))
     LOG.info("* Usage: %s", filesizeformat(Resource.total_size()))
     LOG.info("done")
@@ -7,13 +7,31 @@
 #
 # SPDX-License-Identifier: MIT
 
+import asyncio
+import collections
 from functools import wraps
+from http.cookiejar import DefaultCookiePolicy
 import ipaddress
+import os
 import requests
+import socket
+import threading
+import time
 
 from django.conf import settings
 from django.http import HttpResponseForbidden
 from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import (
+    HTTPConnectionPool,
+    HTTPSConnectionPool,
+)
+from requests.packages.urllib3.exceptions import (
+    ConnectTimeoutError,
+    NewConnectionError,
+)
+from requests.packages.urllib3.poolmanager import PoolManager
+from requests.packages.urllib3.util.connection import allowed_gai_family
 from requests.packages.urllib3.util.retry import Retry
 
 
@@ -40,6 +58,16 @@ def is_client_allowed(request):
 
 
 def check_client_ip(func):
+    if asyncio.iscoroutinefunction(func):
+
+        @wraps(func)
+        async def inner_async(request, *args, **kwargs):
+            if is_client_allowed(request):
+                return await func(request, *args, **kwargs)
+            return HttpResponseForbidden()
+
+        return inner_async
+
     @wraps(func)
     def inner(request, *args, **kwargs):
         if is_client_allowed(request):
@@ -50,37 +78,277 @@ def check_client_ip(func):
     return inner
 
 
+def accepted_encodings(request):
+    """Return the content codings accepted by the client and their quality"""
+    codings = {}
+    for item in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding] = quality
+    return codings
+
+
+def preferred_encoding(request, available):
+    """
+    Return the encoding, among the available ones, preferred by the client or
+    "" if none is accepted or if the client prefers the plain content. The
+    first available encoding wins the ties, even against the plain content.
+    """
+    codings = accepted_encodings(request)
+    best, best_quality = "", 0
+    for coding in available:
+        quality = codings.get(coding, codings.get("*", 0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    # The plain content is accepted unless excluded explicitly (RFC 9110)
+    identity = codings.get("identity", 0 if codings.get("*") == 0 else 1)
+    if identity > best_quality:
+        return ""
+    return best
+
+
+# Maximum number of ranges served for a single request
+MAX_RANGES = 100
+
+
+def parse_ranges(request, length):
+    """
+    Parse the Range header of the request, for a content of the given length.
+
+    Return None when the whole content should be sent, otherwise the sorted
+    list of the (start, end) ranges, end excluded. The overlapping and
+    adjacent ranges are coalesced, so each byte is sent once. The list is
+    empty when no range is satisfiable.
+    """
+    header = request.META.get("HTTP_RANGE")
+    # Without validators, If-Range never matches
+    if header is None or "HTTP_IF_RANGE" in request.META:
+        return None
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) + 1 if last else max(length, start + 1)
+                if start < 0 or end <= start:
+                    return None
+            else:
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                start, end = max(length - suffix, 0), length
+        except ValueError:
+            return None
+        # Not satisfiable
+        if start >= length or start == end:
+            continue
+        ranges.append((start, min(end, length)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    coalesced = []
+    for start, end in sorted(ranges):
+        if coalesced and start <= coalesced[-1][1]:
+            coalesced[-1] = (coalesced[-1][0], max(coalesced[-1][1], end))
+        else:
+            coalesced.append((start, end))
+    return coalesced
+
+
+# Status codes of the requests worth retrying
+RETRY_STATUS_CODES = [
+    # See https://en.wikipedia.org/wiki/List_of_HTTP_status_codes
+    408,  # Request Timeout
+    413,  # Payload Too Large
+    425,  # Too Early
+    429,  # Too Many Requests
+    500,  # Internal Server Error
+    502,  # Bad Gateway
+    503,  # Service Unavailable
+    504,  # Gateway Timeout
+    507,  # Insufficient Storage
+    # Unofficial codes
+    420,  # Enhance Your Calm
+    430,  # Request Header Fields Too Large
+    509,  # Bandwidth Limit Exceeded
+    529,  # Site is overloaded
+    598,  # (Informal convention) Network read timeout error
+]
+
+
+class DNSCache:
+    """
+    Small LRU cache of the addresses of the upstream servers.
+
+    Only the first address returned by the resolver is kept. The entry is
+    dropped when the connection fails, so the next try resolves it again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def resolve(self, host, port):
+        """Return the cached address or the host when it can't be resolved"""
+        if settings.DOWNLOAD_DNS_CACHE_SIZE <= 0:
+            return host
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(host)
+                return entry[0]
+        try:
+            infos = socket.getaddrinfo(
+                host, port, allowed_gai_family(), socket.SOCK_STREAM
+            )
+        except (OSError, UnicodeError):
+            # Let urllib3 raise the right exception
+            return host
+        if not infos:
+            return host
+        address = infos[0][4][0]
+        with self.lock:
+            self.entries[host] = (address, now + settings.DOWNLOAD_DNS_CACHE_TIMEOUT)
+            self.entries.move_to_end(host)
+            while len(self.entries) > settings.DOWNLOAD_DNS_CACHE_SIZE:
+                self.entries.popitem(last=False)
+        return address
+
+    def invalidate(self, host):
+        with self.lock:
+            self.entries.pop(host, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+DNS = DNSCache()
+
+
+class CachedDNSMixin:
+    def _new_conn(self):
+        host = self._dns_host
+        self._dns_host = DNS.resolve(host, self.port)
+        try:
+            return super()._new_conn()
+        except (ConnectTimeoutError, NewConnectionError):
+            DNS.invalidate(host)
+            raise
+        finally:
+            self._dns_host = host
+
+
+class CachedDNSHTTPConnection(CachedDNSMixin, HTTPConnection):
+    pass
+
+
+class CachedDNSHTTPSConnection(CachedDNSMixin, HTTPSConnection):
+    pass
+
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class UpstreamPoolManager(PoolManager):
+    """Resolve with the DNS cache and apply DOWNLOAD_POOL_SIZES"""
+
+    pool_classes_by_scheme = {
+        "http": CachedDNSHTTPConnectionPool,
+        "https": CachedDNSHTTPSConnectionPool,
+    }
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        if request_context is None:
+            request_context = self.connection_pool_kw.copy()
+        maxsize = settings.DOWNLOAD_POOL_SIZES.get(host)
+        if maxsize is not None:
+            request_context["maxsize"] = maxsize
+        return super()._new_pool(scheme, host, port, request_context)
+
+
+class UpstreamAdapter(HTTPAdapter):
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = UpstreamPoolManager(
+            num_pools=connections, maxsize=maxsize, block=block, **pool_kwargs
+        )
+
+
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+
+def _reset_session():
+    """Drop the session inherited from the parent process"""
+    global SESSION, SESSION_LOCK
+    SESSION = None
+    SESSION_LOCK = threading.Lock()
+    DNS.clear()
+
+
+# The connections should never be shared with the forked processes (celery
+# prefork pool)
+os.register_at_fork(after_in_child=_reset_session)
+
+
 def requests_retry():
+    """
+    Return the session shared by the fetch tasks of the current process.
+
+    The connections to the upstream servers are kept alive, hence the
+    following downloads from the same server skip the DNS resolution and the
+    TCP and TLS handshakes.
+    """
+    global SESSION
+    with SESSION_LOCK:
+        if SESSION is None:
+            SESSION = _new_session()
+        return SESSION
+
+
+def _new_session():
     session = requests.Session()
+    # The session is shared by unrelated downloads: never keep cookies
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
     retries = settings.DOWNLOAD_RETRY
     backoff_factor = settings.DOWNLOAD_BACKOFF_FACTOR
-    status_forcelist = [
-        # See https://en.wikipedia.org/wiki/List_of_HTTP_status_codes
-        408,  # Request Timeout
-        413,  # Payload Too Large
-        425,  # Too Early
-        429,  # Too Many Requests
-        500,  # Internal Server Error
-        502,  # Bad Gateway
-        503,  # Service Unavailable
-        504,  # Gateway Timeout
-        507,  # Insufficient Storage
-        # Unofficial codes
-        420,  # Enhance Your Calm
-        430,  # Request Header Fields Too Large
-        509,  # Bandwidth Limit Exceeded
-        529,  # Site is overloaded
-        598,  # (Informal convention) Network read timeout error
-    ]
     retry = Retry(
         total=retries,
         read=retries,
         connect=retries,
         status=retries,
-        status_forcelist=status_forcelist,
+        status_forcelist=RETRY_STATUS_CODES,
         backoff_factor=backoff_factor,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = UpstreamAdapter(
+        pool_connections=settings.DOWNLOAD_POOL_HOSTS,
+        pool_maxsize=settings.DOWNLOAD_POOL_SIZE,
+        max_retries=retry,
+    )
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
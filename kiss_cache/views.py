@@ -8,20 +8,19 @@
 # SPDX-License-Identifier: MIT
 
 import contextlib
-from datetime import timedelta
+import inspect
 import pathlib
-import time
+import secrets
 
-from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
-from django.db import IntegrityError
-from django.db.models import F
-from django.db.models.functions import Now
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
 from django.conf import settings
+from django.db.models import F
 from django.http import (
     FileResponse,
-    Http404,
     HttpResponse,
     HttpResponseBadRequest,
+    HttpResponseNotAllowed,
     JsonResponse,
     StreamingHttpResponse,
 )
@@ -31,9 +30,19 @@ from django.utils import timezone
 from django.views.decorators.http import require_safe
 
 from kiss_cache.__about__ import __version__
+from kiss_cache.eviction import get_policy
+from kiss_cache.metadata import METADATA
 from kiss_cache.models import Resource, Statistic
-from kiss_cache.tasks import fetch
-from kiss_cache.utils import check_client_ip, is_client_allowed, get_user_ip
+from kiss_cache.pagination import InvalidCursor, KeysetPaginator
+from kiss_cache.notify import subscribe
+from kiss_cache.scheduler import schedule
+from kiss_cache.utils import (
+    check_client_ip,
+    is_client_allowed,
+    get_user_ip,
+    parse_ranges,
+    preferred_encoding,
+)
 
 
 def index(request):
@@ -61,9 +70,29 @@ def help(request):
     )
 
 
+def _snapshot():
+    """
+    Return the resource counts and the statistics.
+
+    The snapshot is computed with two queries and cached for
+    SNAPSHOT_CACHE_TIMEOUT seconds, as the monitoring polls the status often.
+    """
+
+    def compute():
+        return {"resources": Resource.counts(), "statistics": Statistic.snapshot()}
+
+    return cache.get_or_set(
+        "kiss_cache.snapshot", compute, settings.SNAPSHOT_CACHE_TIMEOUT
+    )
+
+
 def statistics(request):
+    snapshot = _snapshot()
+    counts = snapshot["resources"]
+    stats = snapshot["statistics"]
+
     # Compute the quota and current size
-    size = Resource.total_size()
+    size = stats[Statistic.STAT_SIZE]
     quota = settings.RESOURCE_QUOTA
     progress = 0
     with contextlib.suppress(Exception):
@@ -75,19 +104,12 @@ def statistics(request):
     else:
         progress_status = "success"
 
-    # Count the resources
-    query = Resource.objects.all()
-    scheduled = query.filter(state=Resource.STATE_SCHEDULED).count()
-    downloading = query.filter(state=Resource.STATE_DOWNLOADING).count()
-    successes = query.filter(state=Resource.STATE_FINISHED, status_code=200).count()
-    failures = (
-        query.filter(state=Resource.STATE_FINISHED).exclude(status_code=200).count()
-    )
-
     # Compute average usage
     average_usage = "??"
     with contextlib.suppress(ZeroDivisionError):
-        average_usage = round(Resource.total_usage() / (successes + failures))
+        average_usage = round(
+            counts["usage"] / (counts["successes"] + counts["failures"])
+        )
 
     return render(
         request,
@@ -98,38 +120,42 @@ def statistics(request):
             "quota": quota,
             "progress": progress,
             "progress_status": progress_status,
-            "scheduled_count": scheduled,
-            "downloading_count": downloading,
-            "successes_count": successes,
-            "successes_total_count": Statistic.successes(),
-            "failures_count": failures,
-            "failures_total_count": Statistic.failures(),
-            "statistics_download": Statistic.download(),
-            "statistics_upload": Statistic.upload(),
-            "statistics_requests": Statistic.requests(),
+            "scheduled_count": counts["scheduled"],
+            "downloading_count": counts["downloading"],
+            "successes_count": counts["successes"],
+            "successes_total_count": stats[Statistic.STAT_SUCCESSES],
+            "failures_count": counts["failures"],
+            "failures_total_count": stats[Statistic.STAT_FAILURES],
+            "statistics_download": stats[Statistic.STAT_DOWNLOAD],
+            "statistics_upload": stats[Statistic.STAT_UPLOAD],
+            "statistics_requests": stats[Statistic.STAT_REQUESTS],
         },
     )
 
 
-def resources(request, page=1, state="successes"):
+# Columns that can be used to sort the resources
+SORTABLE_COLUMNS = [
+    "url",
+    "ttl",
+    "content_length",
+    "last_usage",
+    "usage",
+    "status_code",
+]
+
+
+def resources(request, state="successes"):
     # Default order
     default_order = "url" if state in ["scheduled", "downloading"] else "-last_usage"
 
     # Sort order
     order = request.GET.get("order", default_order)
     attribute = order[1:] if order[0] == "-" else order
-    if not hasattr(Resource, attribute):
+    if attribute not in SORTABLE_COLUMNS:
         return HttpResponseBadRequest(f"Invalid sort order '{order}'")
 
     # Build the query
-    query = Resource.objects.order_by(order, "-last_usage")
-    scheduled = query.filter(state=Resource.STATE_SCHEDULED).count()
-    downloading = query.filter(state=Resource.STATE_DOWNLOADING).count()
-    successes = query.filter(state=Resource.STATE_FINISHED, status_code=200).count()
-    failures = (
-        query.filter(state=Resource.STATE_FINISHED).exclude(status_code=200).count()
-    )
-
+    query = Resource.objects.all()
     if state == "scheduled":
         query = query.filter(state=Resource.STATE_SCHEDULED)
     elif state == "downloading":
@@ -141,13 +167,16 @@ def resources(request, page=1, state="successes"):
     else:
         return HttpResponseBadRequest("Invalid state")
 
-    paginator = Paginator(query, 25)
+    # The counts are cached: do not count the rows on each page view
+    counts = _snapshot()["resources"]
+
+    paginator = KeysetPaginator(query, order, 25)
     try:
-        page = paginator.page(page)
-    except PageNotAnInteger:
-        return HttpResponseBadRequest()
-    except EmptyPage:
-        raise Http404()
+        page = paginator.page(
+            after=request.GET.get("after"), before=request.GET.get("before")
+        )
+    except InvalidCursor:
+        return HttpResponseBadRequest("Invalid cursor")
 
     return render(
         request,
@@ -159,10 +188,10 @@ def resources(request, page=1, state="successes"):
             "default_order": default_order,
             "state": state,
             "url_name": "resources." + state,
-            "scheduled_count": scheduled,
-            "downloading_count": downloading,
-            "successes_count": successes,
-            "failures_count": failures,
+            "scheduled_count": counts["scheduled"],
+            "downloading_count": counts["downloading"],
+            "successes_count": counts["successes"],
+            "failures_count": counts["failures"],
         },
     )
 
@@ -178,30 +207,32 @@ def api_health(request):
     return HttpResponse("ok")
 
 
-@check_client_ip
-@require_safe
-def api_fetch(request, filename=None):
+def _fetch_params(request):
+    """Return the url and the ttl or a response in case of error"""
     url = request.GET.get("url")
     ttl = request.GET.get("ttl", settings.DEFAULT_TTL)
 
     # Check parameters
     if url is None:
-        return HttpResponseBadRequest("'url' should be specified")
+        return (None, HttpResponseBadRequest("'url' should be specified"))
     # Parse the TTL
     try:
         ttl = Resource.parse_ttl(ttl)
     except Exception:
-        return HttpResponseBadRequest("Invalid 'ttl' value")
+        return (None, HttpResponseBadRequest("Invalid 'ttl' value"))
+    return ((url, ttl), None)
 
-    try:
-        # TODO: remove in case of exception in this function
-        res, created = Resource.objects.get_or_create(url=url)
-    except IntegrityError:
-        res = Resource.objects.get(url=url)
-        created = False
+
+def _fetch_resource(url, ttl):
+    """Return the resource, scheduling the fetch if needed, or a response"""
+    # Finished resources are cached by each process. Otherwise, create the
+    # resource or shorten the TTL if needed.
+    res, created = METADATA.get(url, ttl), False
+    if res is None:
+        res, created = Resource.get_or_create_with_ttl(url, ttl)
 
     # Set the last usage and increase the counter
-    Resource.objects.filter(pk=res.pk).update(usage=F("usage") + 1, last_usage=Now())
+    Resource.use(res.pk)
 
     # If needed, fetch the url
     if created:
@@ -211,44 +242,118 @@ def api_fetch(request, filename=None):
             Resource.objects.filter(pk=res.pk).update(
                 state=Resource.STATE_FINISHED, status_code=507
             )
-            return HttpResponse(status=507)
+            return (None, HttpResponse(status=507))
 
-        # Set the ttl
-        Resource.objects.filter(pk=res.pk).update(ttl=ttl)
+        # Adapt the eviction policy
+        get_policy().missed(url)
 
         # Schedule the fetch task
-        fetch.delay(res.url)
-    else:
-        # Set the TTL if the resulting date is earlier
-        now = timezone.now()
-        current_end = res.created_at + timedelta(seconds=res.ttl)
-        new_end = now + timedelta(seconds=ttl)
-        if current_end > new_end:
-            ttl = (now - res.created_at).total_seconds() + ttl
-            res.ttl = ttl
-            Resource.objects.filter(pk=res.pk).update(ttl=ttl)
+        schedule(res)
 
-    # Wait for the task to start
-    # TODO: add timeout
-    res.refresh_from_db()
-    while res.state == Resource.STATE_SCHEDULED:
-        time.sleep(1)
-        res.refresh_from_db()
+    # The fetch tasks start with the resources that most clients wait for
+    if res.state == Resource.STATE_SCHEDULED:
+        Resource.objects.filter(pk=res.pk, state=Resource.STATE_SCHEDULED).update(
+            waiting=F("waiting") + 1
+        )
+    return (res, None)
 
+
+def _fetch_statistics(request, res):
     # Update the statistics (only for GET has with HEAD, django will just
     # return headers, not the body)
     if request.method == "GET":
         Statistic.requests(1)
         if res.content_length:
-            Statistic.upload(res.content_length)
+            # Only count the ranges sent (nothing for a 416). With xsendfile,
+            # the web server sends the same ranges.
+            ranges = parse_ranges(request, res.content_length)
+            if ranges is None:
+                Statistic.upload(res.content_length)
+            elif ranges:
+                Statistic.upload(sum(end - start for (start, end) in ranges))
+
+
+def _byteranges(stream, ranges, headers, trailer):
+    """Generate the multipart/byteranges body"""
+    if inspect.isasyncgenfunction(stream):
+
+        async def body_async():
+            for (start, end), header in zip(ranges, headers):
+                yield header
+                async for data in stream(start, end):
+                    yield data
+            yield trailer
+
+        return body_async()
+
+    def body():
+        for (start, end), header in zip(ranges, headers):
+            yield header
+            yield from stream(start, end)
+        yield trailer
+
+    return body()
+
+
+def _range_response(request, res, stream):
+    """
+    Return the response to the Range request or None to send the whole
+    content. stream(start, end) generates the content of each range.
+    """
+    length = res.content_length
+    # Ranges are served once the length is known
+    if length is None:
+        return None
+    ranges = parse_ranges(request, length)
+    if ranges is None:
+        return None
+    if not ranges:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{length}"
+        return response
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(stream(start, end), status=206)
+        response["Content-Length"] = end - start
+        response["Content-Range"] = f"bytes {start}-{end - 1}/{length}"
+        if res.content_type:
+            response["Content-Type"] = res.content_type
+        return response
 
+    boundary = secrets.token_hex(16)
+    headers = []
+    for index, (start, end) in enumerate(ranges):
+        header = ("\r\n" if index else "") + f"--{boundary}\r\n"
+        if res.content_type:
+            header += f"Content-Type: {res.content_type}\r\n"
+        header += f"Content-Range: bytes {start}-{end - 1}/{length}\r\n\r\n"
+        headers.append(header.encode("utf-8"))
+    trailer = f"\r\n--{boundary}--\r\n".encode("utf-8")
+    response = StreamingHttpResponse(
+        _byteranges(stream, ranges, headers, trailer), status=206
+    )
+    response["Content-Length"] = (
+        sum(len(header) for header in headers)
+        + sum(end - start for (start, end) in ranges)
+        + len(trailer)
+    )
+    response["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    return response
+
+
+def _fetch_response(request, res, filename, stream):
     # The task has been started.
     if res.state == Resource.STATE_DOWNLOADING:
-        response = StreamingHttpResponse(res.stream())
+        response = _range_response(request, res, stream)
+        if response is None:
+            response = StreamingHttpResponse(stream())
+            if res.content_length:
+                response["Content-Length"] = res.content_length
+            if res.content_type:
+                response["Content-Type"] = res.content_type
         if res.content_length:
-            response["Content-Length"] = res.content_length
-        if res.content_type:
-            response["Content-Type"] = res.content_type
+            response["Accept-Ranges"] = "bytes"
         if filename:
             response["Content-Disposition"] = f"attachment; filename={filename}"
         return response
@@ -257,19 +362,46 @@ def api_fetch(request, filename=None):
         if res.status_code != 200:
             return HttpResponse(status=res.status_code)
 
-        # Use xsendfile or just return the file
-        if settings.USE_XSENDFILE:
+        # Select the compressed file or the variant accepted by the client
+        encodings = res.encodings()
+        coding = preferred_encoding(request, encodings)
+        path = res.encoded_path(coding)
+        # Decompress for the clients not accepting the compressed file
+        if res.compression and not coding:
+            response = _range_response(request, res, stream)
+            if response is None:
+                response = StreamingHttpResponse(stream())
+                response["Content-Length"] = res.content_length
+            response["Accept-Ranges"] = "bytes"
+        # Use xsendfile (the web server handles the ranges) or just return the
+        # file
+        elif settings.USE_XSENDFILE:
             response = HttpResponse()
             if settings.XSENDFILE_BACKEND == "apache2":
-                response["X-Sendfile"] = res.fullpath.encode("utf-8")
+                response["X-Sendfile"] = str(
+                    pathlib.Path(settings.DOWNLOAD_PATH) / path
+                ).encode("utf-8")
             elif settings.XSENDFILE_BACKEND == "nginx":
-                response["X-Accel-Redirect"] = ("/internal/" + res.path).encode("utf-8")
+                # nginx adds the Content-Encoding header
+                prefix = f"/internal-{coding}/" if coding else "/internal/"
+                response["X-Accel-Redirect"] = (prefix + path).encode("utf-8")
             else:
                 raise NotImplementedError("Unknown xsendfile backend")
+        elif coding:
+            # The ranges of the variants are only served by xsendfile
+            response = FileResponse(res.open("rb", coding))
         else:
-            response = FileResponse(res.open("rb"))
-
-        if res.content_type:
+            response = _range_response(request, res, stream)
+            if response is None:
+                response = FileResponse(res.open("rb"))
+            response["Accept-Ranges"] = "bytes"
+
+        if encodings:
+            response["Vary"] = "Accept-Encoding"
+        if coding:
+            response["Content-Encoding"] = coding
+        # The partial responses already have their Content-Type
+        if res.content_type and response.status_code == 200:
             response["Content-Type"] = res.content_type
         if filename:
             response["Content-Disposition"] = f"attachment; filename={filename}"
@@ -278,21 +410,71 @@ def api_fetch(request, filename=None):
         raise NotImplementedError("new state value?")
 
 
+@check_client_ip
+@require_safe
+def api_fetch(request, filename=None):
+    params, response = _fetch_params(request)
+    if response is not None:
+        return response
+    res, response = _fetch_resource(*params)
+    if response is not None:
+        return response
+
+    # Wait for the task to start
+    # TODO: add timeout
+    if res.state == Resource.STATE_SCHEDULED:
+        with subscribe(res.pk) as subscription:
+            res.refresh_from_db()
+            while res.state == Resource.STATE_SCHEDULED:
+                subscription.wait()
+                res.refresh_from_db()
+    METADATA.add(res)
+
+    _fetch_statistics(request, res)
+    return _fetch_response(request, res, filename, res.stream)
+
+
+@check_client_ip
+async def api_fetch_async(request, filename=None):
+    """
+    Same as api_fetch, for ASGI servers.
+
+    Clients waiting for the resource to be scheduled or downloaded do not hold
+    a thread: thousands of concurrent clients only cost coroutines. Database
+    queries are run by sync_to_async.
+    """
+    if request.method not in ["GET", "HEAD"]:
+        return HttpResponseNotAllowed(["GET", "HEAD"])
+    params, response = _fetch_params(request)
+    if response is not None:
+        return response
+    res, response = await sync_to_async(_fetch_resource)(*params)
+    if response is not None:
+        return response
+
+    # Wait for the task to start
+    if res.state == Resource.STATE_SCHEDULED:
+        with subscribe(res.pk) as subscription:
+            await sync_to_async(res.refresh_from_db)()
+            while res.state == Resource.STATE_SCHEDULED:
+                await subscription.wait_async()
+                await sync_to_async(res.refresh_from_db)()
+    METADATA.add(res)
+
+    await sync_to_async(_fetch_statistics)(request, res)
+    return _fetch_response(request, res, filename, res.stream_async)
+
+
 @require_safe
 def api_status(request):
-    disk_usage = Resource.total_size()
+    snapshot = _snapshot()
+    counts = snapshot["resources"]
+    stats = snapshot["statistics"]
+
+    disk_usage = stats[Statistic.STAT_SIZE]
     disk_quota = settings.RESOURCE_QUOTA
     disk_usage_percent = round(disk_usage / disk_quota * 100)
 
-    # Count the resources
-    query = Resource.objects.all()
-    scheduled = query.filter(state=Resource.STATE_SCHEDULED).count()
-    downloading = query.filter(state=Resource.STATE_DOWNLOADING).count()
-    successes = query.filter(state=Resource.STATE_FINISHED, status_code=200).count()
-    failures = (
-        query.filter(state=Resource.STATE_FINISHED).exclude(status_code=200).count()
-    )
-
     return JsonResponse(
         {
             "timestamp": timezone.now(),
@@ -300,16 +482,16 @@ def api_status(request):
             "disk_usage_percent": disk_usage_percent,
             "disk_quota": disk_quota,
             "instance": request.build_absolute_uri("/"),
-            "resources_scheduled": scheduled,
-            "resources_downloading": downloading,
-            "resources_successes": successes,
-            "resources_failures": failures,
-            "resources_usage": Resource.total_usage(),
-            "statistics_successes": Statistic.successes(),
-            "statistics_failures": Statistic.failures(),
-            "statistics_download": Statistic.download(),
-            "statistics_upload": Statistic.upload(),
-            "statistics_requests": Statistic.requests(),
+            "resources_scheduled": counts["scheduled"],
+            "resources_downloading": counts["downloading"],
+            "resources_successes": counts["successes"],
+            "resources_failures": counts["failures"],
+            "resources_usage": counts["usage"],
+            "statistics_successes": stats[Statistic.STAT_SUCCESSES],
+            "statistics_failures": stats[Statistic.STAT_FAILURES],
+            "statistics_download": stats[Statistic.STAT_DOWNLOAD],
+            "statistics_upload": stats[Statistic.STAT_UPLOAD],
+            "statistics_requests": stats[Statistic.STAT_REQUESTS],
             "version": __version__,
         }
     )
@@ -91,11 +91,15 @@ then
   then
     CELERY_CONCURRENCY="--concurrency $CELERY_CONCURRENCY"
   fi
-  exec python3 -m celery -A website worker $CELERY_CONCURRENCY --loglevel=INFO
+  if [ "$CELERY_QUEUES" != "" ]
+  then
+    CELERY_QUEUES="--queues $CELERY_QUEUES"
+  fi
+  exec python3 -m celery -A website worker $CELERY_CONCURRENCY $CELERY_QUEUES --loglevel=INFO
 elif [ "$SERVICE" = "celery-beat" ]
 then
   exec python3 -m celery -A website beat --loglevel=INFO --pidfile= -s /var/cache/kiss-cache/celerybeat-schedule
-elif [ "$SERVICE" = "gunicorn" ]
+elif [ "$SERVICE" = "gunicorn" ] || [ "$SERVICE" = "uvicorn" ]
 then
   echo "Waiting for postgresql"
   wait_postgresql
@@ -112,6 +116,13 @@ then
   echo "done"
   echo ""
 
+  if [ "$SERVICE" = "uvicorn" ]
+  then
+    UVICORN_WORKERS=${UVICORN_WORKERS:-4}
+    echo "Starting uvicorn with workers=$UVICORN_WORKERS"
+    exec uvicorn --log-level debug --host 0.0.0.0 --port 80 --workers "$UVICORN_WORKERS" website.asgi:application
+  fi
+
   GUNICORN_THREADS=${GUNICORN_THREADS:-10}
   GUNICORN_WORKERS=${GUNICORN_WORKERS:-4}
   echo "Starting gunicorn with workers=$GUNICORN_WORKERS and threads=$GUNICORN_THREADS"
@@ -36,6 +36,16 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 # Celery settings
 CELERY_BROKER_URL = "redis://redis:6379/0"
 
+# Wake up waiting clients with redis pub/sub
+NOTIFY_BACKEND = "redis"
+NOTIFY_REDIS_URL = "redis://redis:6379/0"
+
+# Large resources are fetched by the celery-worker-large service
+FETCH_LARGE_QUEUE = "large"
+
+# Use the async views when served by uvicorn
+ASYNC_API = os.environ.get("SERVICE") == "uvicorn"
+
 # Load settings from the configuration file
 with contextlib.suppress(FileNotFoundError):
     data = pathlib.Path("/etc/kiss-cache.yaml").read_text(encoding="utf-8")
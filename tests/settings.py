@@ -81,3 +81,11 @@ STATIC_URL = "/static/"
 CELERY_BROKER_URL = "redis://localhost:6379/0"
 
 from kiss_cache.settings import *
+
+# Write immediately to the database
+STATISTIC_FLUSH_INTERVAL = 0
+USAGE_FLUSH_INTERVAL = 0
+# Always read the resources from the database
+METADATA_CACHE_SIZE = 0
+# Always compute the statistics
+SNAPSHOT_CACHE_TIMEOUT = 0
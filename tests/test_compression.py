@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import gzip
+import hashlib
+import os
+import pytest
+
+from kiss_cache.compression import (
+    Decoder,
+    check,
+    compress,
+    decompress,
+    encode,
+    is_compressible,
+    seek_table,
+)
+
+zstandard = pytest.importorskip("zstandard")
+
+
+def test_check(settings):
+    settings.RESOURCE_COMPRESSION = ""
+    check()
+    settings.RESOURCE_COMPRESSION = "zstd"
+    check()
+    settings.RESOURCE_COMPRESSION = "lzma"
+    with pytest.raises(NotImplementedError):
+        check()
+
+
+def test_is_compressible(settings):
+    settings.RESOURCE_COMPRESSION_TYPES = ["text/", "application/json"]
+    assert is_compressible("text/plain; charset=UTF-8")
+    assert is_compressible("Application/JSON")
+    assert not is_compressible("application/gzip")
+    assert not is_compressible("")
+
+
+def test_compress(settings, tmpdir):
+    settings.RESOURCE_COMPRESSION_FRAME_SIZE = 1000
+    content = b"".join(b"line %d\n" % index for index in range(1000))
+    (tmpdir / "plain").write_binary(content)
+
+    checksum = compress(str(tmpdir / "plain"), str(tmpdir / "plain.zst"))
+    data = (tmpdir / "plain.zst").read_binary()
+    assert checksum.digest() == hashlib.sha256(data).digest()
+    assert len(data) < len(content)
+    # A valid zstd stream
+    assert zstandard.ZstdDecompressor().stream_reader(data).read() == content
+
+    fd = os.open(str(tmpdir / "plain.zst"), os.O_RDONLY)
+    try:
+        frames = seek_table(fd)
+        assert len(content) == 8890
+        assert len(frames) == 9
+        assert frames[0][0] == 0
+        assert [frame[2] for frame in frames] == list(range(0, 9000, 1000))
+        assert sum(frame[3] for frame in frames) == len(content)
+
+        assert b"".join(decompress(fd)) == content
+        assert b"".join(decompress(fd, 1500, 4321)) == content[1500:4321]
+        assert b"".join(decompress(fd, 8000)) == content[8000:]
+        assert b"".join(decompress(fd, 0, 0)) == b""
+    finally:
+        os.close(fd)
+
+
+def test_compress_incompressible(settings, tmpdir):
+    settings.RESOURCE_COMPRESSION_FRAME_SIZE = 1000
+    (tmpdir / "plain").write_binary(os.urandom(5000))
+    assert compress(str(tmpdir / "plain"), str(tmpdir / "plain.zst")) is None
+
+
+def test_check_variants(settings):
+    settings.RESOURCE_VARIANTS = ["zstd", "gzip"]
+    check()
+    settings.RESOURCE_VARIANTS = ["deflate"]
+    with pytest.raises(NotImplementedError):
+        check()
+
+
+@pytest.mark.parametrize("coding", ["br", "gzip", "zstd"])
+def test_encode(coding, tmpdir):
+    if coding == "br":
+        brotli = pytest.importorskip("brotli")
+    content = b"".join(b"line %d\n" % index for index in range(1000))
+    chunks = [content[index : index + 100] for index in range(0, len(content), 100)]
+    size = encode(coding, chunks, str(tmpdir / "variant"))
+    data = (tmpdir / "variant").read_binary()
+    assert size == len(data)
+    assert size < len(content)
+    if coding == "br":
+        assert brotli.decompress(data) == content
+    elif coding == "gzip":
+        assert gzip.decompress(data) == content
+    else:
+        assert zstandard.ZstdDecompressor().stream_reader(data).read() == content
+
+
+def test_decoder():
+    content = b"hello world"
+    encoded = gzip.compress(content[:5]) + gzip.compress(content[5:])
+    decoder = Decoder("gzip")
+    data = b"".join(
+        decoder.decode(encoded[index : index + 3])
+        for index in range(0, len(encoded), 3)
+    )
+    assert data == content
+    assert decoder.finished()
+
+    cctx = zstandard.ZstdCompressor()
+    encoded = cctx.compress(content[:5]) + cctx.compress(content[5:])
+    decoder = Decoder("zstd")
+    assert decoder.decode(encoded) == content
+    assert decoder.finished()
+
+    # Truncated
+    decoder = Decoder("gzip")
+    decoder.decode(gzip.compress(content)[:-4])
+    assert not decoder.finished()
+
+    with pytest.raises(NotImplementedError):
+        Decoder("deflate")
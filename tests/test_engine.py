@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import gzip
+
+from asgiref.sync import async_to_sync
+from celery.signals import worker_process_shutdown
+import pytest
+
+from kiss_cache.__about__ import __version__
+from kiss_cache.engine import _get, fetch_async
+from kiss_cache.models import Resource, Statistic
+from kiss_cache.tasks import fetch
+
+
+class Content:
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+
+    async def iter_any(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+
+class Response:
+    def __init__(self, status, chunks=(), headers=None, error=None):
+        self.status = status
+        self.headers = headers or {}
+        self.content = Content(chunks, error)
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+class Session:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    async def get(self, url, headers):
+        self.requests.append((url, headers))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_fetch_async(db, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    Resource.objects.create(url="https://example.com")
+    session = Session(
+        [
+            Response(
+                200,
+                [b"hello", b" worl"],
+                {"Content-Length": "10", "Content-Type": "text/plain"},
+            )
+        ]
+    )
+
+    async_to_sync(fetch_async)("https://example.com", session)
+    assert session.requests == [
+        (
+            "https://example.com",
+            {"Accept-Encoding": "", "User-Agent": f"KissCache/{__version__}"},
+        )
+    ]
+    res = Resource.objects.get(url="https://example.com")
+    assert (tmpdir / res.path).read_text(encoding="utf-8") == "hello worl"
+    assert res.state == Resource.STATE_FINISHED
+    assert res.status_code == 200
+    assert res.content_type == "text/plain"
+    assert res.content_length == 10
+    assert Statistic.download() == 10
+    assert Statistic.successes() == 1
+
+
+def test_fetch_async_resume(db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.DOWNLOAD_RETRY = 0
+    mocker.patch("kiss_cache.engine.asyncio.sleep", mocker.AsyncMock())
+    Resource.objects.create(url="https://example.com")
+    session = Session(
+        [
+            Response(
+                200,
+                [b"hello"],
+                {"Content-Length": "10"},
+                error=asyncio.TimeoutError(),
+            ),
+            Response(206, [b" worl"]),
+        ]
+    )
+
+    async_to_sync(fetch_async)("https://example.com", session)
+    assert session.requests[1][1]["Range"] == "bytes=5-"
+    res = Resource.objects.get(url="https://example.com")
+    assert (tmpdir / res.path).read_text(encoding="utf-8") == "hello worl"
+    assert res.state == Resource.STATE_FINISHED
+    assert res.status_code == 200
+    assert Statistic.download() == 10
+
+
+def test_fetch_async_errors(db, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.DOWNLOAD_RETRY = 0
+
+    # The resource does not exist
+    async_to_sync(fetch_async)("https://example.com", Session([]))
+
+    # Unable to connect
+    Resource.objects.create(url="https://example.com")
+    async_to_sync(fetch_async)("https://example.com", Session([asyncio.TimeoutError()]))
+    res = Resource.objects.get(url="https://example.com")
+    assert res.state == Resource.STATE_FINISHED
+    assert res.status_code == 502
+
+    # Not found
+    res.delete()
+    Resource.objects.create(url="https://example.com")
+    response = Response(404)
+    async_to_sync(fetch_async)("https://example.com", Session([response]))
+    assert response.released
+    res = Resource.objects.get(url="https://example.com")
+    assert res.state == Resource.STATE_FINISHED
+    assert res.status_code == 404
+    assert Statistic.failures() == 2
+
+
+def test_get_retries(mocker, settings):
+    settings.DOWNLOAD_RETRY = 3
+    settings.DOWNLOAD_BACKOFF_FACTOR = 0
+    first, last = Response(503), Response(200)
+    session = Session([first, asyncio.TimeoutError(), Response(429), last])
+    assert asyncio.run(_get(session, "https://example.com", {})) is last
+    assert first.released
+
+    session = Session([Response(503), Response(503)])
+    settings.DOWNLOAD_RETRY = 1
+    assert asyncio.run(_get(session, "https://example.com", {})).status == 503
+
+    session = Session([asyncio.TimeoutError()] * 2)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(_get(session, "https://example.com", {}))
+
+
+def test_fetch_engine(mocker, settings):
+    submit = mocker.patch("kiss_cache.engine.ENGINE.submit")
+    settings.FETCH_ENGINE = "asyncio"
+    fetch("https://example.com")
+    submit.assert_called_once_with("https://example.com")
+
+    settings.FETCH_ENGINE = "gevent"
+    with pytest.raises(NotImplementedError):
+        fetch("https://example.com")
+
+
+def test_engine_shutdown(mocker):
+    stop = mocker.patch("kiss_cache.engine.ENGINE.stop")
+    worker_process_shutdown.send(sender=None, pid=42, exitcode=0)
+    stop.assert_called_once_with()
+
+
+def test_fetch_async_encoded(db, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.DOWNLOAD_ENCODINGS = ["gzip"]
+    Resource.objects.create(url="https://example.com")
+    encoded = gzip.compress(b"hello world")
+    session = Session(
+        [
+            Response(
+                200,
+                [encoded[:10], encoded[10:]],
+                {
+                    "Content-Encoding": "gzip",
+                    "Content-Length": str(len(encoded)),
+                    "Content-Type": "text/plain",
+                },
+            )
+        ]
+    )
+
+    async_to_sync(fetch_async)("https://example.com", session)
+    assert session.requests[0][1]["Accept-Encoding"] == "gzip"
+    res = Resource.objects.get(url="https://example.com")
+    assert (tmpdir / res.path).read_binary() == b"hello world"
+    assert res.state == Resource.STATE_FINISHED
+    assert res.status_code == 200
+    assert res.content_length == 11
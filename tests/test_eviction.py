@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+from datetime import timedelta
+
+import pytest
+
+from django.utils import timezone
+
+from kiss_cache.eviction import ARC, GDSF, LFU, LRU, get_policy
+from kiss_cache.models import Ghost, Resource, Statistic
+
+
+def create(now, name, size, usage, age):
+    return Resource.objects.create(
+        url=f"https://example.com/{name}",
+        content_length=size,
+        usage=usage,
+        last_usage=now - timedelta(hours=age),
+        state=Resource.STATE_FINISHED,
+        status_code=200,
+    )
+
+
+def candidates(policy):
+    query = Resource.objects.filter(state=Resource.STATE_FINISHED)
+    return [row[1].split("/")[-1] for row in policy.candidates(query)]
+
+
+@pytest.fixture
+def resources(db):
+    now = timezone.now()
+    create(now, "rootfs", 2_000_000_000, 500, 24)
+    create(now, "dtb", 1_000, 1, 1)
+    create(now, "kernel", 10_000_000, 20, 2)
+    create(now, "initrd", 30_000_000, 1, 3)
+
+
+def test_get_policy(settings):
+    settings.RESOURCE_EVICTION_POLICY = "lru"
+    assert isinstance(get_policy(), LRU)
+    settings.RESOURCE_EVICTION_POLICY = "gdsf"
+    assert isinstance(get_policy(), GDSF)
+    settings.RESOURCE_EVICTION_POLICY = "fifo"
+    with pytest.raises(NotImplementedError, match="Unknown eviction policy"):
+        get_policy()
+
+
+def test_lru(resources):
+    assert candidates(LRU()) == ["rootfs", "initrd", "kernel", "dtb"]
+
+
+def test_lfu(resources):
+    assert candidates(LFU()) == ["initrd", "dtb", "kernel", "rootfs"]
+
+
+def test_gdsf(resources, settings):
+    settings.RESOURCE_EVICTION_POLICY = "gdsf"
+    # Priorities are computed on each hit
+    for res in Resource.objects.all():
+        Resource.use(res.pk)
+    assert candidates(GDSF()) == ["initrd", "rootfs", "kernel", "dtb"]
+    priorities = dict(Resource.objects.values_list("url", "priority"))
+    assert priorities["https://example.com/dtb"] == pytest.approx(2 / 1_000)
+
+    # The size is known at the end of the download
+    res = Resource.objects.create(url="https://example.com/modules", usage=1)
+    Resource.use(res.pk)
+    res.refresh_from_db()
+    assert res.priority == pytest.approx(2)
+    Resource.objects.filter(pk=res.pk).update(content_length=1_000_000)
+    GDSF().fetched(res.pk)
+    res.refresh_from_db()
+    # L is the lowest priority of the cached resources
+    inflation = Resource.objects.get(url="https://example.com/initrd").priority
+    assert res.priority == pytest.approx(inflation + 2 / 1_000_000)
+
+
+def test_arc(resources, settings):
+    settings.RESOURCE_QUOTA = 3_000_000_000
+    policy = ARC()
+    # T1 (dtb and initrd) is larger than the target: evict T1 first
+    assert Statistic.arc_target() == 0
+    assert candidates(policy) == ["initrd", "dtb", "rootfs", "kernel"]
+
+    # Evicted resources become ghosts
+    query = Resource.objects.filter(url__endswith="/initrd")
+    policy.evicted(Resource.delete_batch(query, 1))
+    query = Resource.objects.filter(url__endswith="/rootfs")
+    policy.evicted(Resource.delete_batch(query, 1))
+    assert sorted(Ghost.objects.values_list("frequent", "size")) == [
+        (False, 30_000_000),
+        (True, 2_000_000_000),
+    ]
+
+    # A ghost from T1 is requested again: T1 target increases
+    policy.missed("https://example.com/initrd")
+    assert Statistic.arc_target() == 2_000_000_000
+    assert Ghost.objects.count() == 1
+    assert candidates(policy) == ["kernel", "dtb"]
+
+    # A ghost from T2 is requested again: T1 target decreases
+    policy.missed("https://example.com/rootfs")
+    assert Statistic.arc_target() == 0
+    assert Ghost.objects.count() == 0
+
+    # Unknown resources
+    policy.missed("https://example.com/modules")
+    assert Statistic.arc_target() == 0
+
+
+def test_arc_ghosts_limit(db, settings):
+    settings.RESOURCE_EVICTION_GHOSTS = 2
+    resources = [
+        Resource(url=f"https://example.com/{index}", usage=1) for index in range(4)
+    ]
+    ARC().evicted(resources)
+    assert Ghost.objects.count() == 2
+    assert Ghost.objects.filter(key=Ghost.key_for("https://example.com/3")).exists()
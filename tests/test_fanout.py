@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import threading
+import time
+
+import pytest
+
+from kiss_cache import inotify
+from kiss_cache.fanout import FANOUT, Tail
+from kiss_cache.models import Resource
+from kiss_cache.notify import DISPATCHER
+
+
+def create(tmpdir):
+    res = Resource.objects.create(
+        url="https://example.com/kernel",
+        content_length=11,
+        state=Resource.STATE_FINISHED,
+        status_code=200,
+    )
+    (tmpdir / res.path).write_text("hello world", encoding="utf-8", ensure=True)
+    return res
+
+
+def test_fanout(db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.STREAM_CHUNK_SIZE = 4
+    pread = mocker.spy(Tail, "_pread")
+    res = create(tmpdir)
+
+    first, second = res.stream(), res.stream()
+    assert next(first) == b"hell"
+    assert next(second) == b"hell"
+    assert FANOUT.tails[res.pk].readers == 2
+    assert list(first) == [b"o wo", b"rld"]
+    assert list(second) == [b"o wo", b"rld"]
+    # The file was only read once
+    assert [c.args[1] for c in pread.call_args_list] == [0, 4, 8, 11]
+    assert FANOUT.tails == {}
+
+
+def test_fanout_lagging(db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.STREAM_CHUNK_SIZE = 4
+    settings.STREAM_FANOUT_BUFFER_SIZE = 4
+    pread = mocker.spy(Tail, "_pread")
+    res = create(tmpdir)
+
+    first = res.stream()
+    assert next(first) == b"hell"
+    assert next(first) == b"o wo"
+    tail = FANOUT.tails[res.pk]
+    assert (tail.start, tail.end) == (4, 8)
+
+    # The beginning is not buffered anymore: read from the file
+    second = res.stream()
+    assert next(second) == b"hell"
+    assert next(second) == b"o wo"
+    assert [c.args[1] for c in pread.call_args_list] == [0, 4, 0]
+
+    assert list(first) == [b"rld"]
+    assert list(second) == [b"rld"]
+    assert FANOUT.tails == {}
+
+
+def test_fanout_watermark(db, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.NOTIFY_POLLING_INTERVAL = 0
+    settings.STREAM_CHUNK_SIZE = 4
+    res = create(tmpdir)
+    # Downloading by segments: only the first 6 bytes are valid
+    Resource.objects.filter(pk=res.pk).update(
+        state=Resource.STATE_DOWNLOADING, watermark=6
+    )
+    res.refresh_from_db()
+
+    stream = res.stream()
+    assert next(stream) == b"hell"
+    assert next(stream) == b"o "
+    assert FANOUT.tails[res.pk].end == 6
+
+    Resource.objects.filter(pk=res.pk).update(
+        state=Resource.STATE_FINISHED, watermark=None
+    )
+    assert list(stream) == [b"worl", b"d"]
+    assert FANOUT.tails == {}
+
+
+@pytest.mark.skipif(inotify._libc() is None, reason="inotify is not available")
+def test_fanout_closed(db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.NOTIFY_BACKEND = "redis"
+    settings.NOTIFY_TIMEOUT = 5
+    mocker.patch("kiss_cache.notify.start_listener")
+    res = Resource.objects.create(
+        url="https://example.com/kernel",
+        content_length=11,
+        state=Resource.STATE_DOWNLOADING,
+        status_code=200,
+    )
+    path = tmpdir / res.path
+    path.write_text("", encoding="utf-8", ensure=True)
+
+    with path.open("wb") as f_out:
+        f_out.write(b"hello")
+        f_out.flush()
+        stream = res.stream()
+        assert next(stream) == b"hello"
+        # Progress notification received before the file is closed
+        DISPATCHER.dispatch(res.pk, True)
+        f_out.write(b" world")
+    assert next(stream) == b" world"
+
+    # The writer closed the file: only wait for the state to change
+    Resource.objects.filter(pk=res.pk).update(state=Resource.STATE_FINISHED)
+    timer = threading.Timer(0.2, DISPATCHER.dispatch, (res.pk, False))
+    timer.start()
+    start = time.monotonic()
+    assert list(stream) == []
+    assert time.monotonic() - start < settings.NOTIFY_TIMEOUT / 2
+    timer.join()
+    assert FANOUT.tails == {}
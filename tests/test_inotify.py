@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from kiss_cache import inotify
+from kiss_cache.inotify import Watcher
+
+
+@pytest.mark.skipif(inotify._libc() is None, reason="inotify is not available")
+def test_watcher(tmpdir):
+    path = tmpdir / "file"
+    with path.open("wb") as f_out:
+        with Watcher(str(path)) as watcher:
+            assert watcher.fd is not None
+            # Nothing written
+            assert watcher.wait(0.01) is False
+
+            # Written in another thread
+            def write():
+                f_out.write(b"hello")
+                f_out.flush()
+
+            timer = threading.Timer(0.1, write)
+            timer.start()
+            assert watcher.wait(5) is True
+            timer.join()
+            assert watcher.wait(0.01) is False
+
+            # Closed by the writer
+            f_out.write(b" world")
+            f_out.flush()
+            f_out.close()
+            assert watcher.wait(5) is False
+            assert watcher.closed is True
+            # Not waiting anymore
+            start = time.monotonic()
+            assert watcher.wait(5) is False
+            assert time.monotonic() - start < 1
+    assert watcher.fd is None
+
+
+@pytest.mark.skipif(inotify._libc() is None, reason="inotify is not available")
+def test_watcher_async(tmpdir):
+    path = tmpdir / "file"
+
+    async def run(f_out, watcher):
+        assert await watcher.wait_async(0.01) is False
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, lambda: f_out.write(b"hello") and f_out.flush())
+        assert await watcher.wait_async(5) is True
+        assert await watcher.wait_async(0.01) is False
+        f_out.close()
+        return await watcher.wait_async(5)
+
+    with path.open("wb") as f_out:
+        with Watcher(str(path)) as watcher:
+            assert asyncio.run(run(f_out, watcher)) is False
+
+
+def test_watcher_without_inotify(monkeypatch, tmpdir):
+    monkeypatch.setattr(inotify, "_LIBC", [None])
+    path = tmpdir / "file"
+    path.write_text("hello", encoding="utf-8")
+    with Watcher(str(path)) as watcher:
+        assert watcher.fd is None
+        assert watcher.wait(10) is False
+        assert asyncio.run(watcher.wait_async(10)) is False
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+from datetime import timedelta
+import pytest
+
+from django.utils import timezone
+
+from kiss_cache.metadata import MetadataCache
+from kiss_cache.models import Resource
+
+
+def resource(pk, url, **kwargs):
+    kwargs.setdefault("state", Resource.STATE_FINISHED)
+    kwargs.setdefault("status_code", 200)
+    res = Resource(pk=pk, url=url, **kwargs)
+    res.expires_at = timezone.now() + timedelta(seconds=res.ttl)
+    return res
+
+
+@pytest.fixture(autouse=True)
+def listener(mocker, settings):
+    settings.NOTIFY_BACKEND = "redis"
+    return mocker.patch("kiss_cache.notify.start_listener")
+
+
+def test_metadata_cache(mocker, settings):
+    settings.METADATA_CACHE_SIZE = 2
+    settings.METADATA_CACHE_TIMEOUT = 60
+    cache = MetadataCache()
+    LONG = 7 * 24 * 3600
+    kernel = resource(1, "https://example.com/kernel")
+    dtb = resource(2, "https://example.com/dtb")
+    rootfs = resource(3, "https://example.com/rootfs")
+
+    assert cache.get(kernel.url, LONG) is None
+    cache.add(kernel)
+    cache.add(dtb)
+    assert cache.get(kernel.url, LONG) is kernel
+    # The least recently used resource is dropped
+    cache.add(rootfs)
+    assert cache.get(dtb.url, LONG) is None
+    assert cache.get(kernel.url, LONG) is kernel
+    assert cache.get(rootfs.url, LONG) is rootfs
+
+    # The database should be updated for shorter ttl
+    assert cache.get(kernel.url, 3600) is None
+    assert cache.get(kernel.url, LONG) is kernel
+
+    # Invalidation
+    cache.invalidate([1, 42])
+    assert cache.get(kernel.url, LONG) is None
+    assert cache.urls == {3: rootfs.url}
+
+    # Timeout
+    now = timezone.now() + timedelta(seconds=61)
+    mocker.patch("django.utils.timezone.now", lambda: now)
+    assert cache.get(rootfs.url, LONG) is None
+    assert cache.entries == {}
+    assert cache.urls == {}
+
+
+def test_metadata_cache_ignored(settings):
+    settings.METADATA_CACHE_SIZE = 10
+    cache = MetadataCache()
+    cache.add(resource(1, "https://example.com/1", state=Resource.STATE_DOWNLOADING))
+    cache.add(resource(2, "https://example.com/2", status_code=404))
+    assert cache.entries == {}
+
+    # Disabled
+    settings.METADATA_CACHE_SIZE = 0
+    cache.add(resource(3, "https://example.com/3"))
+    assert cache.entries == {}
+
+    # Without deletion notifications
+    settings.METADATA_CACHE_SIZE = 10
+    settings.NOTIFY_BACKEND = "polling"
+    cache.add(resource(4, "https://example.com/4"))
+    assert cache.entries == {}
+
+
+def test_metadata_cache_expired(mocker, settings):
+    settings.METADATA_CACHE_SIZE = 10
+    settings.METADATA_CACHE_TIMEOUT = 60
+    cache = MetadataCache()
+    kernel = resource(1, "https://example.com/kernel", ttl=30)
+    cache.add(kernel)
+    assert cache.get(kernel.url, 3600) is kernel
+
+    # The resource expired but was not deleted yet
+    now = timezone.now() + timedelta(seconds=31)
+    mocker.patch("django.utils.timezone.now", lambda: now)
+    assert cache.get(kernel.url, 3600) is None
+    assert cache.entries == {}
+
+
+def test_metadata_cache_hit(mocker, settings):
+    settings.METADATA_CACHE_SIZE = 10
+    settings.METADATA_CACHE_TIMEOUT = 60
+    cache = MetadataCache()
+    LONG = 7 * 24 * 3600
+    kernel = resource(1, "https://example.com/kernel")
+    cache.add(kernel)
+
+    # Adding the cached resource again does not delay the timeout
+    now = timezone.now() + timedelta(seconds=50)
+    mocker.patch("django.utils.timezone.now", lambda: now)
+    assert cache.get(kernel.url, LONG) is kernel
+    cache.add(kernel)
+    now += timedelta(seconds=11)
+    assert cache.get(kernel.url, LONG) is None
+
+    # A new resource for the same url is cached from now on
+    cache.add(kernel)
+    other = resource(2, kernel.url)
+    now += timedelta(seconds=50)
+    cache.add(other)
+    now += timedelta(seconds=20)
+    assert cache.get(kernel.url, LONG) is other
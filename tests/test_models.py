@@ -7,10 +7,17 @@
 #
 # SPDX-License-Identifier: MIT
 
+from datetime import timedelta
 import pytest
+import threading
 import time
 
-from kiss_cache.models import Resource
+from asgiref.sync import async_to_sync, sync_to_async
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from kiss_cache.models import STATISTICS, USAGES, Blob, Host, Resource, Statistic
 
 
 def test_resource_parse_ttl():
@@ -34,14 +41,28 @@ def test_resource_path(db):
     )
 
 
-def test_resource_total_size(db):
+def test_resource_digest(db):
+    # Signed urls can be longer than 512 characters
+    URL = "https://example.com/kernel?signature=" + "a" * 2048
+    res = Resource.objects.create(url=URL)
+    assert bytes(res.digest).hex() == res.path.replace("/", "")
+    assert Resource.get_by_url(URL) == res
+    assert Resource.get_by_url(URL).url == URL
+    with pytest.raises(Resource.DoesNotExist):
+        Resource.get_by_url("https://example.com/kernel")
+
+
+def test_resource_total_size_delete(db):
     assert Resource.total_size() == 0
 
     Resource.objects.create(url="http://example.com", content_length=4212)
     Resource.objects.create(url="http://example.org", content_length=5379)
-    Resource.objects.create(url="http://example.net", content_length=2)
+    res = Resource.objects.create(url="http://example.net", content_length=2)
     assert Resource.total_size() == 4212 + 5379 + 2
 
+    res.delete()
+    assert Resource.total_size() == 4212 + 5379
+
 
 def test_resource_total_size(db, settings):
     settings.RESOURCE_QUOTA = 12
@@ -76,6 +97,20 @@ def test_resource_progress(db, settings, tmpdir):
     assert res.progress() == 8
 
 
+def test_resource_open_link(db, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    res = Resource.objects.create(url="https://example.com")
+    (tmpdir / res.path).dirpath().ensure(dir=True)
+    (tmpdir / "blob").write_text("hello", encoding="utf-8")
+    (tmpdir / res.path).mklinkto(tmpdir / "blob")
+
+    # Writing to the resource never truncates the linked blob
+    with res.open(mode="wb") as f_out:
+        f_out.write(b"world")
+    assert (tmpdir / res.path).read_text(encoding="utf-8") == "world"
+    assert (tmpdir / "blob").read_text(encoding="utf-8") == "hello"
+
+
 def test_resource_stream(db, monkeypatch, settings, tmpdir):
     monkeypatch.setattr(time, "sleep", lambda d: d)
 
@@ -103,6 +138,105 @@ def test_resource_stream(db, monkeypatch, settings, tmpdir):
         next(it)
 
 
+def test_resource_stream_range(db, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.NOTIFY_TIMEOUT = 0.1
+    settings.NOTIFY_POLLING_INTERVAL = 0
+    res = Resource.objects.create(url="https://example.com/kernel", content_length=13)
+    (tmpdir / res.path).dirpath().ensure(dir=True)
+    with (tmpdir / res.path).open("wb") as f_out:
+        f_out.write(b"hello")
+        f_out.flush()
+
+        # Already on disk
+        assert b"".join(res.stream(1, 4)) == b"ell"
+
+        # Partially on disk: wait for the rest
+        it = res.stream(3, 13)
+        assert next(it) == b"lo"
+
+        def write():
+            f_out.write(b" world!!")
+            f_out.flush()
+
+        timer = threading.Timer(0.2, write)
+        timer.start()
+        assert b"".join(it) == b" world!!"
+        timer.join()
+
+    # Truncated
+    Resource.objects.filter(pk=res.pk).update(state=Resource.STATE_FINISHED)
+    res.refresh_from_db()
+    with pytest.raises(Exception, match="Range streamed is truncated: 13 vs 20"):
+        b"".join(res.stream(10, 20))
+
+    async def collect():
+        return [data async for data in res.stream_async(6, 11)]
+
+    assert b"".join(async_to_sync(collect)()) == b"world"
+
+
+def test_resource_stream_async(db, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.NOTIFY_TIMEOUT = 0.01
+    settings.NOTIFY_POLLING_INTERVAL = 0
+    res = Resource.objects.create(url="https://example.com/kernel", content_length=12)
+    path = tmpdir / res.path
+    path.dirpath().ensure(dir=True)
+
+    async def run(f_out):
+        it = res.stream_async()
+        assert await it.__anext__() == b"hello"
+        f_out.write(b" world")
+        f_out.flush()
+        assert await it.__anext__() == b" world"
+
+        await sync_to_async(Resource.objects.filter(pk=res.pk).update)(
+            state=Resource.STATE_FINISHED
+        )
+        f_out.write(b"!")
+        f_out.flush()
+        assert await it.__anext__() == b"!"
+        with pytest.raises(StopAsyncIteration):
+            await it.__anext__()
+
+    with path.open("wb") as f_out:
+        f_out.write(b"hello")
+        f_out.flush()
+        async_to_sync(run)(f_out)
+
+    # The resource is deleted while streaming
+    res = Resource.objects.create(url="https://example.com/dtb", content_length=13)
+    (tmpdir / res.path).write_text("hello", encoding="utf-8", ensure=True)
+
+    async def run_deleted():
+        it = res.stream_async()
+        assert await it.__anext__() == b"hello"
+        await sync_to_async(res.delete)()
+        with pytest.raises(Exception, match="deleted and streamed length is wrong"):
+            await it.__anext__()
+
+    async_to_sync(run_deleted)()
+
+
+def test_resource_stream_chunks(db, monkeypatch, settings, tmpdir):
+    monkeypatch.setattr(time, "sleep", lambda d: d)
+
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.STREAM_CHUNK_SIZE = 4
+    res = Resource.objects.create(
+        url="https://example.com/kernel",
+        content_length=11,
+        state=Resource.STATE_FINISHED,
+        status_code=200,
+    )
+    (tmpdir / "76").mkdir()
+    (
+        tmpdir / "76/66828e5a43fe3e8c06c2e62ad216cc354c91da92f093d6d8a7c3dc9d1baa82"
+    ).write_text("hello world", encoding="utf-8")
+    assert list(res.stream()) == [b"hell", b"o wo", b"rld"]
+
+
 def test_resource_stream_errors(db, monkeypatch, settings, tmpdir):
     monkeypatch.setattr(time, "sleep", lambda d: d)
 
@@ -222,3 +356,360 @@ def test_resource_stream_errors_5(db, monkeypatch, settings, tmpdir):
     # the length is good: no exception should be raised
     with pytest.raises(StopIteration):
         next(it)
+
+
+def test_statistic(db, settings):
+    assert Statistic.download() == 0
+    Statistic.download(10)
+    Statistic.download(32)
+    assert Statistic.download() == 42
+    assert Statistic.upload() == 0
+
+    # Each process writes to its own shard
+    settings.STATISTIC_SHARDS = 1
+    Statistic.download(8)
+    assert Statistic.download() == 50
+    assert Statistic.objects.filter(stat=Statistic.STAT_DOWNLOAD).count() in [1, 2]
+
+
+def test_statistic_write_behind(db, mocker, settings):
+    settings.STATISTIC_FLUSH_INTERVAL = 5
+    mocker.patch("threading.Thread.start")
+
+    Statistic.requests(1)
+    Statistic.requests(1)
+    Statistic.upload(42)
+    assert STATISTICS.data == {Statistic.STAT_REQUESTS: 2, Statistic.STAT_UPLOAD: 42}
+    assert Statistic.requests() == 0
+    assert Statistic.upload() == 0
+
+    STATISTICS.flush()
+    assert STATISTICS.data == {}
+    assert Statistic.requests() == 2
+    assert Statistic.upload() == 42
+
+    # Values are kept when the flush fails
+    Statistic.requests(3)
+    mocker.patch.object(STATISTICS, "flush_func", side_effect=Exception("db down"))
+    STATISTICS.flush()
+    assert STATISTICS.data == {Statistic.STAT_REQUESTS: 3}
+    STATISTICS.data = {}
+
+
+def test_resource_use(db, mocker, settings):
+    now = timezone.now()
+    mocker.patch("django.utils.timezone.now", lambda: now)
+    res1 = Resource.objects.create(url="https://example.com/kernel")
+    res2 = Resource.objects.create(url="https://example.com/dtb", usage=3)
+
+    # Written immediately
+    Resource.use(res1.pk)
+    res1.refresh_from_db()
+    assert res1.usage == 1
+    assert res1.last_usage == now
+
+    # Written in batches
+    settings.USAGE_FLUSH_INTERVAL = 5
+    mocker.patch("threading.Thread.start")
+    Resource.use(res1.pk)
+    Resource.use(res2.pk)
+    later = now + timedelta(seconds=2)
+    mocker.patch("django.utils.timezone.now", lambda: later)
+    Resource.use(res1.pk)
+    assert USAGES.data == {res1.pk: (2, later), res2.pk: (1, now)}
+    res1.refresh_from_db()
+    assert res1.usage == 1
+
+    USAGES.flush()
+    res1.refresh_from_db()
+    res2.refresh_from_db()
+    assert (res1.usage, res1.last_usage) == (3, later)
+    assert (res2.usage, res2.last_usage) == (4, now)
+
+
+def test_resource_expires_at(db, mocker):
+    now = timezone.now()
+    mocker.patch("django.utils.timezone.now", lambda: now)
+    res = Resource.objects.create(url="https://example.com/kernel", ttl=42)
+    assert res.expires_at == res.created_at + timedelta(seconds=42)
+    res.ttl = 60
+    res.save()
+    res.refresh_from_db()
+    assert res.expires_at == res.created_at + timedelta(seconds=60)
+
+
+@pytest.mark.parametrize("returning", [True, False])
+def test_resource_delete_batch(db, mocker, settings, tmpdir, returning):
+    mocker.patch("kiss_cache.models._can_return", lambda: returning)
+    now = timezone.now()
+    mocker.patch("django.utils.timezone.now", lambda: now)
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    for index in range(5):
+        Resource.objects.create(
+            url=f"https://example.com/{index}", content_length=index
+        )
+    res = Resource.objects.get(url="https://example.com/1")
+    (tmpdir / res.path).dirpath().ensure(dir=True)
+    (tmpdir / res.path).write_text("hello", encoding="utf-8")
+
+    query = Resource.objects.filter(content_length__gte=1).order_by("-content_length")
+    resources = Resource.delete_batch(query, 3)
+    # RETURNING does not guarantee the order
+    resources.sort(key=lambda r: r.url)
+    assert [r.url for r in resources] == [
+        "https://example.com/2",
+        "https://example.com/3",
+        "https://example.com/4",
+    ]
+    assert [r.content_length for r in resources] == [2, 3, 4]
+    assert resources[0].expires_at == resources[0].created_at + timedelta(days=1)
+
+    resources = Resource.delete_batch(query, 3)
+    assert [r.url for r in resources] == ["https://example.com/1"]
+    # The post_delete signal was sent
+    assert not (tmpdir / res.path).exists()
+
+    assert Resource.delete_batch(query, 3) == []
+    assert list(Resource.objects.values_list("url", flat=True)) == [
+        "https://example.com/0"
+    ]
+
+
+def test_resource_delete_batch_size(db, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    shared, other = b"\x01" * 32, b"\x02" * 32
+    Blob.objects.create(digest=shared, size=10, refs=2)
+    Blob.objects.create(digest=other, size=20, refs=2)
+    for index, digest in enumerate([shared, shared, other]):
+        Resource.objects.create(
+            url=f"https://example.com/{index}",
+            content_length=100,
+            content_digest=digest,
+            variants_length=index,
+        )
+    Resource.objects.create(url="https://example.com/3", content_length=5)
+    size = Statistic.size()
+
+    with CaptureQueriesContext(connection) as queries:
+        assert len(Resource.delete_batch(Resource.objects.all(), 10)) == 4
+    # The last reference to the shared blob was dropped
+    assert list(Blob.objects.values_list("size", "refs")) == [(20, 1)]
+    assert Statistic.size() == size - 10 - 5 - (0 + 1 + 2)
+    # The size is updated once for the whole batch
+    updates = [q["sql"] for q in queries if q["sql"].startswith("UPDATE")]
+    assert len([sql for sql in updates if "kiss_cache_statistic" in sql]) == 1
+
+
+def test_resource_get_or_create_with_ttl(db, mocker, django_assert_num_queries):
+    URL = "https://example.com/kernel"
+    now = timezone.now()
+    mocker.patch("django.utils.timezone.now", lambda: now)
+
+    res, created = Resource.get_or_create_with_ttl(URL, 3600)
+    assert created
+    assert res.url == URL
+    assert bytes(res.digest) == Resource.digest_for(URL)
+    assert res.ttl == 3600
+    assert res.state == Resource.STATE_SCHEDULED
+    assert res.created_at == now
+    assert res.expires_at == now + timedelta(hours=1)
+
+    # A longer ttl is ignored
+    later = now + timedelta(minutes=10)
+    mocker.patch("django.utils.timezone.now", lambda: later)
+    Resource.objects.filter(url=URL).update(
+        state=Resource.STATE_FINISHED, status_code=200, content_length=42
+    )
+    with django_assert_num_queries(1):
+        res, created = Resource.get_or_create_with_ttl(URL, 7200)
+    assert not created
+    assert res.state == Resource.STATE_FINISHED
+    assert res.status_code == 200
+    assert res.content_length == 42
+    assert res.ttl == 3600
+    assert res.expires_at == now + timedelta(hours=1)
+
+    # A shorter ttl is applied
+    with django_assert_num_queries(2):
+        res, created = Resource.get_or_create_with_ttl(URL, 60)
+    assert not created
+    assert res.ttl == 660
+    assert res.expires_at == later + timedelta(seconds=60)
+    res.refresh_from_db()
+    assert res.ttl == 660
+    assert res.expires_at == later + timedelta(seconds=60)
+    assert Resource.objects.count() == 1
+
+    # Same clock: only the first call creates the resource
+    Resource.objects.all().delete()
+    assert Resource.get_or_create_with_ttl(URL, 3600)[1]
+    assert not Resource.get_or_create_with_ttl(URL, 3600)[1]
+
+
+def test_resource_get_or_create_with_ttl_postgresql(db, mocker):
+    URL = "https://example.com/kernel"
+    now = timezone.now()
+    mocker.patch("django.utils.timezone.now", lambda: now)
+    existing = Resource.objects.create(url=URL, ttl=60, status_code=200)
+    fields = [f.attname for f in Resource._meta.concrete_fields]
+    row = Resource.objects.filter(pk=existing.pk).values_list(*fields).get()
+
+    # Single statement, returning the row and whether it was inserted
+    mocker.patch.object(connection, "vendor", "postgresql")
+    cursor = mocker.MagicMock()
+    cursor.fetchone.return_value = row + (False,)
+    context = mocker.patch.object(connection, "cursor").return_value
+    context.__enter__.return_value = cursor
+    res, created = Resource.get_or_create_with_ttl(URL, 3600)
+    assert created is False
+    assert res.pk == existing.pk
+    assert res.url == URL
+    assert res.ttl == 60
+    assert res.status_code == 200
+    assert res.expires_at == now + timedelta(seconds=60)
+
+    assert cursor.execute.call_count == 1
+    sql, params = cursor.execute.call_args.args
+    assert sql.startswith('INSERT INTO "kiss_cache_resource" (')
+    assert "ON CONFLICT (digest) DO UPDATE SET" in sql
+    assert "EXTRACT(EPOCH FROM EXCLUDED.created_at" in sql
+    assert sql.endswith('("kiss_cache_resource".xmax = 0)')
+    assert sql.count("%s") == len(params) == len(fields) - 1
+    assert URL in params
+    assert 3600 in params
+
+    cursor.fetchone.return_value = row + (True,)
+    assert Resource.get_or_create_with_ttl(URL, 3600)[1] is True
+
+
+def test_resource_claim(db):
+    first = Resource.objects.create(url="https://example.com/1")
+    second = Resource.objects.create(url="https://example.com/2", waiting=3)
+    Resource.objects.create(url="https://example.com/3", waiting=5, queue="large")
+    Resource.objects.create(
+        url="https://example.com/4", waiting=7, state=Resource.STATE_DOWNLOADING
+    )
+
+    # Most waiting clients first, by queue
+    res = Resource.claim("", "task-1")
+    assert res.pk == second.pk
+    assert res.claimed_by == "task-1"
+    assert res.claimed_at is not None
+    assert Resource.objects.get(pk=second.pk).claimed_by == "task-1"
+    assert Resource.claim("").pk == first.pk
+    assert Resource.claim("") is None
+    assert Resource.claim("large").url == "https://example.com/3"
+    assert Resource.claim("large") is None
+    assert Resource.objects.filter(claimed=True).count() == 3
+
+
+def test_resource_host(db):
+    res = Resource.objects.create(url="https://user@Example.com:8080/kernel")
+    assert res.host == "example.com:8080"
+    res, _ = Resource.get_or_create_with_ttl("https://example.org/rootfs", 42)
+    assert Resource.objects.get(pk=res.pk).host == "example.org"
+
+
+def test_resource_claim_host_limit(db, settings):
+    settings.HOST_LIMIT_INITIAL = 2
+    for index in range(3):
+        Resource.objects.create(url=f"https://example.com/{index}", waiting=1)
+    other = Resource.objects.create(url="https://example.org/kernel")
+
+    # Two downloads at most from example.com
+    assert Resource.claim("").host == "example.com"
+    assert Resource.claim("").host == "example.com"
+    assert Resource.claim("").pk == other.pk
+    assert Resource.claim("") is None
+    assert Host.objects.get(name="example.com").limit == 2
+
+    # A download is done
+    Resource.objects.filter(url="https://example.com/0").update(
+        state=Resource.STATE_FINISHED
+    )
+    assert Resource.claim("").url == "https://example.com/2"
+    assert Resource.claim("") is None
+
+    # The worker of a download died: its slot is released
+    Resource.objects.filter(url="https://example.com/1").update(
+        claimed_at=timezone.now() - timedelta(seconds=settings.FETCH_CLAIM_TIMEOUT + 1)
+    )
+    Resource.objects.create(url="https://example.com/3")
+    assert Resource.claim("").url == "https://example.com/3"
+
+
+def test_host_feedback(db, settings):
+    settings.HOST_LIMIT_INITIAL = 4
+    settings.HOST_LIMIT_MAX = 5
+    settings.HOST_LIMIT_MIN_SIZE = 100
+
+    # Additive increase
+    Host.feedback("example.com")
+    assert Host.objects.get(name="example.com").limit == 4.25
+    # Multiplicative decrease
+    Host.feedback("example.com", error=True)
+    assert Host.objects.get(name="example.com").limit == 2.125
+
+    # Throughput
+    Host.feedback("example.com", 1000, 1)
+    host = Host.objects.get(name="example.com")
+    assert host.throughput == 1000
+    assert host.limit == pytest.approx(2.125 + 1 / 2.125)
+    limit = host.limit
+    Host.feedback("example.com", 400, 1)
+    host = Host.objects.get(name="example.com")
+    assert host.throughput == 880
+    assert host.limit == limit / 2
+
+    # Bounds
+    for _ in range(10):
+        Host.feedback("example.com", error=True)
+    assert Host.objects.get(name="example.com").limit == settings.HOST_LIMIT_MIN
+    for _ in range(100):
+        Host.feedback("example.com")
+    assert Host.objects.get(name="example.com").limit == 5
+
+
+def test_resource_counts(db, django_assert_num_queries):
+    assert Resource.counts() == {
+        "scheduled": 0,
+        "downloading": 0,
+        "successes": 0,
+        "failures": 0,
+        "usage": 0,
+    }
+    Resource.objects.create(url="https://example.com/1", usage=2)
+    Resource.objects.create(
+        url="https://example.com/2", state=Resource.STATE_DOWNLOADING
+    )
+    for index, status_code in enumerate([200, 200, 404]):
+        Resource.objects.create(
+            url=f"https://example.com/{index + 3}",
+            state=Resource.STATE_FINISHED,
+            status_code=status_code,
+            usage=index,
+        )
+    with django_assert_num_queries(1):
+        assert Resource.counts() == {
+            "scheduled": 1,
+            "downloading": 1,
+            "successes": 2,
+            "failures": 1,
+            "usage": 5,
+        }
+
+
+def test_statistic_snapshot(db, django_assert_num_queries):
+    Statistic.download(42)
+    Statistic.requests(2)
+    Statistic.objects.create(stat=Statistic.STAT_REQUESTS, shard=99, value=3)
+    with django_assert_num_queries(1):
+        assert Statistic.snapshot() == {
+            Statistic.STAT_DOWNLOAD: 42,
+            Statistic.STAT_UPLOAD: 0,
+            Statistic.STAT_SUCCESSES: 0,
+            Statistic.STAT_FAILURES: 0,
+            Statistic.STAT_REQUESTS: 5,
+            Statistic.STAT_SIZE: 0,
+            Statistic.STAT_ARC_TARGET: 0,
+        }
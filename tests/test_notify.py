@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from kiss_cache import notify
+from kiss_cache.models import Resource
+from kiss_cache.notify import DISPATCHER, subscribe
+
+
+def test_subscribe_polling(monkeypatch, settings):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    settings.NOTIFY_BACKEND = "polling"
+    settings.NOTIFY_POLLING_INTERVAL = 2
+
+    with subscribe(42) as subscription:
+        assert subscription.wait() is True
+        assert subscription.wait() is True
+    assert sleeps == [2, 2]
+    assert 42 not in DISPATCHER.subscribers
+
+    # Nothing is published
+    notify.notify(42)
+
+
+def test_subscribe_events(mocker, settings):
+    settings.NOTIFY_BACKEND = "redis"
+    settings.NOTIFY_TIMEOUT = 10
+    start_listener = mocker.patch("kiss_cache.notify.start_listener")
+
+    with subscribe(42) as subscription:
+        assert start_listener.call_count == 1
+        assert DISPATCHER.subscribers[42] == 1
+
+        # Notifications for other resources are ignored
+        DISPATCHER.dispatch(43, False)
+        assert 43 not in DISPATCHER.subscribers
+
+        # A notification sent before waiting is not lost
+        DISPATCHER.dispatch(42, True)
+        assert subscription.wait() is False
+        DISPATCHER.dispatch(42, False)
+        assert subscription.wait() is True
+
+        # Notification from another thread
+        timer = threading.Timer(0.1, DISPATCHER.dispatch, args=(42, False))
+        timer.start()
+        start = time.monotonic()
+        assert subscription.wait() is True
+        assert time.monotonic() - start < 5
+        timer.join()
+
+        # Timeout
+        settings.NOTIFY_TIMEOUT = 0.01
+        assert subscription.wait() is True
+    assert 42 not in DISPATCHER.subscribers
+
+
+def test_subscribe_events_async(mocker, settings):
+    settings.NOTIFY_BACKEND = "redis"
+    settings.NOTIFY_TIMEOUT = 10
+    mocker.patch("kiss_cache.notify.start_listener")
+
+    async def run(subscription):
+        # A notification sent before waiting is not lost
+        DISPATCHER.dispatch(42, True)
+        assert await subscription.wait_async() is False
+
+        # Notification from the listener thread
+        timer = threading.Timer(0.1, DISPATCHER.dispatch, args=(42, False))
+        timer.start()
+        start = time.monotonic()
+        assert await subscription.wait_async() is True
+        assert time.monotonic() - start < 5
+        timer.join()
+        assert DISPATCHER.futures[42] == set()
+
+        # Timeout
+        settings.NOTIFY_TIMEOUT = 0.01
+        assert await subscription.wait_async() is True
+
+    with subscribe(42) as subscription:
+        asyncio.run(run(subscription))
+    assert 42 not in DISPATCHER.futures
+
+    # Polling
+    settings.NOTIFY_BACKEND = "polling"
+    settings.NOTIFY_POLLING_INTERVAL = 0.01
+    with subscribe(42) as subscription:
+        assert asyncio.run(subscription.wait_async()) is True
+
+
+def test_notify(mocker, settings):
+    publish = mocker.Mock()
+    mocker.patch(
+        "kiss_cache.notify._redis_client", lambda: mocker.Mock(publish=publish)
+    )
+    settings.NOTIFY_BACKEND = "redis"
+    notify.notify(42)
+    notify.notify(42, progress=True)
+    assert publish.call_args_list == [
+        mocker.call("kiss_cache", "42"),
+        mocker.call("kiss_cache", "42:progress"),
+    ]
+
+    # Errors are only logged
+    publish.side_effect = ConnectionError("redis is down")
+    notify.notify(42)
+
+    settings.NOTIFY_BACKEND = "unknown"
+    with pytest.raises(NotImplementedError, match="Unknown notify backend"):
+        notify.notify(42)
+
+
+def test_parse():
+    assert notify._parse("42") == (42, False)
+    assert notify._parse(b"42:progress") == (42, True)
+
+
+def test_notify_deleted(mocker, settings):
+    publish = mocker.Mock()
+    mocker.patch(
+        "kiss_cache.notify._redis_client", lambda: mocker.Mock(publish=publish)
+    )
+    invalidate = mocker.patch("kiss_cache.notify.METADATA.invalidate")
+    settings.NOTIFY_BACKEND = "redis"
+    notify.notify_deleted(list(range(1, 1002)))
+    assert invalidate.call_args_list == [mocker.call(list(range(1, 1002)))]
+    assert [c[0][1] for c in publish.call_args_list] == [
+        "deleted:" + ",".join(str(pk) for pk in range(1, 501)),
+        "deleted:" + ",".join(str(pk) for pk in range(501, 1001)),
+        "deleted:1001",
+    ]
+
+    # Deletions of the block are sent at once
+    publish.reset_mock()
+    with notify.batch_deletions():
+        notify.notify_deleted([1])
+        with notify.batch_deletions():
+            notify.notify_deleted([2, 3])
+        assert publish.call_args_list == []
+    assert [c[0][1] for c in publish.call_args_list] == ["deleted:1,2,3"]
+
+    # Handle the notifications
+    invalidate.reset_mock()
+    dispatch = mocker.patch("kiss_cache.notify.DISPATCHER.dispatch")
+    notify._handle(b"deleted:4,2")
+    notify._handle("42:progress")
+    assert invalidate.call_args_list == [mocker.call([4, 2])]
+    assert dispatch.call_args_list == [mocker.call(42, True)]
+
+
+def test_notify_deleted_signal(db, mocker, settings):
+    publish = mocker.Mock()
+    mocker.patch(
+        "kiss_cache.notify._redis_client", lambda: mocker.Mock(publish=publish)
+    )
+    settings.NOTIFY_BACKEND = "redis"
+    first = Resource.objects.create(url="https://example.com/1")
+    second = Resource.objects.create(url="https://example.com/2")
+    third = Resource.objects.create(url="https://example.com/3")
+
+    # Single deletions (admin, ...)
+    pk = first.pk
+    first.delete()
+    assert [c[0][1] for c in publish.call_args_list] == [f"deleted:{pk}"]
+
+    # Batches
+    publish.reset_mock()
+    Resource.delete_batch(Resource.objects.order_by("pk"), 10)
+    assert [c[0][1] for c in publish.call_args_list] == [
+        f"deleted:{second.pk},{third.pk}"
+    ]
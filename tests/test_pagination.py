@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+from datetime import timedelta
+
+import pytest
+
+from django.utils import timezone
+
+from kiss_cache.models import Resource
+from kiss_cache.pagination import InvalidCursor, KeysetPaginator
+
+
+def walk(paginator):
+    """Walk forward then backward, returning the urls of each page"""
+    pages = [paginator.page()]
+    while pages[-1].has_next():
+        pages.append(paginator.page(after=pages[-1].next_cursor))
+    assert not pages[0].has_previous()
+
+    backward = [pages[-1]]
+    while backward[-1].has_previous():
+        backward.append(paginator.page(before=backward[-1].previous_cursor))
+    assert [p.object_list for p in backward[::-1]] == [p.object_list for p in pages]
+    return [[res.url[-1] for res in page] for page in pages]
+
+
+@pytest.mark.parametrize(
+    "order,expected",
+    [
+        ("url", ["abc", "def", "g"]),
+        ("-url", ["gfe", "dcb", "a"]),
+        # Ties are sorted by pk
+        ("usage", ["ace", "bdf", "g"]),
+        ("-usage", ["gfd", "bec", "a"]),
+        ("last_usage", ["gfe", "dcb", "a"]),
+        ("-last_usage", ["abc", "def", "g"]),
+        # NULL values are last in ascending order
+        ("content_length", ["adg", "bce", "f"]),
+        ("-content_length", ["fec", "bgd", "a"]),
+    ],
+)
+def test_keyset_paginator(db, order, expected):
+    now = timezone.now()
+    for index, name in enumerate("abcdefg"):
+        Resource.objects.create(
+            url=f"https://example.com/{name}",
+            usage=index % 2 if index < 6 else 3,
+            last_usage=now - timedelta(minutes=index),
+            content_length=None if index % 3 else index,
+        )
+    paginator = KeysetPaginator(Resource.objects.all(), order, 3)
+    assert walk(paginator) == [list(page) for page in expected]
+
+
+def test_keyset_paginator_errors(db):
+    paginator = KeysetPaginator(Resource.objects.all(), "-last_usage", 3)
+    page = paginator.page()
+    assert page.object_list == []
+    assert not page.has_next()
+    assert not page.has_previous()
+
+    for cursor in ["!!", "bm90IGpzb24=", "WzFd", "WyJub3cnIiwgMV0="]:
+        with pytest.raises(InvalidCursor):
+            paginator.page(after=cursor)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+#
+# Copyright 2019 Linaro Limited
+#
+# Author: Rémi Duraffort <remi.duraffort@linaro.org>
+#
+# SPDX-License-Identifier: MIT
+
+import requests
+
+from django.urls import reverse
+
+from kiss_cache.models import Resource
+from kiss_cache.scheduler import probe, queue_for, schedule
+
+
+class Response:
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+    def close(self):
+        pass
+
+
+def test_probe(mocker, settings):
+    head = mocker.patch(
+        "requests.head", return_value=Response(200, {"Content-Length": "42"})
+    )
+    assert probe("https://example.com") == 42
+    assert head.call_args[0] == ("https://example.com",)
+    assert head.call_args[1]["allow_redirects"] is True
+    assert head.call_args[1]["timeout"] == settings.FETCH_PROBE_TIMEOUT
+
+    head.return_value = Response(200, {})
+    assert probe("https://example.com") is None
+    head.return_value = Response(404, {"Content-Length": "42"})
+    assert probe("https://example.com") is None
+    head.side_effect = requests.ConnectionError()
+    assert probe("https://example.com") is None
+
+
+def test_queue_for(mocker, settings):
+    head = mocker.patch("requests.head")
+    # Disabled by default
+    assert queue_for("https://example.com") == ""
+    assert head.call_count == 0
+
+    settings.FETCH_LARGE_QUEUE = "large"
+    settings.FETCH_LARGE_SIZE = 100
+    head.return_value = Response(200, {"Content-Length": "100"})
+    assert queue_for("https://example.com") == "large"
+    head.return_value = Response(200, {"Content-Length": "99"})
+    assert queue_for("https://example.com") == ""
+    head.return_value = Response(200, {})
+    assert queue_for("https://example.com") == ""
+
+
+def test_schedule(db, mocker, settings):
+    settings.FETCH_LARGE_QUEUE = "large"
+    settings.FETCH_LARGE_SIZE = 100
+    delay = mocker.patch("kiss_cache.tasks.fetch.delay")
+    apply_async = mocker.patch("kiss_cache.tasks.fetch.apply_async")
+    head = mocker.patch(
+        "requests.head", return_value=Response(200, {"Content-Length": "100"})
+    )
+
+    res = Resource.objects.create(url="https://example.com/large")
+    schedule(res)
+    apply_async.assert_called_once_with(("https://example.com/large",), queue="large")
+    assert Resource.objects.get(pk=res.pk).queue == "large"
+
+    head.return_value = Response(200, {"Content-Length": "10"})
+    res = Resource.objects.create(url="https://example.com/small")
+    schedule(res)
+    delay.assert_called_once_with("https://example.com/small")
+    assert Resource.objects.get(pk=res.pk).queue == ""
+
+
+def test_api_fetch_waiting(client, db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.NOTIFY_POLLING_INTERVAL = 0
+    URL = "https://example.com"
+
+    def mocked_fetch(url):
+        res = Resource.get_by_url(url)
+        assert res.waiting == 0
+        Resource.objects.filter(pk=res.pk).update(
+            state=Resource.STATE_FINISHED, status_code=404
+        )
+
+    mocker.patch("kiss_cache.tasks.fetch.delay", mocked_fetch)
+    ret = client.get(f"{reverse('api.fetch')}?url={URL}")
+    assert ret.status_code == 404
+    # The resource was not scheduled anymore
+    assert Resource.get_by_url(URL).waiting == 0
+
+    # Clients waiting for a scheduled resource are counted
+    res = Resource.objects.create(url="https://example.com/2")
+    subscribe = mocker.patch("kiss_cache.views.subscribe")
+    subscribe.return_value.__enter__.return_value.wait.side_effect = (
+        lambda: Resource.objects.filter(pk=res.pk).update(
+            state=Resource.STATE_FINISHED, status_code=404
+        )
+    )
+    ret = client.get(f"{reverse('api.fetch')}?url=https://example.com/2")
+    assert ret.status_code == 404
+    assert Resource.objects.get(pk=res.pk).waiting == 1
@@ -8,19 +8,35 @@
 # SPDX-License-Identifier: MIT
 
 from datetime import timedelta
+import gzip
+import hashlib
+import io
 import logging
+import os
+import pytest
 import requests
+from requests.packages.urllib3.exceptions import ProtocolError
 
 from django.utils import timezone
 
 from kiss_cache.__about__ import __version__
-from kiss_cache.models import Resource, Statistic
-from kiss_cache.tasks import expire, fetch
+from kiss_cache.models import Blob, Host, Resource, Statistic
+from kiss_cache.tasks import (
+    _checksum,
+    _iter_raw,
+    _watermark,
+    encode,
+    evict,
+    expire,
+    fetch,
+)
 
 
 def test_fetch(caplog, db, mocker, settings, tmpdir):
     caplog.set_level(logging.DEBUG)
     settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.DOWNLOAD_CHUNK_SIZE = 1
+    settings.NOTIFY_PROGRESS_INTERVAL = 0
 
     Resource.objects.create(url="https://example.com")
 
@@ -28,10 +44,7 @@ def test_fetch(caplog, db, mocker, settings, tmpdir):
         status_code = 200
         headers = {"Content-Length": 10, "Content-Type": "text/html; charset=UTF-8"}
 
-        def iter_content(self, chunk_size, decode_unicode):
-            assert chunk_size == settings.DOWNLOAD_CHUNK_SIZE
-            assert decode_unicode is False
-            return [b"h", b"e", b"l", b"l", b"o", b" ", b"w", b"o", b"r", b"l"]
+        raw = io.BytesIO(b"hello worl")
 
         def close(self):
             pass
@@ -61,7 +74,7 @@ def test_fetch(caplog, db, mocker, settings, tmpdir):
     assert res.state == Resource.STATE_FINISHED
     assert res.content_type == "text/html; charset=UTF-8"
     assert res.content_length == 10
-    assert Statistic.objects.get(stat=Statistic.STAT_DOWNLOAD).value == 10
+    assert Statistic.download() == 10
     assert caplog.record_tuples == [
         ("kiss_cache.tasks", 20, "Fetching 'https://example.com'"),
         ("kiss_cache.tasks", 20, "progress  10% (0MB)"),
@@ -81,6 +94,8 @@ def test_fetch(caplog, db, mocker, settings, tmpdir):
 def test_fetch_no_content_length(caplog, db, mocker, settings, tmpdir):
     caplog.set_level(logging.DEBUG)
     settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.DOWNLOAD_CHUNK_SIZE = 1
+    settings.NOTIFY_PROGRESS_INTERVAL = 0
 
     Resource.objects.create(url="https://example.com")
 
@@ -88,10 +103,7 @@ def test_fetch_no_content_length(caplog, db, mocker, settings, tmpdir):
         status_code = 200
         headers = {"Content-Type": "text/html; charset=UTF-8"}
 
-        def iter_content(self, chunk_size, decode_unicode):
-            assert chunk_size == settings.DOWNLOAD_CHUNK_SIZE
-            assert decode_unicode is False
-            return [b"h", b"e", b"l", b"l", b"o", b" ", b"w", b"o", b"r", b"l"]
+        raw = io.BytesIO(b"hello worl")
 
         def close(self):
             pass
@@ -121,7 +133,7 @@ def test_fetch_no_content_length(caplog, db, mocker, settings, tmpdir):
     assert res.state == Resource.STATE_FINISHED
     assert res.content_type == "text/html; charset=UTF-8"
     assert res.content_length == 10
-    assert Statistic.objects.get(stat=Statistic.STAT_DOWNLOAD).value == 10
+    assert Statistic.download() == 10
     assert caplog.record_tuples == [
         ("kiss_cache.tasks", 20, "Fetching 'https://example.com'"),
         ("kiss_cache.tasks", 20, "0MB downloaded in 0.00s (??MB/s)"),
@@ -249,6 +261,91 @@ def test_fetch_errors_3(caplog, db, mocker, settings, tmpdir):
     ]
 
 
+def test_fetch_segments(db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.DOWNLOAD_SEGMENTS = 3
+    settings.DOWNLOAD_CHUNK_SIZE = 2
+    settings.DOWNLOAD_SEGMENTS_MIN_SIZE = 11
+    settings.NOTIFY_PROGRESS_INTERVAL = 0.01
+
+    Resource.objects.create(url="https://example.com")
+    content = b"hello world"
+    ranges = []
+
+    class Response:
+        def __init__(self, status_code, data):
+            self.status_code = status_code
+            self.raw = io.BytesIO(data)
+            self.headers = {
+                "Accept-Ranges": "bytes",
+                "Content-Length": str(len(data)),
+                "Content-Type": "text/plain",
+            }
+
+        def close(self):
+            pass
+
+    class RequestRetry:
+        def get(self, url, stream, headers, timeout):
+            assert url == "https://example.com"
+            if "Range" not in headers:
+                return Response(200, content)
+            ranges.append(headers["Range"])
+            start, end = headers["Range"][len("bytes=") :].split("-")
+            return Response(206, content[int(start) : int(end) + 1])
+
+    mocker.patch("kiss_cache.tasks.requests_retry", RequestRetry)
+
+    fetch("https://example.com")
+    assert sorted(ranges) == ["bytes=0-2", "bytes=3-6", "bytes=7-10"]
+    res = Resource.objects.get(url="https://example.com")
+    assert (tmpdir / res.path).read_binary() == content
+    assert res.state == Resource.STATE_FINISHED
+    assert res.status_code == 200
+    assert res.content_length == 11
+    assert res.watermark is None
+    assert bytes(res.content_digest) == hashlib.sha256(content).digest()
+    assert Statistic.download() == 11
+    assert Statistic.successes() == 1
+
+
+def test_fetch_segments_errors(db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.DOWNLOAD_SEGMENTS = 2
+    settings.DOWNLOAD_SEGMENTS_MIN_SIZE = 11
+
+    Resource.objects.create(url="https://example.com")
+
+    class Response:
+        # Range requests are ignored
+        status_code = 200
+        headers = {"Accept-Ranges": "bytes", "Content-Length": "11"}
+
+        def close(self):
+            pass
+
+    class RequestRetry:
+        def get(self, url, stream, headers, timeout):
+            return Response()
+
+    mocker.patch("kiss_cache.tasks.requests_retry", RequestRetry)
+
+    fetch("https://example.com")
+    res = Resource.objects.get(url="https://example.com")
+    assert res.state == Resource.STATE_FINISHED
+    assert res.status_code == 504
+    assert Statistic.failures() == 1
+
+
+def test_watermark():
+    bounds = [0, 3, 7, 11]
+    assert _watermark(bounds, [0, 0, 0]) == 0
+    assert _watermark(bounds, [2, 4, 0]) == 2
+    assert _watermark(bounds, [3, 2, 4]) == 5
+    assert _watermark(bounds, [3, 4, 2]) == 9
+    assert _watermark(bounds, [3, 4, 4]) == 11
+
+
 def test_expire(caplog, db, mocker, settings, tmpdir):
     now = timezone.now()
     mocker.patch("django.utils.timezone.now", lambda: now)
@@ -304,13 +401,44 @@ def test_expire(caplog, db, mocker, settings, tmpdir):
         status_code=404,
     )
 
+    # Downloads lost with their worker
+    lost = Resource.objects.create(
+        url="https://example.com/lost",
+        state=Resource.STATE_DOWNLOADING,
+        watermark=4,
+        claimed=True,
+        claimed_by="task-1",
+        claimed_at=now - timedelta(seconds=settings.FETCH_CLAIM_TIMEOUT + 1),
+        queue="large",
+    )
+    Resource.objects.create(
+        url="https://example.com/running",
+        state=Resource.STATE_DOWNLOADING,
+        claimed=True,
+        claimed_at=now - timedelta(seconds=settings.FETCH_CLAIM_TIMEOUT - 1),
+    )
+    apply_async = mocker.patch("kiss_cache.tasks.fetch.apply_async")
+    delay = mocker.patch("kiss_cache.tasks.evict.delay")
+
     assert Resource.total_size() == 150
     expire()
 
     assert (
         Resource.objects.filter(url="https://example.com/nfsrootfs.tar.gz").count() == 0
     )
-    assert Resource.objects.filter(url="https://example.com/ramdisk").count() == 0
+    # Evicting is left to its own task
+    assert Resource.objects.filter(url="https://example.com/ramdisk").count() == 1
+    assert delay.call_count == 1
+    lost.refresh_from_db()
+    assert lost.state == Resource.STATE_SCHEDULED
+    assert lost.watermark is None
+    assert not lost.claimed
+    assert lost.claimed_by == ""
+    assert lost.claimed_at is None
+    assert apply_async.call_args_list == [
+        mocker.call(("https://example.com/lost",), queue="large")
+    ]
+    assert Resource.objects.filter(claimed=True).count() == 1
     assert caplog.record_tuples == [
         ("kiss_cache.tasks", 20, "Removing failed resources"),
         ("kiss_cache.tasks", 20, "* 'https://example.com/rootfs.img.bz2'"),
@@ -318,14 +446,671 @@ def test_expire(caplog, db, mocker, settings, tmpdir):
         ("kiss_cache.tasks", 20, "Expiring resources"),
         ("kiss_cache.tasks", 20, "* 'https://example.com/nfsrootfs.tar.gz'"),
         ("kiss_cache.tasks", 20, "done"),
+        ("kiss_cache.tasks", 20, "Scheduling the lost downloads again"),
+        ("kiss_cache.tasks", 20, "* 'https://example.com/lost'"),
+        ("kiss_cache.tasks", 20, "done"),
+    ]
+
+
+def test_expire_batches(caplog, db, mocker, settings, tmpdir):
+    now = timezone.now()
+    mocker.patch("django.utils.timezone.now", lambda: now)
+    caplog.set_level(logging.DEBUG)
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.RESOURCE_EXPIRE_BATCH_SIZE = 2
+
+    for index in range(5):
+        Resource.objects.create(
+            url=f"https://example.com/{index}",
+            created_at=now,
+            ttl=60,
+            state=Resource.STATE_FINISHED,
+            status_code=200,
+        )
+    Resource.objects.filter(url="https://example.com/1").update(
+        expires_at=now - timedelta(seconds=1)
+    )
+    Resource.objects.exclude(url="https://example.com/1").update(
+        expires_at=now - timedelta(seconds=2)
+    )
+    Resource.objects.filter(url="https://example.com/0").update(expires_at=now)
+    lost = Resource.objects.create(
+        url="https://example.com/lost",
+        state=Resource.STATE_DOWNLOADING,
+        claimed=True,
+        claimed_at=now - timedelta(seconds=settings.FETCH_CLAIM_TIMEOUT + 1),
+    )
+    apply_async = mocker.patch("kiss_cache.tasks.fetch.apply_async")
+    delay = mocker.patch("kiss_cache.tasks.evict.delay")
+
+    # No time left
+    settings.RESOURCE_EXPIRE_TIME_BUDGET = 0
+    expire()
+    assert Resource.objects.count() == 6
+    assert apply_async.call_count == 0
+    assert delay.call_count == 1
+    assert (
+        "kiss_cache.tasks",
+        30,
+        "* Time budget exhausted, resuming on next run",
+    ) in caplog.record_tuples
+
+    settings.RESOURCE_EXPIRE_TIME_BUDGET = 45
+    expire()
+    assert list(Resource.objects.values_list("url", flat=True)) == [
+        "https://example.com/0",
+        "https://example.com/lost",
+    ]
+    assert apply_async.call_count == 1
+    assert delay.call_count == 2
+
+
+def test_evict(caplog, db, mocker, settings, tmpdir):
+    now = timezone.now()
+    mocker.patch("django.utils.timezone.now", lambda: now)
+    caplog.set_level(logging.DEBUG)
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.RESOURCE_QUOTA = 100
+    settings.RESOURCE_QUOTA_AUTO_CLEAN = 75
+    settings.RESOURCE_QUOTA_AUTO_CLEAN_LOW = 50
+
+    for index in range(8):
+        Resource.objects.create(
+            url=f"https://example.com/{index}",
+            content_length=10,
+            state=Resource.STATE_FINISHED,
+            status_code=200,
+            last_usage=now - timedelta(days=1, seconds=index),
+        )
+    assert Resource.total_size() == 80
+
+    # Evict down to the low watermark, least recently used first
+    evict()
+    assert Resource.total_size() == 50
+    assert sorted(Resource.objects.values_list("url", flat=True)) == [
+        "https://example.com/0",
+        "https://example.com/1",
+        "https://example.com/2",
+        "https://example.com/3",
+        "https://example.com/4",
+    ]
+    assert caplog.record_tuples == [
         ("kiss_cache.tasks", 20, "Checking quota usage"),
         (
             "kiss_cache.tasks",
             20,
-            "* Cleaning by last usage (100\xa0bytes > 45\xa0bytes)",
+            "* Cleaning by last usage (80\xa0bytes > 75\xa0bytes)",
         ),
-        ("kiss_cache.tasks", 20, "  - 30\xa0bytes: 'https://example.com/ramdisk'"),
-        ("kiss_cache.tasks", 20, "* No more resources to clean"),
-        ("kiss_cache.tasks", 20, "* Usage: 70\xa0bytes"),
+        ("kiss_cache.tasks", 20, "  - 10\xa0bytes: 'https://example.com/7'"),
+        ("kiss_cache.tasks", 20, "  - 10\xa0bytes: 'https://example.com/6'"),
+        ("kiss_cache.tasks", 20, "  - 10\xa0bytes: 'https://example.com/5'"),
+        ("kiss_cache.tasks", 20, "* Usage: 50\xa0bytes"),
         ("kiss_cache.tasks", 20, "done"),
     ]
+
+    # Nothing to do below the high watermark
+    caplog.clear()
+    evict()
+    assert Resource.total_size() == 50
+    assert caplog.record_tuples == [
+        ("kiss_cache.tasks", 20, "Checking quota usage"),
+        ("kiss_cache.tasks", 20, "* Usage: 50\xa0bytes"),
+        ("kiss_cache.tasks", 20, "done"),
+    ]
+
+
+def test_evict_shared_blob(db, mocker, settings, tmpdir):
+    now = timezone.now()
+    mocker.patch("django.utils.timezone.now", lambda: now)
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.RESOURCE_QUOTA = 100
+    settings.RESOURCE_QUOTA_AUTO_CLEAN = 75
+    settings.RESOURCE_QUOTA_AUTO_CLEAN_LOW = 50
+
+    # Two resources sharing the same content
+    digest = hashlib.sha256(b"shared").digest()
+    Blob.objects.create(digest=digest, size=20, refs=2)
+    for index in range(2):
+        Resource.objects.create(
+            url=f"https://example.com/shared/{index}",
+            content_length=20,
+            content_digest=digest,
+            state=Resource.STATE_FINISHED,
+            status_code=200,
+            last_usage=now - timedelta(days=2, seconds=index),
+        )
+    Statistic.size(-20)
+    for index in range(6):
+        Resource.objects.create(
+            url=f"https://example.com/{index}",
+            content_length=10,
+            state=Resource.STATE_FINISHED,
+            status_code=200,
+            last_usage=now - timedelta(days=1, seconds=index),
+        )
+    assert Resource.total_size() == 80
+
+    # Only the second deletion frees the blob
+    evict()
+    assert Resource.total_size() == 50
+    assert not Blob.objects.exists()
+    assert Resource.objects.count() == 5
+    assert not Resource.objects.filter(url__contains="/shared/").exists()
+
+
+def test_evict_compressed(db, mocker, settings, tmpdir):
+    now = timezone.now()
+    mocker.patch("django.utils.timezone.now", lambda: now)
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.RESOURCE_QUOTA = 100
+    settings.RESOURCE_QUOTA_AUTO_CLEAN = 75
+    settings.RESOURCE_QUOTA_AUTO_CLEAN_LOW = 50
+
+    # Compressed resources, with variants
+    for index in range(8):
+        Resource.objects.create(
+            url=f"https://example.com/{index}",
+            content_length=100,
+            stored_length=5,
+            variants="gzip",
+            variants_length=5,
+            state=Resource.STATE_FINISHED,
+            status_code=200,
+            last_usage=now - timedelta(days=1, seconds=index),
+        )
+    Statistic.size(8 * (5 + 5 - 100))
+    assert Resource.total_size() == 80
+
+    # Each eviction frees 10 bytes
+    evict()
+    assert Resource.total_size() == 50
+    assert Resource.objects.count() == 5
+
+
+def test_fetch_evict(db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.RESOURCE_QUOTA = 12
+    Resource.objects.create(url="https://example.com")
+
+    class Response:
+        status_code = 200
+        headers = {"Content-Length": "10"}
+
+        raw = io.BytesIO(b"hello worl")
+
+        def close(self):
+            pass
+
+    class RequestRetry:
+        def get(self, url, stream, headers, timeout):
+            return Response()
+
+    mocker.patch("kiss_cache.tasks.requests_retry", lambda: RequestRetry())
+    delay = mocker.patch("kiss_cache.tasks.evict.delay")
+
+    # The high watermark is crossed as soon as the size is known
+    fetch("https://example.com")
+    assert Resource.total_size() == 10
+    assert delay.call_count == 1
+
+
+def test_iter_raw(mocker, settings):
+    settings.DOWNLOAD_CHUNK_SIZE = 2
+    settings.DOWNLOAD_CHUNK_MAX_SIZE = 8
+    settings.NOTIFY_PROGRESS_INTERVAL = 4
+
+    class Response:
+        raw = io.BytesIO(b"0123456789abcdefghijklmnopqrstuvwxyz")
+
+    # Fast reads: the buffer grows up to the maximum
+    mocker.patch("time.monotonic", return_value=0)
+    chunks = [bytes(data) for data in _iter_raw(Response())]
+    assert chunks == [b"01", b"2345", b"6789abcd", b"efghijkl", b"mnopqrst", b"uvwxyz"]
+
+    # Slow reads: the buffer shrinks
+    Response.raw = io.BytesIO(b"0123456789abcdefghij")
+    times = [0, 0, 0, 0, 0, 5, 0, 5, 0, 0, 0]
+    mocker.patch("time.monotonic", side_effect=times)
+    chunks = [bytes(data) for data in _iter_raw(Response())]
+    assert chunks == [b"01", b"2345", b"6789abcd", b"efgh", b"ij"]
+
+
+def test_fetch_most_waiting_first(caplog, db, mocker, settings, tmpdir):
+    caplog.set_level(logging.DEBUG)
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    Resource.objects.create(url="https://example.com/1")
+    Resource.objects.create(url="https://example.com/2", waiting=2)
+
+    class Response:
+        status_code = 200
+        headers = {"Content-Length": "5"}
+        raw = io.BytesIO(b"hello")
+
+        def close(self):
+            pass
+
+    class RequestRetry:
+        def get(self, url, stream, headers, timeout):
+            urls.append(url)
+            return Response()
+
+    urls = []
+    mocker.patch("kiss_cache.tasks.requests_retry", RequestRetry)
+
+    # The task of the first resource fetches the second one
+    fetch("https://example.com/1")
+    assert urls == ["https://example.com/2"]
+    assert caplog.record_tuples[:2] == [
+        ("kiss_cache.tasks", 20, "Fetching 'https://example.com/1'"),
+        (
+            "kiss_cache.tasks",
+            20,
+            "Fetching 'https://example.com/2' first (2 waiting clients)",
+        ),
+    ]
+    assert Resource.get_by_url("https://example.com/2").state == Resource.STATE_FINISHED
+
+    # And the other way around
+    Response.raw = io.BytesIO(b"hello")
+    fetch("https://example.com/2")
+    assert urls == ["https://example.com/2", "https://example.com/1"]
+    assert Resource.get_by_url("https://example.com/1").state == Resource.STATE_FINISHED
+
+    # Nothing left
+    caplog.clear()
+    fetch("https://example.com/1")
+    assert caplog.record_tuples == [
+        ("kiss_cache.tasks", 20, "Fetching 'https://example.com/1'"),
+        ("kiss_cache.tasks", 20, "No resource left to fetch"),
+    ]
+
+
+def test_fetch_host_busy(caplog, db, mocker, settings):
+    caplog.set_level(logging.DEBUG)
+    settings.HOST_LIMIT_INITIAL = 1
+    Resource.objects.create(
+        url="https://example.com/1",
+        state=Resource.STATE_DOWNLOADING,
+        claimed=True,
+        claimed_at=timezone.now(),
+    )
+    Resource.objects.create(url="https://example.com/2")
+    apply_async = mocker.patch("kiss_cache.tasks.fetch.apply_async")
+
+    fetch("https://example.com/2")
+    apply_async.assert_called_once_with(
+        ("https://example.com/2",),
+        queue=None,
+        countdown=settings.HOST_LIMIT_RETRY_DELAY,
+    )
+    assert caplog.record_tuples == [
+        ("kiss_cache.tasks", 20, "Fetching 'https://example.com/2'"),
+        ("kiss_cache.tasks", 20, "Upstream servers are busy, retrying in 5s"),
+    ]
+    assert not Resource.get_by_url("https://example.com/2").claimed
+
+
+def test_fetch_redelivered(caplog, db, mocker, settings, tmpdir):
+    caplog.set_level(logging.DEBUG)
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    URL = "https://example.com/kernel"
+    Resource.objects.create(url=URL)
+
+    class Response:
+        status_code = 200
+        headers = {"Content-Length": "5"}
+        raw = io.BytesIO(b"hello")
+
+        def close(self):
+            pass
+
+    class RequestRetry:
+        def get(self, url, stream, headers, timeout):
+            urls.append(url)
+            return Response()
+
+    urls = []
+    mocker.patch("kiss_cache.tasks.requests_retry", RequestRetry)
+
+    # The worker dies while downloading
+    res = Resource.claim("", "task-1")
+    Resource.objects.filter(pk=res.pk).update(
+        state=Resource.STATE_DOWNLOADING, watermark=3
+    )
+
+    # Another task can't claim it
+    fetch.push_request(id="task-2", delivery_info={"redelivered": True})
+    try:
+        fetch.run(URL)
+    finally:
+        fetch.pop_request()
+    assert urls == []
+    assert Resource.get_by_url(URL).state == Resource.STATE_DOWNLOADING
+
+    # The task is delivered again
+    caplog.clear()
+    fetch.push_request(id="task-1", delivery_info={"redelivered": True})
+    try:
+        fetch.run(URL)
+    finally:
+        fetch.pop_request()
+    assert urls == [URL]
+    assert caplog.record_tuples[:2] == [
+        ("kiss_cache.tasks", 20, f"Fetching '{URL}'"),
+        ("kiss_cache.tasks", 30, f"Fetching '{URL}' again (task redelivered)"),
+    ]
+    res = Resource.get_by_url(URL)
+    assert res.state == Resource.STATE_FINISHED
+    assert res.watermark is None
+    assert res.claimed_by == "task-1"
+    assert (tmpdir / res.path).read_binary() == b"hello"
+
+    # Finished resources are not fetched again
+    fetch.push_request(id="task-1", delivery_info={"redelivered": True})
+    try:
+        fetch.run(URL)
+    finally:
+        fetch.pop_request()
+    assert urls == [URL]
+
+
+def test_fetch_host_feedback(db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    Resource.objects.create(url="https://example.com/1")
+    Resource.objects.create(url="https://example.com/2")
+
+    class Response:
+        status_code = 503
+        headers = {}
+
+        def close(self):
+            pass
+
+    class RequestRetry:
+        def get(self, url, stream, headers, timeout):
+            return Response()
+
+    mocker.patch("kiss_cache.tasks.requests_retry", RequestRetry)
+    fetch("https://example.com/1")
+    assert Host.objects.get(name="example.com").limit == 2
+
+    Response.status_code = 404
+    fetch("https://example.com/2")
+    assert Host.objects.get(name="example.com").limit == 2.5
+
+
+@pytest.mark.parametrize("returning", [True, False])
+def test_fetch_deduplicate(db, mocker, returning, settings, tmpdir):
+    mocker.patch("kiss_cache.models._can_return", lambda: returning)
+    settings.DOWNLOAD_PATH = str(tmpdir)
+
+    class Response:
+        status_code = 200
+        headers = {"Content-Length": "11", "Content-Type": "text/plain"}
+
+        def __init__(self):
+            self.raw = io.BytesIO(b"hello world")
+
+        def close(self):
+            pass
+
+    class RequestRetry:
+        def get(self, url, stream, headers, timeout):
+            return Response()
+
+    mocker.patch("kiss_cache.tasks.requests_retry", RequestRetry)
+
+    urls = ["https://example.com/a", "https://mirror.example.com/a"]
+    for url in urls:
+        Resource.objects.create(url=url)
+        fetch(url)
+
+    first, second = [Resource.objects.get(url=url) for url in urls]
+    digest = hashlib.sha256(b"hello world").digest()
+    assert bytes(first.content_digest) == digest
+    assert bytes(second.content_digest) == digest
+    blob = Blob.objects.get()
+    assert bytes(blob.digest) == digest
+    assert blob.size == 11
+    assert blob.refs == 2
+
+    # Both files are links to the blob
+    path = tmpdir / Blob.path_for(digest)
+    assert path.read_binary() == b"hello world"
+    assert path.stat().ino == (tmpdir / first.path).stat().ino
+    assert path.stat().ino == (tmpdir / second.path).stat().ino
+    assert Resource.total_size() == 11
+    assert Statistic.download() == 22
+
+    # The blob is removed along with the last resource
+    Resource.delete_batch(Resource.objects.filter(url=urls[0]), 1)
+    assert not (tmpdir / first.path).exists()
+    assert path.exists()
+    assert Blob.objects.get().refs == 1
+    assert Resource.total_size() == 11
+
+    Resource.delete_batch(Resource.objects.filter(url=urls[1]), 1)
+    assert not (tmpdir / second.path).exists()
+    assert not path.exists()
+    assert Blob.objects.count() == 0
+    assert Resource.total_size() == 0
+
+
+def test_fetch_deduplicate_disabled(db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.RESOURCE_DEDUPLICATION = False
+
+    class Response:
+        status_code = 200
+        headers = {"Content-Length": "5", "Content-Type": "text/plain"}
+        raw = io.BytesIO(b"hello")
+
+        def close(self):
+            pass
+
+    class RequestRetry:
+        def get(self, url, stream, headers, timeout):
+            return Response()
+
+    mocker.patch("kiss_cache.tasks.requests_retry", RequestRetry)
+    sha256 = mocker.patch("kiss_cache.tasks.hashlib.sha256", wraps=hashlib.sha256)
+
+    res = Resource.objects.create(url="https://example.com")
+    fetch("https://example.com")
+    res.refresh_from_db()
+    # The content is not hashed, only the url
+    assert mocker.call() not in sha256.call_args_list
+    assert res.content_digest is None
+    assert Blob.objects.count() == 0
+    assert (tmpdir / res.path).read_binary() == b"hello"
+
+
+def test_checksum(settings):
+    text = Resource(content_type="text/plain")
+    gzip = Resource(content_type="application/gzip")
+    assert _checksum(text) is not None
+    assert _checksum(gzip) is not None
+
+    # The digest of the compressed file is used
+    settings.RESOURCE_COMPRESSION = "zstd"
+    assert _checksum(text) is None
+    assert _checksum(gzip) is not None
+
+    settings.RESOURCE_DEDUPLICATION = False
+    assert _checksum(gzip) is None
+
+
+def test_fetch_compression(db, mocker, settings, tmpdir):
+    pytest.importorskip("zstandard")
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.RESOURCE_COMPRESSION = "zstd"
+    settings.RESOURCE_COMPRESSION_FRAME_SIZE = 1000
+    content = b"".join(b"line %d\n" % index for index in range(1000))
+
+    class Response:
+        status_code = 200
+
+        def __init__(self, content_type):
+            self.headers = {
+                "Content-Length": str(len(content)),
+                "Content-Type": content_type,
+            }
+            self.raw = io.BytesIO(content)
+
+        def close(self):
+            pass
+
+    class RequestRetry:
+        def get(self, url, stream, headers, timeout):
+            if url.endswith(".gz"):
+                return Response("application/gzip")
+            return Response("text/plain")
+
+    mocker.patch("kiss_cache.tasks.requests_retry", RequestRetry)
+
+    res = Resource.objects.create(url="https://example.com/log.txt")
+    plain = res.fullpath
+    fetch(res.url)
+    res.refresh_from_db()
+    assert res.state == Resource.STATE_FINISHED
+    assert res.compression == "zstd"
+    assert res.path.endswith(".zst")
+    assert res.content_length == len(content)
+    assert res.stored_length == (tmpdir / res.path).size()
+    assert res.stored_length < len(content)
+    assert not os.path.exists(plain)
+    assert b"".join(res.stream()) == content
+    # The quota counts the compressed bytes
+    assert Resource.total_size() == res.stored_length
+    assert Statistic.download() == len(content)
+
+    # Not a compressible content type
+    other = Resource.objects.create(url="https://example.com/log.gz")
+    fetch(other.url)
+    other.refresh_from_db()
+    assert other.compression == ""
+    assert other.stored_length is None
+    assert (tmpdir / other.path).read_binary() == content
+    assert Resource.total_size() == res.stored_length + len(content)
+
+    Resource.delete_batch(Resource.objects.filter(pk=res.pk), 1)
+    assert not (tmpdir / res.path).exists()
+    assert Resource.total_size() == len(content)
+
+
+def test_encode(caplog, db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.RESOURCE_VARIANTS = ["gzip"]
+    content = b"".join(b"line %d\n" % index for index in range(1000))
+
+    class Response:
+        status_code = 200
+        headers = {"Content-Length": str(len(content)), "Content-Type": "text/plain"}
+
+        def __init__(self):
+            self.raw = io.BytesIO(content)
+
+        def close(self):
+            pass
+
+    class RequestRetry:
+        def get(self, url, stream, headers, timeout):
+            return Response()
+
+    mocker.patch("kiss_cache.tasks.requests_retry", RequestRetry)
+    delay = mocker.patch("kiss_cache.tasks.encode.delay")
+
+    res = Resource.objects.create(url="https://example.com/log.txt")
+    fetch(res.url)
+    delay.assert_called_once_with(res.url)
+
+    encode(res.url)
+    res.refresh_from_db()
+    assert res.variants == "gzip"
+    assert res.encodings() == ["gzip"]
+    path = tmpdir / res.encoded_path("gzip")
+    assert str(path).endswith(".gz")
+    assert gzip.decompress(path.read_binary()) == content
+    assert res.variants_length == path.size()
+    assert Resource.total_size() == len(content) + path.size()
+
+    # Already encoded
+    encode(res.url)
+    assert Resource.objects.get(pk=res.pk).variants == "gzip"
+
+    # The variants are removed with the resource
+    Resource.delete_batch(Resource.objects.filter(pk=res.pk), 1)
+    assert not path.exists()
+    assert Resource.total_size() == 0
+
+    # Not worth it
+    settings.RESOURCE_COMPRESSION_MAX_RATIO = 0.01
+    res = Resource.objects.create(url="https://example.com/log.txt")
+    fetch(res.url)
+    encode(res.url)
+    res.refresh_from_db()
+    assert res.variants == ""
+    assert not (tmpdir / res.encoded_path("gzip")).exists()
+    assert not (tmpdir / (res.encoded_path("gzip") + ".tmp")).exists()
+
+
+def test_fetch_encoded(db, mocker, settings, tmpdir):
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.DOWNLOAD_ENCODINGS = ["gzip"]
+    settings.DOWNLOAD_CHUNK_SIZE = 16
+    mocker.patch("time.sleep")
+    content = b"".join(b"line %d\n" % index for index in range(1000))
+    encoded = gzip.compress(content)
+    requests = []
+
+    class Raw:
+        """Return the first half of the data and then fail"""
+
+        def __init__(self, data, fail):
+            self.data = io.BytesIO(data)
+            self.fail = fail
+
+        def readinto(self, buffer):
+            if self.fail and self.data.tell() >= len(encoded) // 2:
+                raise ProtocolError("Connection broken")
+            return self.data.readinto(buffer)
+
+    class Response:
+        def __init__(self, status_code, data, fail):
+            self.status_code = status_code
+            self.raw = Raw(data, fail)
+            self.headers = {
+                "Content-Encoding": "gzip",
+                "Content-Length": str(len(data)),
+                "Content-Type": "text/plain",
+            }
+
+        def close(self):
+            pass
+
+    class RequestRetry:
+        def get(self, url, stream, headers, timeout):
+            requests.append(headers.copy())
+            if "Range" not in headers:
+                return Response(200, encoded, True)
+            start = int(headers["Range"][len("bytes=") : -1])
+            return Response(206, encoded[start:], False)
+
+    mocker.patch("kiss_cache.tasks.requests_retry", RequestRetry)
+
+    res = Resource.objects.create(url="https://example.com/log.txt")
+    fetch(res.url)
+    assert requests[0]["Accept-Encoding"] == "gzip"
+    assert "Range" not in requests[0]
+    # The range is relative to the encoded content
+    assert len(requests) == 2
+    start = int(requests[1]["Range"][len("bytes=") : -1])
+    assert len(encoded) // 2 <= start < len(encoded)
+
+    res.refresh_from_db()
+    assert res.state == Resource.STATE_FINISHED
+    assert res.status_code == 200
+    assert res.content_length == len(content)
+    assert (tmpdir / res.path).read_binary() == content
+    assert Statistic.download() == len(content)
+    assert Resource.total_size() == len(content)
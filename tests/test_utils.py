@@ -7,6 +7,10 @@
 #
 # SPDX-License-Identifier: MIT
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import socket
+import threading
+
 import pytest
 import requests
 from requests.adapters import HTTPAdapter
@@ -16,9 +20,14 @@ from django.http import HttpResponseForbidden
 
 import kiss_cache
 from kiss_cache.utils import (
+    DNS,
+    _reset_session,
+    accepted_encodings,
     check_client_ip,
     get_user_ip,
     is_client_allowed,
+    parse_ranges,
+    preferred_encoding,
     requests_retry,
 )
 
@@ -84,3 +93,145 @@ def test_requests_retry(settings):
     assert r.connect == settings.DOWNLOAD_RETRY
     assert r.status == settings.DOWNLOAD_RETRY
     assert r.backoff_factor == settings.DOWNLOAD_BACKOFF_FACTOR
+
+
+def test_requests_retry_shared(settings):
+    _reset_session()
+    session = requests_retry()
+    assert requests_retry() is session
+    # The forked processes should create their own session
+    _reset_session()
+    assert requests_retry() is not session
+
+
+def test_requests_retry_pool_sizes(settings):
+    settings.DOWNLOAD_POOL_SIZES = {"images.example.com": 20}
+    _reset_session()
+    manager = requests_retry().adapters["http://"].poolmanager
+    assert manager.connection_from_host("images.example.com").pool.maxsize == 20
+    assert (
+        manager.connection_from_host("example.com").pool.maxsize
+        == settings.DOWNLOAD_POOL_SIZE
+    )
+    _reset_session()
+
+
+def test_dns_cache(mocker, settings):
+    DNS.clear()
+    getaddrinfo = mocker.patch(
+        "socket.getaddrinfo",
+        return_value=[(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.1", 80))],
+    )
+    assert DNS.resolve("example.com", 80) == "10.0.0.1"
+    assert DNS.resolve("example.com", 80) == "10.0.0.1"
+    assert getaddrinfo.call_count == 1
+
+    # Expired or invalidated entries are resolved again
+    settings.DOWNLOAD_DNS_CACHE_TIMEOUT = -1
+    DNS.invalidate("example.com")
+    assert DNS.resolve("example.com", 80) == "10.0.0.1"
+    assert DNS.resolve("example.com", 80) == "10.0.0.1"
+    assert getaddrinfo.call_count == 3
+
+    # Resolution errors are raised by urllib3
+    getaddrinfo.side_effect = socket.gaierror("unknown host")
+    assert DNS.resolve("unknown.example.com", 80) == "unknown.example.com"
+
+    settings.DOWNLOAD_DNS_CACHE_SIZE = 0
+    assert DNS.resolve("example.com", 80) == "example.com"
+    DNS.clear()
+
+
+def test_requests_retry_keep_alive(mocker, settings):
+    clients = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            clients.append(self.client_address)
+            self.send_response(200)
+            self.send_header("Content-Length", "5")
+            self.send_header("Set-Cookie", "session=secret")
+            self.end_headers()
+            self.wfile.write(b"hello")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _reset_session()
+    getaddrinfo = mocker.spy(socket, "getaddrinfo")
+    try:
+        url = f"http://localhost:{server.server_address[1]}/"
+        for _ in range(3):
+            req = requests_retry().get(url, stream=True, timeout=5)
+            assert req.raw.read() == b"hello"
+            req.close()
+        # Cookies are never stored
+        assert len(requests_retry().cookies) == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+        _reset_session()
+    # A single connection and a single resolution
+    assert len(clients) == 3
+    assert len(set(clients)) == 1
+    assert [c.args[0] for c in getaddrinfo.call_args_list].count("localhost") == 1
+
+
+def test_accepted_encodings(rf):
+    request = rf.get("/", HTTP_ACCEPT_ENCODING="gzip, br;q=0.5, zstd;q=0, x;q=bad")
+    assert accepted_encodings(request) == {"gzip": 1.0, "br": 0.5, "zstd": 0, "x": 0}
+    assert preferred_encoding(request, ["zstd", "br", "gzip"]) == "gzip"
+    # The plain content is preferred to br
+    assert preferred_encoding(request, ["zstd", "br"]) == ""
+    assert preferred_encoding(request, ["zstd"]) == ""
+    assert preferred_encoding(request, []) == ""
+
+    request = rf.get("/", HTTP_ACCEPT_ENCODING="gzip, br, zstd")
+    assert preferred_encoding(request, ["zstd", "br", "gzip"]) == "zstd"
+    assert preferred_encoding(request, ["br", "gzip"]) == "br"
+    request = rf.get("/", HTTP_ACCEPT_ENCODING="*")
+    assert preferred_encoding(request, ["br", "gzip"]) == "br"
+    assert preferred_encoding(rf.get("/"), ["gzip"]) == ""
+
+    # Quality of the plain content
+    request = rf.get("/", HTTP_ACCEPT_ENCODING="gzip;q=0.1, identity")
+    assert preferred_encoding(request, ["gzip"]) == ""
+    request = rf.get("/", HTTP_ACCEPT_ENCODING="gzip;q=0.1, identity;q=0")
+    assert preferred_encoding(request, ["gzip"]) == "gzip"
+    request = rf.get("/", HTTP_ACCEPT_ENCODING="gzip;q=0.1, *;q=0")
+    assert preferred_encoding(request, ["gzip"]) == "gzip"
+    request = rf.get("/", HTTP_ACCEPT_ENCODING="br;q=0.5, *;q=0.5")
+    assert preferred_encoding(request, ["br", "gzip"]) == ""
+
+
+def test_parse_ranges(rf):
+    def ranges(header, **kwargs):
+        return parse_ranges(rf.get("/", HTTP_RANGE=header, **kwargs), 100)
+
+    assert parse_ranges(rf.get("/"), 100) is None
+    assert ranges("bytes=0-9") == [(0, 10)]
+    assert ranges("bytes=90-") == [(90, 100)]
+    assert ranges("bytes=90-200") == [(90, 100)]
+    assert ranges("bytes=-10") == [(90, 100)]
+    assert ranges("bytes=-200") == [(0, 100)]
+    assert ranges("bytes=0-0, 10-19,-5") == [(0, 1), (10, 20), (95, 100)]
+    # Coalesced and sorted
+    assert ranges("bytes=" + ",".join(["0-"] * 100)) == [(0, 100)]
+    assert ranges("bytes=50-59,0-9,5-14,15-19") == [(0, 20), (50, 60)]
+    assert ranges("bytes=-10,0-9") == [(0, 10), (90, 100)]
+    # Not satisfiable
+    assert ranges("bytes=100-") == []
+    assert ranges("bytes=-0") == []
+    assert ranges("bytes=200-300, 0-9") == [(0, 10)]
+    # Invalid or ignored
+    assert ranges("items=0-9") is None
+    assert ranges("bytes=9-0") is None
+    assert ranges("bytes=a-b") is None
+    assert ranges("bytes=10") is None
+    assert ranges("bytes=0-9", HTTP_IF_RANGE="Wed, 21 Oct 2015 07:28:00 GMT") is None
+    assert ranges("bytes=" + ",".join(["0-0"] * 101)) is None
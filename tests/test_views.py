@@ -8,14 +8,22 @@
 # SPDX-License-Identifier: MIT
 
 import json
+import pytest
 
+from asgiref.sync import async_to_sync
+
+from django.core.cache import cache
 from django.http import FileResponse, HttpResponse, JsonResponse
 from django.http.response import StreamingHttpResponse
+from django.test import AsyncRequestFactory
 from django.urls import reverse
 from django.utils import timezone
 
 from kiss_cache.__about__ import __version__
-from kiss_cache.models import Resource, Statistic
+from kiss_cache.compression import compress
+from kiss_cache.metadata import METADATA
+from kiss_cache.models import STATISTICS, USAGES, Resource, Statistic
+from kiss_cache.views import api_fetch_async
 
 
 def test_index(client):
@@ -102,7 +110,6 @@ def test_resources(client, db):
     assert ret.templates[0].name == "kiss_cache/resources.html"
     assert ret.templates[1].name == "kiss_cache/base.html"
     assert len(ret.context["resources"].object_list) == 0
-    assert ret.context["resources"].number == 1
     assert ret.context["state"] == "successes"
     assert ret.context["url_name"] == "resources.successes"
     assert ret.context["scheduled_count"] == 0
@@ -141,7 +148,6 @@ def test_resources(client, db):
     assert ret.templates[1].name == "kiss_cache/base.html"
     assert len(ret.context["resources"].object_list) == 1
     assert ret.context["resources"].object_list[0].url == "http://example.com/1"
-    assert ret.context["resources"].number == 1
     assert ret.context["state"] == "scheduled"
     assert ret.context["url_name"] == "resources.scheduled"
     assert ret.context["scheduled_count"] == 1
@@ -155,7 +161,6 @@ def test_resources(client, db):
     assert ret.templates[1].name == "kiss_cache/base.html"
     assert len(ret.context["resources"].object_list) == 1
     assert ret.context["resources"].object_list[0].url == "http://example.com/2"
-    assert ret.context["resources"].number == 1
     assert ret.context["state"] == "downloading"
     assert ret.context["url_name"] == "resources.downloading"
     assert ret.context["scheduled_count"] == 1
@@ -169,7 +174,6 @@ def test_resources(client, db):
     assert ret.templates[1].name == "kiss_cache/base.html"
     assert len(ret.context["resources"].object_list) == 1
     assert ret.context["resources"].object_list[0].url == "http://example.com/3"
-    assert ret.context["resources"].number == 1
     assert ret.context["state"] == "successes"
     assert ret.context["url_name"] == "resources.successes"
     assert ret.context["scheduled_count"] == 1
@@ -183,7 +187,6 @@ def test_resources(client, db):
     assert ret.templates[1].name == "kiss_cache/base.html"
     assert len(ret.context["resources"].object_list) == 1
     assert ret.context["resources"].object_list[0].url == "http://example.com/4"
-    assert ret.context["resources"].number == 1
     assert ret.context["state"] == "failures"
     assert ret.context["url_name"] == "resources.failures"
     assert ret.context["scheduled_count"] == 1
@@ -196,6 +199,35 @@ def test_resources(client, db):
     assert ret.status_code == 400
     ret = client.get(reverse("resources.failures") + "10/")
     assert ret.status_code == 404
+    ret = client.get(reverse("resources.failures") + "?after=WzFd")
+    assert ret.status_code == 400
+
+
+def test_resources_pages(client, db):
+    for index in range(30):
+        Resource.objects.create(
+            url=f"http://example.com/{index:02}", state=Resource.STATE_SCHEDULED
+        )
+    ret = client.get(reverse("resources.scheduled") + "?order=-url")
+    page = ret.context["resources"]
+    assert [r.url[-2:] for r in page][:2] == ["29", "28"]
+    assert len(page) == 25
+    assert not page.has_previous()
+    assert f"?after={page.next_cursor}&amp;order=-url" in ret.content.decode()
+
+    ret = client.get(
+        reverse("resources.scheduled") + f"?after={page.next_cursor}&order=-url"
+    )
+    page = ret.context["resources"]
+    assert [r.url[-2:] for r in page] == ["04", "03", "02", "01", "00"]
+    assert not page.has_next()
+
+    ret = client.get(
+        reverse("resources.scheduled") + f"?before={page.previous_cursor}&order=-url"
+    )
+    page = ret.context["resources"]
+    assert len(page) == 25
+    assert page.object_list[0].url == "http://example.com/29"
 
 
 def test_api_health(client, mocker, settings, tmpdir):
@@ -354,3 +386,326 @@ def test_api_status(client, db):
     assert data["statistics_requests"] == 0
     assert data["version"] == __version__
     assert "timestamp" in data
+
+
+def test_api_fetch_metadata_cache(
+    client, db, django_assert_num_queries, mocker, settings, tmpdir
+):
+    URL = "https://example.com"
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.METADATA_CACHE_SIZE = 10
+    settings.NOTIFY_BACKEND = "redis"
+    mocker.patch("kiss_cache.notify.start_listener")
+    publish = mocker.patch("kiss_cache.notify._publish")
+    METADATA.clear()
+    res = Resource.objects.create(
+        url=URL,
+        state=Resource.STATE_FINISHED,
+        status_code=200,
+        content_type="text/plain",
+    )
+
+    ret = client.get(f"{reverse('api.fetch')}?url={URL}&ttl=42d")
+    assert ret.status_code == 200
+    assert ret["X-Accel-Redirect"] == f"/internal/{res.path}"
+
+    # Served from the cache (usage and statistics are written later)
+    settings.STATISTIC_FLUSH_INTERVAL = 3600
+    settings.USAGE_FLUSH_INTERVAL = 3600
+    with django_assert_num_queries(0):
+        ret = client.get(f"{reverse('api.fetch')}?url={URL}&ttl=42d")
+    assert ret.status_code == 200
+    assert ret["X-Accel-Redirect"] == f"/internal/{res.path}"
+    assert ret["content-type"] == "text/plain"
+    USAGES.flush()
+    STATISTICS.flush()
+    assert Resource.objects.get(pk=res.pk).usage == 2
+    assert Statistic.requests() == 2
+
+    # Deleted resources are dropped from the cache
+    Resource.delete_batch(Resource.objects.filter(pk=res.pk), 1)
+    assert METADATA.get(URL, 3600) is None
+    assert publish.call_args_list == [mocker.call(f"deleted:{res.pk}")]
+    METADATA.clear()
+
+
+def test_api_status_snapshot(client, db, django_assert_num_queries, settings):
+    settings.SNAPSHOT_CACHE_TIMEOUT = 60
+    cache.clear()
+    with django_assert_num_queries(2):
+        ret = client.get(reverse("api.status"))
+    assert json.loads(ret.content)["resources_scheduled"] == 0
+
+    # The snapshot is shared with the other views
+    Resource.objects.create(url="https://example.com")
+    with django_assert_num_queries(0):
+        ret = client.get(reverse("api.status"))
+    assert json.loads(ret.content)["resources_scheduled"] == 0
+    ret = client.get(reverse("statistics"))
+    assert ret.context["scheduled_count"] == 0
+
+    cache.clear()
+    ret = client.get(reverse("api.status"))
+    assert json.loads(ret.content)["resources_scheduled"] == 1
+
+
+def test_api_fetch_async(db, mocker, settings, tmpdir):
+    URL = "https://example.com"
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.NOTIFY_TIMEOUT = 0.1
+    settings.NOTIFY_POLLING_INTERVAL = 0
+    factory = AsyncRequestFactory()
+
+    def mocked_fetch(url):
+        Resource.objects.filter(url=URL).update(
+            state=Resource.STATE_DOWNLOADING,
+            status_code=200,
+            content_length=12,
+            content_type="text/plain",
+        )
+        res = Resource.get_by_url(URL)
+        (tmpdir / res.path).dirpath().ensure(dir=True)
+        (tmpdir / res.path).write_text("Hello world!", encoding="utf-8")
+
+    mocker.patch("kiss_cache.tasks.fetch.delay", mocked_fetch)
+
+    async def collect(response):
+        return [chunk async for chunk in response.streaming_content]
+
+    # Streaming
+    request = factory.get(reverse("api.fetch") + "kernel", {"url": URL})
+    ret = async_to_sync(api_fetch_async)(request, filename="kernel")
+    assert isinstance(ret, StreamingHttpResponse)
+    assert ret.is_async
+    assert ret["content-length"] == "12"
+    assert ret["content-disposition"] == "attachment; filename=kernel"
+    Resource.objects.filter(url=URL).update(state=Resource.STATE_FINISHED)
+    assert async_to_sync(collect)(ret) == [b"Hello world!"]
+
+    # Finished
+    ret = async_to_sync(api_fetch_async)(
+        factory.get(reverse("api.fetch"), {"url": URL})
+    )
+    assert ret.status_code == 200
+    assert ret["X-Accel-Redirect"] == f"/internal/{Resource.get_by_url(URL).path}"
+    assert Resource.get_by_url(URL).usage == 2
+    assert Statistic.requests() == 2
+
+    # Errors
+    ret = async_to_sync(api_fetch_async)(factory.post(reverse("api.fetch")))
+    assert ret.status_code == 405
+    ret = async_to_sync(api_fetch_async)(factory.get(reverse("api.fetch")))
+    assert ret.status_code == 400
+    settings.ALLOWED_NETWORKS = ["10.0.0.0/8"]
+    ret = async_to_sync(api_fetch_async)(factory.get(reverse("api.fetch")))
+    assert ret.status_code == 403
+
+
+def test_api_fetch_compressed(client, db, settings, tmpdir):
+    pytest.importorskip("zstandard")
+    URL = "https://example.com"
+    content = b"Hello world!" * 100
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    res = Resource.objects.create(
+        url=URL,
+        state=Resource.STATE_FINISHED,
+        status_code=200,
+        content_length=1200,
+        content_type="text/plain",
+        compression="zstd",
+    )
+    (tmpdir / res.path).dirpath().ensure(dir=True)
+    (tmpdir / "plain").write_binary(content)
+    compress(str(tmpdir / "plain"), res.fullpath)
+
+    # Send the compressed file
+    ret = client.get(
+        reverse("api.fetch"), {"url": URL}, HTTP_ACCEPT_ENCODING="gzip, zstd"
+    )
+    assert ret.status_code == 200
+    assert ret["X-Accel-Redirect"] == f"/internal-zstd/{res.path}"
+    assert ret["Content-Encoding"] == "zstd"
+    assert ret["Vary"] == "Accept-Encoding"
+    assert ret["Content-Type"] == "text/plain"
+
+    settings.USE_XSENDFILE = False
+    ret = client.get(reverse("api.fetch"), {"url": URL}, HTTP_ACCEPT_ENCODING="*")
+    assert isinstance(ret, FileResponse)
+    assert ret["Content-Encoding"] == "zstd"
+    assert int(ret["Content-Length"]) == (tmpdir / res.path).size()
+
+    # Decompress on the fly
+    ret = client.get(
+        reverse("api.fetch"), {"url": URL}, HTTP_ACCEPT_ENCODING="zstd;q=0, gzip"
+    )
+    assert isinstance(ret, StreamingHttpResponse)
+    assert "Content-Encoding" not in ret
+    assert ret["Vary"] == "Accept-Encoding"
+    assert ret["Content-Length"] == "1200"
+    assert b"".join(ret.streaming_content) == content
+
+    async def collect(response):
+        return [chunk async for chunk in response.streaming_content]
+
+    ret = async_to_sync(api_fetch_async)(
+        AsyncRequestFactory().get(reverse("api.fetch"), {"url": URL})
+    )
+    assert ret.is_async
+    assert b"".join(async_to_sync(collect)(ret)) == content
+
+
+def test_api_fetch_variants(client, db, settings, tmpdir):
+    URL = "https://example.com"
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    res = Resource.objects.create(
+        url=URL,
+        state=Resource.STATE_FINISHED,
+        status_code=200,
+        content_length=12,
+        content_type="text/plain",
+        variants="br,gzip",
+    )
+    (tmpdir / res.path).dirpath().ensure(dir=True)
+    (tmpdir / res.path).write_binary(b"Hello world!")
+    (tmpdir / res.encoded_path("gzip")).write_binary(b"gzip")
+
+    ret = client.get(reverse("api.fetch"), {"url": URL}, HTTP_ACCEPT_ENCODING="gzip")
+    assert ret["X-Accel-Redirect"] == f"/internal-gzip/{res.path}.gz"
+    assert ret["Content-Encoding"] == "gzip"
+    assert ret["Vary"] == "Accept-Encoding"
+
+    ret = client.get(
+        reverse("api.fetch"), {"url": URL}, HTTP_ACCEPT_ENCODING="gzip, br"
+    )
+    assert ret["X-Accel-Redirect"] == f"/internal-br/{res.path}.br"
+    assert ret["Content-Encoding"] == "br"
+
+    settings.XSENDFILE_BACKEND = "apache2"
+    ret = client.get(
+        reverse("api.fetch"), {"url": URL}, HTTP_ACCEPT_ENCODING="gzip, br;q=0.5"
+    )
+    assert ret["X-Sendfile"] == str(tmpdir / f"{res.path}.gz")
+    assert ret["Content-Encoding"] == "gzip"
+
+    # No variant accepted
+    settings.USE_XSENDFILE = False
+    ret = client.get(reverse("api.fetch"), {"url": URL})
+    assert isinstance(ret, FileResponse)
+    assert "Content-Encoding" not in ret
+    assert ret["Vary"] == "Accept-Encoding"
+    assert b"".join(ret.streaming_content) == b"Hello world!"
+
+    ret = client.get(reverse("api.fetch"), {"url": URL}, HTTP_ACCEPT_ENCODING="gzip")
+    assert isinstance(ret, FileResponse)
+    assert ret["Content-Encoding"] == "gzip"
+    assert b"".join(ret.streaming_content) == b"gzip"
+
+
+def test_api_fetch_ranges(client, db, settings, tmpdir):
+    URL = "https://example.com"
+    content = b"Hello world!" * 100
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.USE_XSENDFILE = False
+    res = Resource.objects.create(
+        url=URL,
+        state=Resource.STATE_FINISHED,
+        status_code=200,
+        content_length=1200,
+        content_type="text/plain",
+    )
+    (tmpdir / res.path).dirpath().ensure(dir=True)
+    (tmpdir / res.path).write_binary(content)
+
+    ret = client.get(reverse("api.fetch"), {"url": URL})
+    assert isinstance(ret, FileResponse)
+    assert ret["Accept-Ranges"] == "bytes"
+    assert Statistic.upload() == 1200
+
+    # Single range
+    ret = client.get(reverse("api.fetch"), {"url": URL}, HTTP_RANGE="bytes=6-10")
+    assert ret.status_code == 206
+    assert ret["Content-Range"] == "bytes 6-10/1200"
+    assert ret["Content-Length"] == "5"
+    assert ret["Content-Type"] == "text/plain"
+    assert b"".join(ret.streaming_content) == b"world"
+    assert Statistic.upload() == 1205
+
+    # Multiple ranges
+    ret = client.get(reverse("api.fetch"), {"url": URL}, HTTP_RANGE="bytes=0-4,-6")
+    assert ret.status_code == 206
+    content_type = ret["Content-Type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.split("=")[1]
+    body = b"".join(ret.streaming_content)
+    assert int(ret["Content-Length"]) == len(body)
+    assert body == (
+        f"--{boundary}\r\nContent-Type: text/plain\r\n"
+        "Content-Range: bytes 0-4/1200\r\n\r\nHello"
+        f"\r\n--{boundary}\r\nContent-Type: text/plain\r\n"
+        "Content-Range: bytes 1194-1199/1200\r\n\r\nworld!"
+        f"\r\n--{boundary}--\r\n"
+    ).encode("utf-8")
+
+    # Overlapping ranges are sent once
+    ret = client.get(reverse("api.fetch"), {"url": URL}, HTTP_RANGE="bytes=0-,0-")
+    assert ret.status_code == 206
+    assert ret["Content-Range"] == "bytes 0-1199/1200"
+    assert b"".join(ret.streaming_content) == content
+
+    # Not satisfiable
+    ret = client.get(reverse("api.fetch"), {"url": URL}, HTTP_RANGE="bytes=1200-")
+    assert ret.status_code == 416
+    assert ret["Content-Range"] == "bytes */1200"
+    # Only the ranges are counted
+    assert Statistic.upload() == 1205 + 11 + 1200
+
+    # Invalid ranges are ignored
+    ret = client.get(reverse("api.fetch"), {"url": URL}, HTTP_RANGE="bytes=10-0")
+    assert ret.status_code == 200
+    assert isinstance(ret, FileResponse)
+
+    # While downloading
+    Resource.objects.filter(pk=res.pk).update(state=Resource.STATE_DOWNLOADING)
+    ret = client.get(reverse("api.fetch"), {"url": URL}, HTTP_RANGE="bytes=-6")
+    assert ret.status_code == 206
+    assert ret["Content-Range"] == "bytes 1194-1199/1200"
+    assert ret["Accept-Ranges"] == "bytes"
+    assert b"".join(ret.streaming_content) == b"world!"
+
+    async def collect(response):
+        return [chunk async for chunk in response.streaming_content]
+
+    ret = async_to_sync(api_fetch_async)(
+        AsyncRequestFactory().get(
+            reverse("api.fetch"), {"url": URL}, headers={"Range": "bytes=12-16"}
+        )
+    )
+    assert ret.status_code == 206
+    assert ret.is_async
+    assert b"".join(async_to_sync(collect)(ret)) == b"Hello"
+
+
+def test_api_fetch_ranges_compressed(client, db, settings, tmpdir):
+    pytest.importorskip("zstandard")
+    URL = "https://example.com"
+    content = b"Hello world!" * 100
+    settings.DOWNLOAD_PATH = str(tmpdir)
+    settings.RESOURCE_COMPRESSION_FRAME_SIZE = 100
+    res = Resource.objects.create(
+        url=URL,
+        state=Resource.STATE_FINISHED,
+        status_code=200,
+        content_length=1200,
+        content_type="text/plain",
+        compression="zstd",
+    )
+    (tmpdir / res.path).dirpath().ensure(dir=True)
+    (tmpdir / "plain").write_binary(content)
+    compress(str(tmpdir / "plain"), res.fullpath)
+
+    ret = client.get(reverse("api.fetch"), {"url": URL}, HTTP_RANGE="bytes=90-215")
+    assert ret.status_code == 206
+    assert ret["Content-Range"] == "bytes 90-215/1200"
+    assert ret["Accept-Ranges"] == "bytes"
+    assert "Content-Encoding" not in ret
+    assert b"".join(ret.streaming_content) == content[90:216]